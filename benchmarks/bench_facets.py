@@ -0,0 +1,86 @@
+""" Time the plugin's IFacets hooks, as called for each search page
+
+Compares the hooks with the implementation that rebuilt the facets on
+every call. Run with::
+
+    nosetests -s benchmarks/bench_facets.py
+"""
+import timeit
+from collections import OrderedDict
+
+import mock
+
+import ckan.plugins.toolkit as toolkit
+
+from ckanext.mapactionimporter import plugin
+
+CALLS = 10000
+
+FACETS = (
+    ('organization', 'Organizations'),
+    ('groups', 'Groups'),
+    ('tags', 'Tags'),
+    ('res_format', 'Formats'),
+    ('license_id', 'Licenses'),
+)
+
+
+def rebuilt_dataset_facets(facets_dict, package_type):
+    facets = facets_dict.items()
+    keys = facets_dict.keys()
+    facets_dict.clear()
+
+    position = 0
+    if 'groups' in keys:
+        position = keys.index('groups') + 1
+
+    facets.insert(position, ('vocab_product_themes', toolkit._('Themes')))
+
+    for item in facets:
+        facets_dict[item[0]] = item[1]
+
+    return facets_dict
+
+
+def rebuilt_group_facets(facets_dict, group_type, package_type):
+    facets = facets_dict.items()
+    facets_dict.clear()
+
+    facets_dict['vocab_product_themes'] = toolkit._('Themes')
+    for item in facets:
+        facets_dict[item[0]] = item[1]
+
+    return facets_dict
+
+
+class TestFacets(object):
+    def test_facet_hooks(self):
+        hooks = plugin.MapactionimporterPlugin()
+
+        print
+        print '{0:<10} {1:>16} {2:>16}'.format(
+            'hook', 'rebuilt (us)', 'plugin (us)')
+        print '{0:<10} {1:>16.2f}'.format('(baseline)', _baseline())
+
+        with mock.patch.object(toolkit, '_', lambda s: s):
+            print '{0:<10} {1:>16.2f} {2:>16.2f}'.format(
+                'dataset',
+                _time(lambda f: rebuilt_dataset_facets(f, 'dataset')),
+                _time(lambda f: hooks.dataset_facets(f, 'dataset')))
+            print '{0:<10} {1:>16.2f} {2:>16.2f}'.format(
+                'group',
+                _time(lambda f: rebuilt_group_facets(f, 'group', 'dataset')),
+                _time(lambda f: hooks.group_facets(f, 'group', 'dataset')))
+
+
+def _baseline():
+    """ Time taken by CKAN to create the facets for each request """
+    return min(timeit.repeat(lambda: OrderedDict(FACETS),
+                             number=CALLS, repeat=5)) * 1000000 / CALLS
+
+
+def _time(hook):
+    seconds = min(timeit.repeat(lambda: hook(OrderedDict(FACETS)),
+                                number=CALLS, repeat=5))
+
+    return seconds * 1000000 / CALLS - _baseline()
@@ -0,0 +1,128 @@
+""" Throughput, latency and memory of importing synthetic map packages
+
+Packages are generated by synthetic.generate_package() for each scenario
+below. TestReadPackages reads them with mappackage.to_dataset() alone, and
+TestImportPackages imports them with create_dataset_from_mapaction_zip,
+which needs the CKAN test stack. Run with::
+
+    nosetests -s --nologcapture --with-pylons=test.ini benchmarks/bench_import_pipeline.py
+
+Set BENCH_PACKAGES to the number of packages imported per scenario, and
+any of BENCH_MEMBERS, BENCH_MEMBER_SIZE, BENCH_FIELDS and BENCH_THEMES to
+run a single scenario of that shape instead. Peak RSS is the process's
+peak so far, so scenarios run from smallest to largest.
+"""
+import os
+import shutil
+import tempfile
+import time
+
+import ckan.tests.factories as factories
+import ckan.tests.helpers as helpers
+
+from ckanext.mapactionimporter.lib import mappackage
+from ckanext.mapactionimporter.lib.upload import FileUpload
+from ckanext.mapactionimporter.tests.helpers import FunctionalTestBaseClass
+
+import synthetic
+
+SCENARIOS = (
+    ('small', dict(members=2, member_size=256 * 1024, fields=10, themes=1)),
+    ('many files', dict(members=50, member_size=64 * 1024, fields=10,
+                        themes=1)),
+    ('large files', dict(members=2, member_size=32 * 1024 * 1024, fields=10,
+                         themes=1)),
+    ('large metadata', dict(members=2, member_size=256 * 1024, fields=5000,
+                            themes=5)),
+)
+
+OPERATION_ID = '189'
+
+
+def scenarios():
+    shape = {}
+    for key in ('members', 'member_size', 'fields', 'themes'):
+        value = os.environ.get('BENCH_' + key.upper())
+        if value is not None:
+            shape[key] = int(value)
+
+    if shape:
+        custom = dict(SCENARIOS[0][1])
+        custom.update(shape)
+        return [('custom', custom)]
+
+    return SCENARIOS
+
+
+def generate_packages(directory, prefix, shape):
+    """ Write BENCH_PACKAGES packages of the given shape to directory """
+    count = int(os.environ.get('BENCH_PACKAGES', 20))
+    paths = []
+    for i in range(count):
+        map_number = '{0}{1:04d}'.format(prefix, i)
+        path = os.path.join(directory, map_number + '.zip')
+        synthetic.generate_package(
+            path, map_number=map_number, operation_id=OPERATION_ID, seed=i,
+            **shape)
+        paths.append(path)
+
+    return paths
+
+
+def run_scenarios(process):
+    """ Time process(path) on the packages of each scenario """
+    directory = tempfile.mkdtemp()
+    try:
+        for n, (label, shape) in enumerate(scenarios()):
+            # Map numbers differ between scenarios, so that each one
+            # creates new datasets
+            paths = generate_packages(directory, 'MA{0}'.format(n), shape)
+
+            seconds = []
+            for path in paths:
+                start = time.time()
+                process(path)
+                seconds.append(time.time() - start)
+
+            print
+            synthetic.report(label, seconds,
+                             sum(os.path.getsize(path) for path in paths))
+
+            for path in paths:
+                os.remove(path)
+    finally:
+        shutil.rmtree(directory)
+
+
+class TestReadPackages(object):
+    def test_scenarios(self):
+        run_scenarios(self._read)
+
+    def _read(self, path):
+        with open(path, 'rb') as f:
+            dataset_info = mappackage.to_dataset(f)
+            try:
+                for member in dataset_info['members']:
+                    member_file = member.open()
+                    while member_file.read(mappackage.COPY_BUFFER_SIZE):
+                        pass
+                    member_file.close()
+            finally:
+                dataset_info['zip_file'].close()
+
+
+class TestImportPackages(FunctionalTestBaseClass):
+    def setup(self):
+        super(TestImportPackages, self).setup()
+        self.user = factories.User()
+        factories.Group(name=OPERATION_ID.zfill(5), user=self.user)
+
+    def test_scenarios(self):
+        run_scenarios(self._import)
+
+    def _import(self, path):
+        with open(path, 'rb') as f:
+            helpers.call_action(
+                'create_dataset_from_mapaction_zip',
+                context={'user': self.user['name']},
+                upload=FileUpload(f))
@@ -0,0 +1,129 @@
+""" Count the action calls and search index updates made by one import
+
+test_batch compares the action calls per package of importing packages one
+at a time with importing them as a batch. Run against the CKAN test stack
+with::
+
+    nosetests -s --nologcapture --with-pylons=test.ini benchmarks/bench_import_writes.py
+
+Set BENCH_PACKAGES to the number of packages in the batch (default: 20).
+"""
+import collections
+import contextlib
+import os
+import shutil
+import tempfile
+
+import mock
+
+import ckan.lib.search as search
+import ckan.tests.factories as factories
+import ckan.tests.helpers as helpers
+import ckan.plugins.toolkit as toolkit
+
+from ckanext.mapactionimporter.lib.upload import FileUpload
+from ckanext.mapactionimporter.tests.helpers import (
+    FunctionalTestBaseClass,
+    get_correction_zip,
+    get_test_zip,
+)
+
+import synthetic
+
+
+class TestImportWrites(FunctionalTestBaseClass):
+    def setup(self):
+        super(TestImportWrites, self).setup()
+        self.user = factories.User()
+        factories.Group(name='00189', user=self.user)
+
+    def test_create_and_correct(self):
+        self._report('create', get_test_zip())
+        self._report('correction', get_correction_zip())
+
+    def test_batch(self):
+        count = int(os.environ.get('BENCH_PACKAGES', 20))
+        directory = tempfile.mkdtemp()
+        try:
+            singles = self._generate(directory, 'MA1', count)
+            batch = self._generate(directory, 'MA2', count)
+
+            with _counting() as (action_calls, index_calls):
+                for path in singles:
+                    with open(path, 'rb') as f:
+                        helpers.call_action(
+                            'create_dataset_from_mapaction_zip',
+                            context={'user': self.user['name']},
+                            upload=FileUpload(f))
+            single_calls = sum(action_calls.values())
+
+            files = [open(path, 'rb') for path in batch]
+            try:
+                with _counting() as (action_calls, index_calls):
+                    report = helpers.call_action(
+                        'create_datasets_from_mapaction_zips',
+                        context={'user': self.user['name']},
+                        uploads=[FileUpload(f) for f in files])
+            finally:
+                for f in files:
+                    f.close()
+            batch_calls = sum(action_calls.values())
+        finally:
+            shutil.rmtree(directory)
+
+        assert report['failed'] == 0, report
+        print
+        print '{0} packages'.format(count)
+        print '  action calls per package, one at a time: {0:.1f}'.format(
+            float(single_calls) / count)
+        print '  action calls per package, as a batch:    {0:.1f}'.format(
+            float(batch_calls) / count)
+
+    def _generate(self, directory, prefix, count):
+        paths = []
+        for i in range(count):
+            map_number = '{0}{1:03d}'.format(prefix, i)
+            path = os.path.join(directory, map_number + '.zip')
+            synthetic.generate_package(path, map_number=map_number, seed=i,
+                                       member_size=64 * 1024)
+            paths.append(path)
+
+        return paths
+
+    def _report(self, label, zip_file):
+        with _counting() as (action_calls, index_calls):
+            dataset = helpers.call_action(
+                'create_dataset_from_mapaction_zip',
+                context={'user': self.user['name']},
+                upload=FileUpload(zip_file))
+
+        print
+        print '{0}: {1}'.format(label, dataset['name'])
+        print '  action calls: {0}'.format(sum(action_calls.values()))
+        for name, count in sorted(action_calls.items()):
+            print '    {0:<30} {1}'.format(name, count)
+        print '  search index updates: {0}'.format(sum(index_calls.values()))
+        for name, count in sorted(index_calls.items()):
+            print '    {0:<30} {1}'.format(name, count)
+
+
+@contextlib.contextmanager
+def _counting():
+    """ Count action calls by name, and search index updates by dataset """
+    action_calls = collections.Counter()
+    index_calls = collections.Counter()
+    real_get_action = toolkit.get_action
+    real_dispatch = search.dispatch_by_operation
+
+    def counting_get_action(name):
+        action_calls[name] += 1
+        return real_get_action(name)
+
+    def counting_dispatch(entity_type, entity, operation):
+        index_calls[entity.get('name')] += 1
+        return real_dispatch(entity_type, entity, operation)
+
+    with mock.patch.object(toolkit, 'get_action', counting_get_action), \
+            mock.patch.object(search, 'dispatch_by_operation',
+                              counting_dispatch):
+        yield action_calls, index_calls
@@ -0,0 +1,86 @@
+""" Time reading the fields of generated metadata documents of growing size
+
+Compares the single pass MetadataIndex with looking up each field with its
+own descendant search, as the importer used to, and parsing the whole
+document with streaming it through parse_metadata(). Run with::
+
+    nosetests -s benchmarks/bench_metadata_parsing.py
+"""
+import timeit
+from StringIO import StringIO
+
+from defusedxml.ElementTree import parse
+
+from ckanext.mapactionimporter.lib import mappackage
+
+SIZES = (100, 1000, 10000, 50000)
+
+FIELDS = ('title', 'productType', 'operationID', 'mapNumber',
+          'versionNumber', 'operationID', 'summary', 'status', 'operationID')
+
+
+def generate_metadata(size):
+    """ Return a metadata document with size extra fields and themes """
+    lines = [
+        '<?xml version="1.0" encoding="utf-8"?>',
+        '<mapdoc>',
+        '  <mapdata>',
+        '    <themes>',
+    ]
+    lines.extend('      <theme>Health</theme>' for i in range(size))
+    lines.append('    </themes>')
+    lines.extend('    <field{0}>value {0}</field{0}>'.format(i)
+                 for i in range(size))
+    lines.extend([
+        '    <operationID>00189</operationID>',
+        '    <title>Example</title>',
+        '    <status>New</status>',
+        '    <summary>Example map</summary>',
+        '    <mapNumber>MA001</mapNumber>',
+        '    <versionNumber>1</versionNumber>',
+        '  </mapdata>',
+        '</mapdoc>',
+    ])
+
+    return '\n'.join(lines)
+
+
+def read_indexed(et):
+    metadata = mappackage.MetadataIndex(et)
+    mappackage.populate_dataset_dict_from_xml(metadata)
+    mappackage.get_mandatory_text_node(metadata, 'status')
+    mappackage.get_mandatory_text_node(metadata, 'operationID')
+
+
+def read_per_field(et):
+    for name in FIELDS:
+        et.find('.//mapdata/{0}'.format(name))
+    for e in et.findall('./mapdata/*'):
+        pass
+    for theme in et.findall('.//mapdata//theme'):
+        pass
+
+
+class TestMetadataParsing(object):
+    def test_parsing_cost_by_document_size(self):
+        print
+        print '{0:>8} {1:>12} {2:>12} {3:>12} {4:>12}'.format(
+            'fields', 'parse (ms)', 'index (ms)', 'per field', 'stream (ms)')
+
+        for size in SIZES:
+            xml = generate_metadata(size)
+            et = parse(StringIO(xml))
+
+            parse_time = _best(lambda: parse(StringIO(xml)))
+            indexed = _best(lambda: read_indexed(et))
+            per_field = _best(lambda: read_per_field(et))
+            streamed = _best(
+                lambda: mappackage.parse_metadata(StringIO(xml)))
+
+            print '{0:>8} {1:>12.2f} {2:>12.2f} {3:>12.2f} {4:>12.2f}'.format(
+                size, parse_time * 1000, indexed * 1000, per_field * 1000,
+                streamed * 1000)
+
+
+def _best(function, repeat=5):
+    return min(timeit.repeat(function, number=1, repeat=repeat))
@@ -0,0 +1,117 @@
+""" Generate synthetic map packages, and summarise benchmark timings
+
+Packages are made from a seeded random number generator, so the same
+arguments always give the same package.
+"""
+import random
+import resource
+import tempfile
+import zipfile
+
+BLOCK_SIZE = 64 * 1024
+
+METADATA = u"""<?xml version="1.0" encoding="utf-8"?>
+<mapdoc>
+  <mapdata>
+    <operationID>{operation_id}</operationID>
+    <title>Synthetic map {map_number}</title>
+    <mapNumber>{map_number}</mapNumber>
+    <versionNumber>{version}</versionNumber>
+    <status>{status}</status>
+    <summary>Synthetic map package generated for benchmarking</summary>
+    <themes>
+{themes}
+    </themes>
+{fields}
+  </mapdata>
+</mapdoc>
+"""
+
+THEMES = (
+    'Health',
+    'Logistics',
+    'Orientation and Reference',
+    'Water Sanitation and Hygiene',
+    'Affected Population',
+)
+
+
+def generate_package(fp, map_number='MA001', operation_id='189', version=1,
+                     status='New', members=2, member_size=1024 * 1024,
+                     fields=0, themes=1, seed=0):
+    """ Write a map package to fp, which may be a path
+
+    The package has the given number of members of member_size bytes of
+    incompressible data, and metadata with fields extra fields and themes
+    themes.
+    """
+    rng = random.Random(seed)
+    block = ''.join(chr(rng.getrandbits(8)) for i in range(BLOCK_SIZE))
+
+    metadata = METADATA.format(
+        operation_id=operation_id,
+        map_number=map_number,
+        version=version,
+        status=status,
+        themes='\n'.join(
+            '      <theme>{0}</theme>'.format(THEMES[i % len(THEMES)])
+            for i in range(themes)),
+        fields='\n'.join(
+            '    <field{0}>Value {0}</field{0}>'.format(i)
+            for i in range(fields)),
+    )
+
+    member_file = tempfile.NamedTemporaryFile()
+    try:
+        with zipfile.ZipFile(fp, 'w', zipfile.ZIP_DEFLATED) as z:
+            z.writestr('{0}.xml'.format(map_number), metadata.encode('utf-8'))
+            for i in range(members):
+                _write_member(member_file, block, i, member_size)
+                z.write(member_file.name, '{0}-{1}.pdf'.format(map_number, i))
+    finally:
+        member_file.close()
+
+
+def _write_member(f, block, i, size):
+    # Written a block at a time, so that generating large members doesn't
+    # add to the peak memory use being measured. Each member starts
+    # differently, so none are identical.
+    f.seek(0)
+    f.truncate()
+    f.write(str(i)[:size])
+    remaining = size - f.tell()
+    while remaining > 0:
+        f.write(block[:remaining])
+        remaining -= len(block)
+    f.flush()
+
+
+def percentile(values, p):
+    """ Return the p'th percentile of values, by nearest rank """
+    values = sorted(values)
+    if not values:
+        return None
+
+    rank = int(round(p / 100.0 * len(values) + 0.5)) - 1
+    return values[min(max(rank, 0), len(values) - 1)]
+
+
+def peak_rss_mb():
+    """ Return the peak resident set size of this process so far """
+    # Kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def report(label, seconds, total_bytes):
+    """ Print the throughput and latency of a benchmark run
+
+    seconds holds the time taken by each package.
+    """
+    elapsed = sum(seconds)
+    print '{0}: {1} packages in {2:.2f}s'.format(label, len(seconds), elapsed)
+    print '  throughput: {0:.1f} packages/min, {1:.2f} MB/s'.format(
+        len(seconds) * 60 / elapsed, total_bytes / elapsed / (1024 * 1024))
+    print '  latency (ms): p50 {0:.1f}, p90 {1:.1f}, p99 {2:.1f}, ' \
+        'max {3:.1f}'.format(*[
+            percentile(seconds, p) * 1000 for p in (50, 90, 99, 100)])
+    print '  peak RSS so far: {0:.1f} MB'.format(peak_rss_mb())
@@ -1,3 +1,11 @@
+import Queue
+import glob
+import json
+import math
+import multiprocessing
+import os
+import time
+
 import ckan.plugins.toolkit as toolkit
 
 import paste.script
@@ -7,12 +15,35 @@ from ckanext.mapactionimporter.plugin import (
 )
 
 
+BULK_BATCH_SIZE = 20
+VALIDATE_BATCH_SIZE = 200
+
+
 class MapactionImporterCommand(toolkit.CkanCommand):
     """
     ckanext-mapactionimporter management commands
 
     Usage::
         paster mapactionimporter create_product_themes
+        paster mapactionimporter bulk_import <directory or glob> [options]
+        paster mapactionimporter validate <directory or glob> [options]
+        paster mapactionimporter worker
+        paster mapactionimporter collect_blobs
+        paster mapactionimporter recover
+
+    bulk_import options::
+        -w, --workers N         Import N packages at once (default: 1)
+        --processes             Use worker processes rather than threads
+        --checkpoint FILE       Record results in FILE and skip packages
+                                already imported successfully
+        --owner-org ORG         Organization to create the datasets in
+        --user USER             User to import as (default: site user)
+
+    validate checks packages without importing them. It takes the
+    --workers and --user options.
+
+    recover undoes whatever was done by imports that died part way, for
+    example when their process was killed.
 
     """
     summary = __doc__.split('\n')[0]
@@ -22,6 +53,18 @@ class MapactionImporterCommand(toolkit.CkanCommand):
     parser.add_option('-c', '--config', dest='config',
                       default='development.ini',
                       help='Config file to use.')
+    parser.add_option('-w', '--workers', dest='workers', type='int',
+                      default=1,
+                      help='Number of packages to import at once.')
+    parser.add_option('--processes', dest='processes', action='store_true',
+                      default=False,
+                      help='Use worker processes rather than threads.')
+    parser.add_option('--checkpoint', dest='checkpoint',
+                      help='File recording imported packages.')
+    parser.add_option('--owner-org', dest='owner_org',
+                      help='Organization to create the datasets in.')
+    parser.add_option('--user', dest='user',
+                      help='User to import as.')
 
     def command(self):
         cmd = None
@@ -31,6 +74,258 @@ class MapactionImporterCommand(toolkit.CkanCommand):
         self._load_config()
 
         if cmd == 'create_product_themes':
-            create_product_themes()
+            changes = create_product_themes()
+            if changes['vocabulary_created']:
+                print 'Created product_themes vocabulary'
+            print 'Added themes: {0}'.format(
+                ', '.join(changes['created']) or 'none')
+            print 'Removed themes: {0}'.format(
+                ', '.join(changes['deleted']) or 'none')
+        elif cmd == 'bulk_import' and len(self.args) == 2:
+            self.bulk_import(self.args[1])
+        elif cmd == 'validate' and len(self.args) == 2:
+            self.validate(self.args[1])
+        elif cmd == 'collect_blobs':
+            self.collect_blobs()
+        elif cmd == 'recover':
+            self.recover()
+        elif cmd == 'worker':
+            from ckanext.mapactionimporter.lib import jobs
+            jobs.work()
         else:
             print self.__doc__
+
+    def bulk_import(self, pattern):
+        from ckanext.mapactionimporter.lib import workers
+
+        workers.register_translator()
+
+        paths = _find_zips(pattern)
+        done = _read_checkpoint(self.options.checkpoint)
+        todo = [p for p in paths if os.path.abspath(p) not in done]
+
+        print 'Importing {0} packages ({1} already imported)'.format(
+            len(todo), len(paths) - len(todo))
+
+        user = self.options.user or toolkit.get_action('get_site_user')(
+            {'ignore_auth': True}, {})['name']
+        # Each worker imports a batch at a time, so that the event of each
+        # batch is looked up once. Results are passed back as each package
+        # is imported, so that they are checkpointed straight away.
+        if self.options.processes:
+            results = multiprocessing.Manager().Queue()
+        else:
+            results = Queue.Queue()
+        tasks = [(batch, user, self.options.owner_org, results)
+                 for batch in _batches(todo, self.options.workers)]
+
+        checkpoint = None
+        if self.options.checkpoint:
+            checkpoint = open(self.options.checkpoint, 'a')
+
+        pool = workers.pool(self.options.workers,
+                            processes=self.options.processes)
+        start = time.time()
+        imported = failed = total_bytes = 0
+
+        try:
+            outcome = pool.map_async(_import_zips, tasks)
+            for result in _results(results, outcome):
+                if result['success']:
+                    imported += 1
+                    total_bytes += result['bytes']
+                    print 'OK     {path}: {name} ({seconds:.1f}s)'.format(
+                        **result)
+                else:
+                    failed += 1
+                    print 'FAILED {path}: {error}'.format(**result)
+
+                if checkpoint is not None:
+                    checkpoint.write(json.dumps(result) + '\n')
+                    checkpoint.flush()
+            outcome.get()
+        finally:
+            pool.close()
+            pool.join()
+            if checkpoint is not None:
+                checkpoint.close()
+
+        elapsed = max(time.time() - start, 0.001)
+        print '{0} imported, {1} failed in {2:.1f}s'.format(
+            imported, failed, elapsed)
+        print '{0:.1f} zips/min, {1:.2f} MB/s'.format(
+            imported * 60 / elapsed, total_bytes / elapsed / (1024 * 1024))
+
+    def validate(self, pattern):
+        import ckan.model as model
+        from ckanext.mapactionimporter.lib import workers
+        from ckanext.mapactionimporter.lib.upload import FileUpload
+
+        workers.register_translator()
+
+        paths = _find_zips(pattern)
+        user = self.options.user or toolkit.get_action('get_site_user')(
+            {'ignore_auth': True}, {})['name']
+        context = {
+            'model': model,
+            'session': model.Session,
+            'user': user,
+        }
+
+        start = time.time()
+        valid = invalid = 0
+        # Batches keep the number of open files down
+        for i in range(0, len(paths), VALIDATE_BATCH_SIZE):
+            batch = paths[i:i + VALIDATE_BATCH_SIZE]
+            files = [open(path, 'rb') for path in batch]
+            try:
+                report = toolkit.get_action('validate_mapaction_zips')(
+                    dict(context), {
+                        'uploads': [FileUpload(f) for f in files],
+                        'workers': self.options.workers,
+                    })
+            finally:
+                for f in files:
+                    f.close()
+
+            for path, result in zip(batch, report['results']):
+                label = 'OK     ' if result['valid'] else 'INVALID'
+                print '{0} {1}: {2}'.format(label, path, result['name'])
+                for error in result['errors']:
+                    print '          error: {0}'.format(error)
+                for warning in result['warnings']:
+                    print '          warning: {0}'.format(warning)
+
+            valid += report['valid']
+            invalid += report['invalid']
+
+        elapsed = max(time.time() - start, 0.001)
+        print '{0} valid, {1} invalid in {2:.1f}s ({3:.0f} zips/min)'.format(
+            valid, invalid, elapsed, (valid + invalid) * 60 / elapsed)
+
+    def collect_blobs(self):
+        from ckanext.mapactionimporter.lib import blobstore
+
+        store = blobstore.default_blob_store()
+        if store is None:
+            print 'ckan.storage_path is not set'
+            return
+
+        freed = store.collect_garbage()
+        print 'Removed unreferenced blobs, {0:.2f} MB freed'.format(
+            freed / (1024.0 * 1024))
+
+    def recover(self):
+        from ckanext.mapactionimporter.lib import journal, workers
+
+        workers.register_translator()
+
+        results = journal.recover()
+        for result in results:
+            label = 'UNDONE' if result['undone'] else 'FAILED'
+            print '{0} {1} (started {2})'.format(
+                label, result['dataset'],
+                time.strftime('%Y-%m-%d %H:%M:%S',
+                              time.localtime(result['started'])))
+            for reason in result['skipped']:
+                print '       left alone: {0}'.format(reason)
+
+        print '{0} incomplete imports rolled back, {1} failed'.format(
+            len([r for r in results if r['undone']]),
+            len([r for r in results if not r['undone']]))
+
+
+def _find_zips(pattern):
+    if os.path.isdir(pattern):
+        pattern = os.path.join(pattern, '*.zip')
+
+    return sorted(glob.glob(pattern))
+
+
+def _read_checkpoint(path):
+    done = set()
+    if path and os.path.exists(path):
+        with open(path) as f:
+            for line in f:
+                result = json.loads(line)
+                if result['success']:
+                    done.add(result['path'])
+
+    return done
+
+
+def _batches(paths, workers):
+    # As many batches as there are workers, so that every worker gets work,
+    # or more if that would make them larger than BULK_BATCH_SIZE
+    count = min(len(paths), max(workers, int(math.ceil(
+        float(len(paths)) / BULK_BATCH_SIZE))))
+    if not count:
+        return []
+    bounds = [len(paths) * i // count for i in range(count + 1)]
+
+    return [paths[start:end] for start, end in zip(bounds, bounds[1:])]
+
+
+def _results(results, outcome):
+    # Until every batch has finished and its results have been taken
+    while True:
+        try:
+            yield results.get(timeout=1)
+        except Queue.Empty:
+            if outcome.ready() and results.empty():
+                return
+
+
+def _import_zips(task):
+    """ Import a batch of packages, putting each result on the queue given """
+    import ckan.model as model
+    from ckanext.mapactionimporter.lib.upload import FileUpload
+
+    paths, user, owner_org, results = task
+    paths = [os.path.abspath(path) for path in paths]
+    reported = []
+
+    def report(result):
+        path = paths[len(reported)]
+        reported.append(path)
+        results.put({
+            'path': path,
+            'bytes': os.path.getsize(path),
+            'success': result['success'],
+            'name': result['name'],
+            'error': result['errors'],
+            'seconds': result['seconds'],
+        })
+
+    context = {
+        'model': model,
+        'session': model.Session,
+        'user': user,
+        # Waits for a retried import already in flight, however long it takes
+        'claim_wait': None,
+        'result_callback': report,
+    }
+    data_dict = {}
+    if owner_org:
+        data_dict['owner_org'] = owner_org
+
+    files = []
+    try:
+        for path in paths:
+            files.append(open(path, 'rb'))
+        data_dict['uploads'] = [FileUpload(f) for f in files]
+        toolkit.get_action('create_datasets_from_mapaction_zips')(
+            context, data_dict)
+    except Exception as e:
+        for path in paths[len(reported):]:
+            results.put({
+                'path': path,
+                'bytes': os.path.getsize(path) if os.path.exists(path) else 0,
+                'success': False,
+                'error': repr(e),
+                'seconds': 0,
+            })
+    finally:
+        for f in files:
+            f.close()
+        model.Session.remove()
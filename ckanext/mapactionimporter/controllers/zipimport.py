@@ -1,6 +1,12 @@
+import json
+import os
+
 import ckan.model as model
 import ckan.plugins.toolkit as toolkit
 
+from ckanext.mapactionimporter.lib import chunked, jobs
+from ckanext.mapactionimporter.lib.upload import FileUpload
+
 
 class ZipImportController(toolkit.BaseController):
     def new(self, data=None, errors=None, error_summary=None):
@@ -34,8 +40,11 @@ class ZipImportController(toolkit.BaseController):
         }
         self._authorize_or_abort(context)
 
+        params = toolkit.request.params
+        if jobs.async_enabled() and hasattr(params.get('upload'), 'file'):
+            return self._import_dataset_async(params)
+
         try:
-            params = toolkit.request.params
             dataset = toolkit.get_action(
                 'create_dataset_from_mapaction_zip')(
                     context,
@@ -51,6 +60,144 @@ class ZipImportController(toolkit.BaseController):
                             errors=errors,
                             error_summary=error_summary)
 
+    def status(self, id):
+        context = {
+            'model': model,
+            'session': model.Session,
+            'user': toolkit.c.user,
+        }
+
+        try:
+            job = toolkit.get_action('mapaction_import_status')(
+                context, {'id': id})
+        except toolkit.ObjectNotFound:
+            toolkit.abort(404, toolkit._('Import job not found'))
+        except toolkit.NotAuthorized:
+            toolkit.abort(401,
+                toolkit._('Unauthorized to view this import'))
+
+        return toolkit.render(
+            'mapactionimporter/import_status.html',
+            extra_vars={'job': job})
+
+    # Chunked uploads, used by the import form's chunked-upload module so
+    # that a large package can be resumed after a dropped connection
+
+    def upload_start(self):
+        self._authorize_or_abort(self._context())
+
+        params = toolkit.request.params
+        try:
+            size = int(params.get('size', ''))
+        except ValueError:
+            return self._json({'error': toolkit._('Upload size is required')},
+                              status=400)
+
+        try:
+            upload = chunked.start(toolkit.c.user, params.get('filename'),
+                                   size)
+        except chunked.ChunkedUploadException as e:
+            return self._json({'error': unicode(e)}, status=400)
+
+        return self._json(self._upload_status(upload))
+
+    def upload_status(self, id):
+        upload = self._get_upload_or_abort(id)
+
+        return self._json(self._upload_status(upload))
+
+    def upload_chunk(self, id):
+        self._get_upload_or_abort(id)
+
+        request = toolkit.request
+        try:
+            offset = int(request.params.get('offset', ''))
+        except ValueError:
+            return self._json({'error': toolkit._('Chunk offset is required')},
+                              status=400)
+
+        try:
+            chunked.append(id, offset, request.body_file,
+                           request.content_length or 0,
+                           sha256=request.params.get('sha256'))
+        except chunked.ChunkedUploadException as e:
+            # 409 tells the client to resume from the offset given
+            return self._json({'error': unicode(e), 'offset': e.offset},
+                              status=400 if e.offset is None else 409)
+
+        return self._json(self._upload_status(chunked.get_upload(id)))
+
+    def upload_finish(self, id):
+        upload = self._get_upload_or_abort(id)
+        context = self._context()
+
+        try:
+            path = chunked.finish(id)
+        except chunked.ChunkedUploadException as e:
+            return self._json({'error': unicode(e), 'offset': e.offset},
+                              status=409)
+
+        params = toolkit.request.params
+        data_dict = dict((k, params[k]) for k in ('owner_org', 'private')
+                         if k in params)
+
+        if jobs.async_enabled():
+            job_id = jobs.enqueue_file(toolkit.c.user, path,
+                                       upload['filename'], data_dict)
+            return self._json({'url': toolkit.url_for(
+                'import_mapactionzip_status', id=job_id)})
+
+        try:
+            with open(path, 'rb') as f:
+                data_dict['upload'] = FileUpload(f, upload['filename'])
+                dataset = toolkit.get_action(
+                    'create_dataset_from_mapaction_zip')(context, data_dict)
+        except toolkit.ValidationError as e:
+            return self._json({'errors': e.error_summary}, status=400)
+        finally:
+            os.remove(path)
+
+        return self._json({'url': toolkit.url_for(
+            controller='package', action='edit', id=dataset['name'])})
+
+    def _get_upload_or_abort(self, id):
+        self._authorize_or_abort(self._context())
+
+        upload = chunked.get_upload(id)
+        # Other users' uploads are treated as missing
+        if upload is None or upload['user'] != toolkit.c.user:
+            toolkit.abort(404, toolkit._('Upload not found'))
+
+        return upload
+
+    def _upload_status(self, upload):
+        return {
+            'id': upload['id'],
+            'size': upload['size'],
+            'offset': upload['offset'],
+            'chunk_size': chunked.chunk_size(),
+        }
+
+    def _context(self):
+        return {
+            'model': model,
+            'session': model.Session,
+            'user': toolkit.c.user,
+        }
+
+    def _json(self, data, status=200):
+        toolkit.response.status_int = status
+        toolkit.response.headers['Content-Type'] = 'application/json'
+
+        return json.dumps(data)
+
+    def _import_dataset_async(self, params):
+        job_params = dict((k, params[k]) for k in ('owner_org', 'private')
+                          if k in params)
+        job_id = jobs.enqueue(toolkit.c.user, params['upload'], job_params)
+
+        toolkit.redirect_to('import_mapactionzip_status', id=job_id)
+
     def _authorize_or_abort(self, context):
         try:
             toolkit.check_access('package_create', context)
@@ -0,0 +1,271 @@
+/* Uploads the import form's map package in chunks
+ *
+ * Each chunk is sent with its SHA-256 checksum, computed with WebCrypto
+ * where the page has it (it is only offered over HTTPS) and in JavaScript
+ * otherwise, and a chunk that fails is retried from the offset the server
+ * has received. The upload id is remembered, so choosing the same
+ * file again after the page is reloaded resumes the upload. Browsers
+ * without the File API post the form as usual.
+ */
+this.ckan.module('mapactionimporter-chunked-upload', function ($, _) {
+  var K = [
+    0x428a2f98, 0x71374491, 0xb5c0fbcf, 0xe9b5dba5, 0x3956c25b, 0x59f111f1,
+    0x923f82a4, 0xab1c5ed5, 0xd807aa98, 0x12835b01, 0x243185be, 0x550c7dc3,
+    0x72be5d74, 0x80deb1fe, 0x9bdc06a7, 0xc19bf174, 0xe49b69c1, 0xefbe4786,
+    0x0fc19dc6, 0x240ca1cc, 0x2de92c6f, 0x4a7484aa, 0x5cb0a9dc, 0x76f988da,
+    0x983e5152, 0xa831c66d, 0xb00327c8, 0xbf597fc7, 0xc6e00bf3, 0xd5a79147,
+    0x06ca6351, 0x14292967, 0x27b70a85, 0x2e1b2138, 0x4d2c6dfc, 0x53380d13,
+    0x650a7354, 0x766a0abb, 0x81c2c92e, 0x92722c85, 0xa2bfe8a1, 0xa81a664b,
+    0xc24b8b70, 0xc76c51a3, 0xd192e819, 0xd6990624, 0xf40e3585, 0x106aa070,
+    0x19a4c116, 0x1e376c08, 0x2748774c, 0x34b0bcb5, 0x391c0cb3, 0x4ed8aa4a,
+    0x5b9cca4f, 0x682e6ff3, 0x748f82ee, 0x78a5636f, 0x84c87814, 0x8cc70208,
+    0x90befffa, 0xa4506ceb, 0xbef9a3f7, 0xc67178f2
+  ];
+
+  function toHex(bytes) {
+    var hex = '';
+    for (var i = 0; i < bytes.length; i++) {
+      hex += ('0' + bytes[i].toString(16)).slice(-2);
+    }
+    return hex;
+  }
+
+  /* SHA-256 of an ArrayBuffer, for pages without WebCrypto */
+  function sha256(buffer) {
+    var data = new Uint8Array(buffer);
+    var length = data.length;
+    // Padded with 0x80, zeros and the length in bits to a multiple of 64
+    var padded = new Uint8Array(((length + 72) >> 6) << 6);
+    padded.set(data);
+    padded[length] = 0x80;
+    var view = new DataView(padded.buffer);
+    view.setUint32(padded.length - 8, Math.floor(length / 0x20000000));
+    view.setUint32(padded.length - 4, (length << 3) >>> 0);
+
+    var h = [0x6a09e667, 0xbb67ae85, 0x3c6ef372, 0xa54ff53a,
+             0x510e527f, 0x9b05688c, 0x1f83d9ab, 0x5be0cd19];
+    var w = new Array(64);
+
+    function rotr(x, n) {
+      return (x >>> n) | (x << (32 - n));
+    }
+
+    for (var offset = 0; offset < padded.length; offset += 64) {
+      var i;
+      for (i = 0; i < 16; i++) {
+        w[i] = view.getUint32(offset + i * 4);
+      }
+      for (i = 16; i < 64; i++) {
+        var s0 = rotr(w[i - 15], 7) ^ rotr(w[i - 15], 18) ^ (w[i - 15] >>> 3);
+        var s1 = rotr(w[i - 2], 17) ^ rotr(w[i - 2], 19) ^ (w[i - 2] >>> 10);
+        w[i] = (w[i - 16] + s0 + w[i - 7] + s1) | 0;
+      }
+
+      var a = h[0], b = h[1], c = h[2], d = h[3];
+      var e = h[4], f = h[5], g = h[6], k = h[7];
+      for (i = 0; i < 64; i++) {
+        var t1 = (k + (rotr(e, 6) ^ rotr(e, 11) ^ rotr(e, 25)) +
+                  ((e & f) ^ (~e & g)) + K[i] + w[i]) | 0;
+        var t2 = ((rotr(a, 2) ^ rotr(a, 13) ^ rotr(a, 22)) +
+                  ((a & b) ^ (a & c) ^ (b & c))) | 0;
+        k = g; g = f; f = e; e = (d + t1) | 0;
+        d = c; c = b; b = a; a = (t1 + t2) | 0;
+      }
+
+      h[0] = (h[0] + a) | 0; h[1] = (h[1] + b) | 0;
+      h[2] = (h[2] + c) | 0; h[3] = (h[3] + d) | 0;
+      h[4] = (h[4] + e) | 0; h[5] = (h[5] + f) | 0;
+      h[6] = (h[6] + g) | 0; h[7] = (h[7] + k) | 0;
+    }
+
+    var digest = new Uint8Array(32);
+    var digestView = new DataView(digest.buffer);
+    for (var j = 0; j < 8; j++) {
+      digestView.setUint32(j * 4, h[j] >>> 0);
+    }
+    return toHex(digest);
+  }
+
+  return {
+    options: {
+      url: null,
+      retries: 5,
+      retryDelay: 2000
+    },
+
+    initialize: function () {
+      if (!this.options.url || !window.FileReader || !window.Blob ||
+          !Blob.prototype.slice) {
+        return;
+      }
+
+      $.proxyAll(this, /_on/);
+      this.el.on('submit', this._onSubmit);
+      this.progress = $('<div class="progress"><div class="bar"></div></div>')
+        .hide().insertBefore(this.el.find('.form-actions'));
+    },
+
+    _onSubmit: function (event) {
+      var file = this.el.find('input[type=file]')[0].files[0];
+      if (!file) {
+        return;
+      }
+
+      event.preventDefault();
+      this.file = file;
+      this.failures = 0;
+      this.el.find('button[type=submit]').prop('disabled', true);
+      this.progress.show();
+      this._resumeOrStart();
+    },
+
+    _storageKey: function () {
+      var file = this.file;
+      return 'mapactionimporter-upload:' + [
+        file.name, file.size, file.lastModified].join(':');
+    },
+
+    _resumeOrStart: function () {
+      var self = this;
+      var id = window.localStorage && localStorage.getItem(this._storageKey());
+
+      if (!id) {
+        this._start();
+        return;
+      }
+
+      $.getJSON(this.options.url + '/' + id)
+        .done(this._onStatus)
+        .fail(function () { self._start(); });
+    },
+
+    _start: function () {
+      $.post(this.options.url, {filename: this.file.name, size: this.file.size})
+        .done(this._onStatus)
+        .fail(this._onError);
+    },
+
+    _onStatus: function (upload) {
+      this.upload = upload;
+      if (window.localStorage) {
+        localStorage.setItem(this._storageKey(), upload.id);
+      }
+      this.progress.find('.bar').css(
+        'width', (100 * upload.offset / upload.size) + '%');
+
+      if (upload.offset < upload.size) {
+        this._sendChunk(upload.offset);
+      } else {
+        this._finish();
+      }
+    },
+
+    _sendChunk: function (offset) {
+      var self = this;
+      var chunk = this.file.slice(
+        offset, Math.min(offset + this.upload.chunk_size, this.file.size));
+
+      this._checksum(chunk, function (digest) {
+        var url = self.options.url + '/' + self.upload.id + '?offset=' + offset +
+          '&sha256=' + digest;
+
+        $.ajax({
+          url: url,
+          type: 'POST',
+          data: chunk,
+          processData: false,
+          contentType: 'application/octet-stream',
+          dataType: 'json'
+        })
+          .done(function (upload) {
+            self.failures = 0;
+            self._onStatus(upload);
+          })
+          .fail(self._onChunkError);
+      });
+    },
+
+    _checksum: function (chunk, callback) {
+      var self = this;
+      var crypto = window.crypto && window.crypto.subtle;
+      var reader = new FileReader();
+
+      reader.onload = function () {
+        if (!crypto) {
+          callback(sha256(reader.result));
+          return;
+        }
+        crypto.digest('SHA-256', reader.result).then(function (digest) {
+          callback(toHex(new Uint8Array(digest)));
+        }, function () {
+          callback(sha256(reader.result));
+        });
+      };
+      reader.onerror = function () { self._onChunkError({}); };
+      reader.readAsArrayBuffer(chunk);
+    },
+
+    _onChunkError: function (xhr) {
+      var self = this;
+      this.failures += 1;
+      if (this.failures > this.options.retries) {
+        this._onError(xhr);
+        return;
+      }
+
+      // Ask where to carry on from, as the chunk may have been received
+      window.setTimeout(function () {
+        $.getJSON(self.options.url + '/' + self.upload.id)
+          .done(self._onStatus)
+          .fail(self._onChunkError);
+      }, this.options.retryDelay * this.failures);
+    },
+
+    _finish: function () {
+      var self = this;
+      var data = this.el.find(':input').not('[type=file]').serializeArray();
+
+      $.post(this.options.url + '/' + this.upload.id + '/finish', data)
+        .done(function (result) {
+          if (window.localStorage) {
+            localStorage.removeItem(self._storageKey());
+          }
+          window.location = result.url;
+        })
+        .fail(function (xhr) {
+          if (xhr.status === 409) {
+            // Not all of the file has been received
+            self._onChunkError(xhr);
+            return;
+          }
+          if (window.localStorage) {
+            localStorage.removeItem(self._storageKey());
+          }
+          self._onError(xhr);
+        });
+    },
+
+    _onError: function (xhr) {
+      var result = {};
+      try {
+        // Parsed here, as CKAN's jQuery predates responseJSON
+        result = $.parseJSON(xhr.responseText) || {};
+      } catch (e) {}
+      var messages = [];
+      if (result.errors) {
+        $.each(result.errors, function (field, message) {
+          messages.push(message);
+        });
+      } else {
+        messages.push(result.error || _('The upload failed. Please try again.').fetch());
+      }
+
+      this.progress.hide();
+      this.el.find('.chunked-upload-error').remove();
+      $('<div class="alert alert-error chunked-upload-error"></div>')
+        .text(messages.join(' '))
+        .prependTo(this.el);
+      this.el.find('button[type=submit]').prop('disabled', false);
+    }
+  };
+});
@@ -0,0 +1,101 @@
+import errno
+import glob
+import logging
+import os
+
+log = logging.getLogger(__name__)
+
+
+def default_blob_store():
+    """ Return the store next to CKAN's resource files, if they are local """
+    import ckan.lib.uploader as uploader
+
+    storage_path = uploader.get_storage_path()
+    if not storage_path:
+        return None
+
+    return BlobStore(os.path.join(storage_path, 'mapactionimporter', 'blobs'))
+
+
+class BlobStore(object):
+    """ Content-addressed store for uploaded resource files
+
+    Each distinct file is kept once under root, named by its zip CRC, size
+    and SHA-256, and resource files are hard links to it. The CRC and size
+    come free from the zip's central directory, so a file that is not in
+    the store can be recognised without reading it.
+
+    A blob's link count is its reference count plus one. CKAN deleting or
+    replacing a resource file only removes that resource's link, and
+    collect_garbage() removes blobs that are no longer linked to any
+    resource. root must be on the same filesystem as the resource files.
+    """
+
+    def __init__(self, root):
+        self.root = root
+
+    def find(self, crc, size):
+        """ Return (path, sha256) for each stored blob with this CRC and size """
+        pattern = os.path.join(self._directory(crc),
+                               '{0}-*'.format(self._prefix(crc, size)))
+
+        return [(path, os.path.basename(path).rsplit('-', 1)[1])
+                for path in glob.glob(pattern)]
+
+    def add(self, path, crc, size, sha256):
+        """ Add an uploaded resource file to the store """
+        blob = self._blob_path(crc, size, sha256)
+        _make_dirs(os.path.dirname(blob))
+
+        try:
+            os.link(path, blob)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+            # Stored by another import in the meantime: share its copy
+            self.link(blob, path)
+
+        return blob
+
+    def link(self, blob, path):
+        """ Make path, a resource file, a reference to the blob """
+        _make_dirs(os.path.dirname(path))
+
+        tmp_path = path + '~'
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        os.link(blob, tmp_path)
+        os.rename(tmp_path, path)
+
+    def references(self, blob):
+        return os.stat(blob).st_nlink - 1
+
+    def collect_garbage(self):
+        """ Remove unreferenced blobs, returning the number of bytes freed """
+        freed = 0
+        for blob in glob.glob(os.path.join(self.root, '*', '*')):
+            stat = os.stat(blob)
+            if stat.st_nlink == 1:
+                os.remove(blob)
+                freed += stat.st_size
+                log.debug('Removed unreferenced blob {0}'.format(blob))
+
+        return freed
+
+    def _blob_path(self, crc, size, sha256):
+        return os.path.join(self._directory(crc), '{0}-{1}'.format(
+            self._prefix(crc, size), sha256))
+
+    def _directory(self, crc):
+        return os.path.join(self.root, '{0:08x}'.format(crc)[:2])
+
+    def _prefix(self, crc, size):
+        return '{0:08x}-{1}'.format(crc, size)
+
+
+def _make_dirs(path):
+    try:
+        os.makedirs(path)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
@@ -0,0 +1,54 @@
+import threading
+import time
+
+
+class TTLCache(object):
+    """ Thread-safe in-process cache whose entries expire after ttl seconds
+
+    Counts hits and misses. Invalidation only affects the current process,
+    so other web processes see changes once their entries expire.
+    """
+
+    def __init__(self, ttl, max_entries=100):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries = {}
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def get(self, key, compute):
+        """ Return the cached value for key, calling compute() if needed """
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > now:
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+            generation = self._generation
+
+        value = compute()
+
+        with self._lock:
+            # Values computed before an invalidation may already be stale
+            if generation == self._generation:
+                if len(self._entries) >= self.max_entries:
+                    self._entries.clear()
+                self._entries[key] = (now + self.ttl, value)
+
+        return value
+
+    def invalidate(self):
+        with self._lock:
+            self._entries.clear()
+            self._generation += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'entries': len(self._entries),
+            }
@@ -0,0 +1,280 @@
+import fcntl
+import hashlib
+import logging
+import os
+import tempfile
+import time
+import uuid
+
+from ckan.common import _
+import ckan.plugins.toolkit as toolkit
+
+from ckanext.mapactionimporter.lib import mappackage, state
+
+log = logging.getLogger(__name__)
+
+CHUNK_SIZE = 8 * 1024 * 1024
+COPY_BUFFER_SIZE = 64 * 1024
+MAX_OPEN_UPLOADS = 3
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS chunked_upload (
+    id TEXT PRIMARY KEY,
+    user TEXT NOT NULL,
+    filename TEXT,
+    size INTEGER NOT NULL,
+    offset INTEGER NOT NULL,
+    created REAL NOT NULL,
+    updated REAL NOT NULL
+)
+'''
+
+
+class ChunkedUploadException(Exception):
+    """ A chunk was refused
+
+    offset is the number of bytes received so far, from which the client
+    should resume.
+    """
+
+    def __init__(self, message, offset=None):
+        super(ChunkedUploadException, self).__init__(message)
+        self.offset = offset
+
+
+def chunk_size():
+    return toolkit.asint(toolkit.config.get(
+        'ckanext.mapactionimporter.upload_chunk_size', CHUNK_SIZE))
+
+
+def max_size():
+    """ The largest upload accepted, in bytes, or 0 for no limit
+
+    A package that is larger than max_total_size, or than the import quota
+    for extracting it, would be refused once uploaded, so it is refused
+    before any of it is stored.
+    """
+    config = toolkit.config
+    limits = [toolkit.asint(config.get(key, default)) for key, default in (
+        ('ckanext.mapactionimporter.max_total_size',
+         mappackage.MAX_TOTAL_SIZE),
+        ('ckanext.mapactionimporter.import_quota', 0),
+        ('ckanext.mapactionimporter.global_quota', 0),
+    )]
+    limits = [limit for limit in limits if limit > 0]
+
+    return min(limits) if limits else 0
+
+
+def max_open_uploads():
+    return toolkit.asint(toolkit.config.get(
+        'ckanext.mapactionimporter.max_open_uploads', MAX_OPEN_UPLOADS))
+
+
+def start(user, filename, size):
+    """ Begin an upload of size bytes, returning it as a dictionary
+
+    Uploads abandoned for longer than the upload timeout are removed at
+    the same time.
+    """
+    if size <= 0:
+        raise ChunkedUploadException(_('Upload size must be positive'))
+
+    if max_size() and size > max_size():
+        raise ChunkedUploadException(
+            _('Uploads may be at most {0} bytes').format(max_size()))
+
+    remove_stale()
+
+    with _connect() as connection:
+        open_uploads = connection.execute(
+            'SELECT COUNT(*) FROM chunked_upload WHERE user = ?',
+            (user,)).fetchone()[0]
+    if max_open_uploads() and open_uploads >= max_open_uploads():
+        raise ChunkedUploadException(
+            _('You may have at most {0} unfinished uploads. Finish or wait '
+              'for one to expire first.').format(max_open_uploads()))
+
+    upload_id = str(uuid.uuid4())
+    # Created empty, so that the first chunk can be written in place
+    open(_part_path(upload_id), 'wb').close()
+
+    now = time.time()
+    with _connect() as connection:
+        connection.execute(
+            'INSERT INTO chunked_upload '
+            '(id, user, filename, size, offset, created, updated) '
+            'VALUES (?, ?, ?, ?, 0, ?, ?)',
+            (upload_id, user, filename, size, now, now))
+
+    return get_upload(upload_id)
+
+
+def get_upload(upload_id):
+    """ Return the upload as a dictionary, or None if there is no such upload """
+    with _connect() as connection:
+        row = connection.execute(
+            'SELECT * FROM chunked_upload WHERE id = ?',
+            (upload_id,)).fetchone()
+
+    if row is None:
+        return None
+
+    return dict(row)
+
+
+def append(upload_id, offset, fp, length, sha256):
+    """ Add length bytes read from fp at offset, returning the new offset
+
+    offset must be the number of bytes received so far: a chunk that was
+    only partly received is sent again from there. The chunk is only kept
+    if its SHA-256 digest matches sha256.
+    """
+    if not sha256:
+        raise ChunkedUploadException(
+            _('Chunks must be sent with their SHA-256 checksum'))
+
+    if length > chunk_size():
+        raise ChunkedUploadException(
+            _('Chunks may be at most {0} bytes').format(chunk_size()))
+
+    # Checked before the chunk is read, so that a client that is out of
+    # step is told where to resume from straight away
+    _check_offset(get_upload(upload_id), offset, length)
+
+    # The chunk is read from the network, which may be slow, before any
+    # lock is taken
+    with tempfile.TemporaryFile(dir=state.state_dir('chunks')) as chunk:
+        _receive_chunk(fp, length, sha256, chunk, offset)
+
+        try:
+            part = open(_part_path(upload_id), 'r+b')
+        except IOError:
+            # Discarded while the chunk was being received
+            raise ChunkedUploadException(_('Upload not found'))
+
+        with part:
+            # Held while the chunk is added, so that chunks of this upload
+            # sent at once can't interleave. Other uploads aren't held up.
+            fcntl.flock(part, fcntl.LOCK_EX)
+            upload = get_upload(upload_id)
+            _check_offset(upload, offset, length)
+
+            chunk.seek(0)
+            part.seek(offset)
+            # Anything past the offset is from a chunk that failed
+            part.truncate()
+            _copy(chunk, part)
+            part.flush()
+            os.fsync(part.fileno())
+
+            with _connect() as connection:
+                connection.execute(
+                    'UPDATE chunked_upload SET offset = ?, updated = ? '
+                    'WHERE id = ?', (offset + length, time.time(), upload_id))
+
+    return offset + length
+
+
+def finish(upload_id):
+    """ Return the path of a completely received upload
+
+    The file belongs to the caller from then on, and should be moved or
+    removed with discard().
+    """
+    upload = get_upload(upload_id)
+    if upload is None:
+        raise ChunkedUploadException(_('Upload not found'))
+
+    if upload['offset'] != upload['size']:
+        raise ChunkedUploadException(
+            _('Only {0} of {1} bytes have been received').format(
+                upload['offset'], upload['size']),
+            offset=upload['offset'])
+
+    with _connect() as connection:
+        connection.execute(
+            'DELETE FROM chunked_upload WHERE id = ?', (upload_id,))
+
+    return _part_path(upload_id)
+
+
+def discard(upload_id):
+    """ Remove an upload and anything received for it """
+    with _connect() as connection:
+        connection.execute(
+            'DELETE FROM chunked_upload WHERE id = ?', (upload_id,))
+
+    try:
+        os.remove(_part_path(upload_id))
+    except OSError:
+        pass
+
+
+def remove_stale():
+    """ Remove uploads that haven't received a chunk within the timeout """
+    timeout = toolkit.asint(toolkit.config.get(
+        'ckanext.mapactionimporter.upload_timeout', 86400))
+    if not timeout:
+        return
+
+    with _connect() as connection:
+        rows = connection.execute(
+            'SELECT id FROM chunked_upload WHERE updated < ?',
+            (time.time() - timeout,)).fetchall()
+
+    for row in rows:
+        log.info('Removing abandoned upload {0}'.format(row['id']))
+        discard(row['id'])
+
+
+def _check_offset(upload, offset, length):
+    if upload is None:
+        raise ChunkedUploadException(_('Upload not found'))
+
+    if offset != upload['offset']:
+        raise ChunkedUploadException(
+            _('Expected a chunk at offset {0}').format(upload['offset']),
+            offset=upload['offset'])
+
+    if offset + length > upload['size']:
+        raise ChunkedUploadException(
+            _('Chunk is past the end of the upload'),
+            offset=upload['offset'])
+
+
+def _receive_chunk(fp, length, sha256, chunk, offset):
+    digest = hashlib.sha256()
+    remaining = length
+    while remaining > 0:
+        data = fp.read(min(COPY_BUFFER_SIZE, remaining))
+        if not data:
+            break
+        digest.update(data)
+        chunk.write(data)
+        remaining -= len(data)
+
+    if remaining:
+        raise ChunkedUploadException(
+            _('Chunk is shorter than its length'), offset=offset)
+
+    if digest.hexdigest() != sha256.lower():
+        raise ChunkedUploadException(
+            _('Chunk does not match its SHA-256 checksum'), offset=offset)
+
+
+def _copy(source, destination):
+    while True:
+        data = source.read(COPY_BUFFER_SIZE)
+        if not data:
+            break
+        destination.write(data)
+
+
+def _part_path(upload_id):
+    return os.path.join(state.state_dir('chunks'),
+                        '{0}.part'.format(upload_id))
+
+
+def _connect():
+    return state.database('uploads', _SCHEMA)
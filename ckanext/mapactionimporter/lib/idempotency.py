@@ -0,0 +1,122 @@
+import logging
+import time
+from contextlib import contextmanager
+
+from ckanext.mapactionimporter.lib import mappackage, state
+
+log = logging.getLogger(__name__)
+
+# Dataset extra recording the archive a dataset was imported from
+ARCHIVE_SHA256_KEY = 'import_sha256'
+
+POLL_INTERVAL = 1
+# Claims are refreshed at most this often, in seconds
+REFRESH_INTERVAL = 30
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS import_claim (
+    key TEXT PRIMARY KEY,
+    claimed REAL NOT NULL
+)
+'''
+
+
+def archive_sha256(fp):
+    """ Return the SHA-256 of a whole uploaded archive """
+    fp.seek(0)
+    try:
+        return mappackage.file_sha256(fp)
+    finally:
+        fp.seek(0)
+
+
+def import_key(sha256, dataset_info):
+    # The dataset name is made from the operationID, mapNumber and
+    # versionNumber
+    return '{0}:{1}'.format(sha256, dataset_info['name'])
+
+
+def imported_from(dataset_dict, sha256):
+    """ Return whether the dataset was imported from the given archive """
+    for extra in dataset_dict.get('extras', []):
+        if extra['key'] == ARCHIVE_SHA256_KEY:
+            return extra['value'] == sha256
+
+    return False
+
+
+class ImportInProgress(Exception):
+    """ An import with the same key was still in flight after waiting """
+
+
+@contextmanager
+def claim(key, wait=None):
+    """ Run the block as the only import in flight with this key
+
+    If an import with the same key is already in flight, in any thread or
+    process, waits for it to finish first, for at most wait seconds if
+    given, after which ImportInProgress is raised. Yields a Claim, which
+    the block should refresh as it makes progress: claims not refreshed
+    for ckanext.mapactionimporter.import_claim_timeout seconds are assumed
+    to belong to imports that died, and are taken over.
+    """
+    _acquire(key, state.claim_timeout(), wait)
+    try:
+        yield Claim(key)
+    finally:
+        with _connect() as connection:
+            connection.execute('DELETE FROM import_claim WHERE key = ?',
+                               (key,))
+
+
+class Claim(object):
+    def __init__(self, key):
+        self.key = key
+        self._refreshed = time.time()
+
+    def refresh(self):
+        """ Record that the import is still making progress """
+        now = time.time()
+        if now - self._refreshed < REFRESH_INTERVAL:
+            return
+
+        self._refreshed = now
+        with _connect() as connection:
+            connection.execute(
+                'UPDATE import_claim SET claimed = ? WHERE key = ?',
+                (now, self.key))
+
+
+def _acquire(key, timeout, wait=None):
+    give_up = None if wait is None else time.time() + wait
+    while True:
+        now = time.time()
+        with _connect() as connection:
+            connection.execute('BEGIN IMMEDIATE')
+            try:
+                row = connection.execute(
+                    'SELECT claimed FROM import_claim WHERE key = ?',
+                    (key,)).fetchone()
+                acquired = row is None or row['claimed'] < now - timeout
+                if acquired:
+                    if row is not None:
+                        log.warning('Taking over stale import {0}'.format(key))
+                    connection.execute(
+                        'INSERT OR REPLACE INTO import_claim (key, claimed) '
+                        'VALUES (?, ?)', (key, now))
+                connection.execute('COMMIT')
+            except:
+                connection.execute('ROLLBACK')
+                raise
+
+        if acquired:
+            return
+
+        if give_up is not None and time.time() >= give_up:
+            raise ImportInProgress(key)
+
+        time.sleep(POLL_INTERVAL)
+
+
+def _connect():
+    return state.database('imports', _SCHEMA)
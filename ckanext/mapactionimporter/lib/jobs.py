@@ -0,0 +1,306 @@
+import json
+import logging
+import os
+import shutil
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+import ckan.plugins.toolkit as toolkit
+
+from ckanext.mapactionimporter.lib import state
+
+log = logging.getLogger(__name__)
+
+QUEUED = 'queued'
+RUNNING = 'running'
+COMPLETE = 'complete'
+ERROR = 'error'
+
+POLL_INTERVAL = 2
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS import_job (
+    id TEXT PRIMARY KEY,
+    user TEXT NOT NULL,
+    filename TEXT,
+    path TEXT NOT NULL,
+    params TEXT NOT NULL,
+    status TEXT NOT NULL,
+    stage TEXT,
+    dataset TEXT,
+    error TEXT,
+    host TEXT,
+    pid INTEGER,
+    created REAL NOT NULL,
+    updated REAL NOT NULL
+)
+'''
+
+# Added to import_job after it was first released
+_COLUMNS = (('host', 'TEXT'), ('pid', 'INTEGER'))
+
+_workers = []
+_workers_lock = threading.Lock()
+_wake_up = threading.Event()
+
+
+def async_enabled():
+    return toolkit.asbool(
+        toolkit.config.get('ckanext.mapactionimporter.async_import', False))
+
+
+def enqueue(user, upload, params):
+    """ Spool an uploaded map package to disk and queue it for import
+
+    Returns the id of the new job.
+    """
+    job_id = str(uuid.uuid4())
+    path = _spool_path(job_id)
+
+    with open(path, 'wb') as spool_file:
+        upload.file.seek(0)
+        shutil.copyfileobj(upload.file, spool_file)
+
+    _queue(job_id, user, getattr(upload, 'filename', None), path, params)
+
+    return job_id
+
+
+def enqueue_file(user, path, filename, params):
+    """ Queue a map package already on disk for import
+
+    The file is moved into the spool directory, so must be on the same
+    filesystem as the state directory. Returns the id of the new job.
+    """
+    job_id = str(uuid.uuid4())
+    spool_path = _spool_path(job_id)
+    os.rename(path, spool_path)
+
+    _queue(job_id, user, filename, spool_path, params)
+
+    return job_id
+
+
+def get_job(job_id):
+    """ Return the job as a dictionary, or None if there is no such job """
+    with _connect() as connection:
+        row = connection.execute(
+            'SELECT * FROM import_job WHERE id = ?', (job_id,)).fetchone()
+
+    if row is None:
+        return None
+
+    job = dict(row)
+    job['params'] = json.loads(job['params'])
+    if job['error'] is not None:
+        job['error'] = json.loads(job['error'])
+
+    return job
+
+
+def set_stage(job_id, stage):
+    _update(job_id, stage=stage)
+
+
+def claim_next_job():
+    """ Mark the oldest queued job as running and return it
+
+    Jobs abandoned by a worker that has stopped are failed first.
+    """
+    with _connect() as connection:
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            abandoned = _fail_abandoned(connection)
+            row = connection.execute(
+                'SELECT id FROM import_job WHERE status = ? '
+                'ORDER BY created LIMIT 1', (QUEUED,)).fetchone()
+            if row is not None:
+                connection.execute(
+                    'UPDATE import_job SET status = ?, host = ?, pid = ?, '
+                    'updated = ? WHERE id = ?',
+                    (RUNNING, socket.gethostname(), os.getpid(), time.time(),
+                     row['id']))
+            connection.execute('COMMIT')
+        except:
+            connection.execute('ROLLBACK')
+            raise
+
+    _remove_spool_files(abandoned)
+
+    if row is None:
+        return None
+
+    return get_job(row['id'])
+
+
+def recover():
+    """ Fail jobs abandoned by a worker that has stopped, returning their ids
+
+    A worker is taken to have stopped if its process is no longer running
+    on this host, for example because the web server recycled it, or if
+    its job has made no progress for import_claim_timeout seconds.
+    """
+    with _connect() as connection:
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            abandoned = _fail_abandoned(connection)
+            connection.execute('COMMIT')
+        except:
+            connection.execute('ROLLBACK')
+            raise
+
+    _remove_spool_files(abandoned)
+
+    return [row['id'] for row in abandoned]
+
+
+def run_job(job):
+    """ Import the map package for a job claimed with claim_next_job() """
+    import ckan.model as model
+    from ckanext.mapactionimporter.lib.upload import FileUpload
+
+    context = {
+        'model': model,
+        'session': model.Session,
+        'user': job['user'],
+        'progress': lambda stage: set_stage(job['id'], stage),
+        # Waits for a retried import already in flight, however long it takes
+        'claim_wait': None,
+    }
+    data_dict = dict(job['params'])
+
+    try:
+        with open(job['path'], 'rb') as f:
+            data_dict['upload'] = FileUpload(f, job['filename'])
+            dataset = toolkit.get_action('create_dataset_from_mapaction_zip')(
+                context, data_dict)
+        _update(job['id'], status=COMPLETE, stage=None,
+                dataset=dataset['name'])
+    except toolkit.ValidationError as e:
+        _update(job['id'], status=ERROR, error=json.dumps(e.error_summary))
+    except Exception as e:
+        log.exception('Import job {0} failed'.format(job['id']))
+        _update(job['id'], status=ERROR,
+                error=json.dumps({'Error': repr(e)}))
+    finally:
+        model.Session.remove()
+        # Already removed if the job was taken to have been abandoned
+        _remove_spool_files([job])
+
+
+def work(run_forever=True):
+    """ Run queued jobs, waiting for more if run_forever is set """
+    from ckanext.mapactionimporter.lib.workers import register_translator
+
+    register_translator()
+
+    while True:
+        try:
+            job = claim_next_job()
+        except sqlite3.OperationalError:
+            log.exception('Unable to fetch import jobs')
+            job = None
+
+        if job is not None:
+            run_job(job)
+        elif run_forever:
+            _wake_up.wait(POLL_INTERVAL)
+            _wake_up.clear()
+        else:
+            return
+
+
+def start_workers():
+    """ Start the in-process worker threads, if not already running """
+    count = toolkit.asint(toolkit.config.get(
+        'ckanext.mapactionimporter.async_worker_threads', 1))
+
+    with _workers_lock:
+        if count and not _workers:
+            try:
+                recover()
+            except sqlite3.OperationalError:
+                log.exception('Unable to recover import jobs')
+
+        while len(_workers) < count:
+            worker = threading.Thread(target=work,
+                                      name='mapaction-import-worker')
+            worker.daemon = True
+            worker.start()
+            _workers.append(worker)
+
+
+def _fail_abandoned(connection):
+    timeout = state.claim_timeout()
+
+    rows = connection.execute(
+        'SELECT * FROM import_job WHERE status = ?', (RUNNING,)).fetchall()
+    abandoned = [
+        row for row in rows
+        if not state.process_running(row['host'], row['pid']) or
+        row['updated'] < time.time() - timeout]
+
+    for row in abandoned:
+        log.warning('Import job {0} was abandoned by its worker'.format(
+            row['id']))
+        # Anything the import did is undone by the import journal
+        connection.execute(
+            'UPDATE import_job SET status = ?, error = ?, updated = ? '
+            'WHERE id = ?',
+            (ERROR, json.dumps({'Error': 'The import was interrupted. '
+                                'Please upload the package again.'}),
+             time.time(), row['id']))
+
+    return abandoned
+
+
+def _remove_spool_files(rows):
+    for row in rows:
+        try:
+            os.remove(row['path'])
+        except OSError:
+            pass
+
+
+def _spool_path(job_id):
+    return os.path.join(state.state_dir('spool'), '{0}.zip'.format(job_id))
+
+
+def _queue(job_id, user, filename, path, params):
+    now = time.time()
+    with _connect() as connection:
+        connection.execute(
+            'INSERT INTO import_job '
+            '(id, user, filename, path, params, status, created, updated) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+            (job_id, user, filename, path, json.dumps(params), QUEUED, now,
+             now))
+
+    start_workers()
+    _wake_up.set()
+
+
+def _update(job_id, **fields):
+    fields['updated'] = time.time()
+    assignments = ', '.join('{0} = ?'.format(k) for k in fields)
+
+    with _connect() as connection:
+        connection.execute(
+            'UPDATE import_job SET {0} WHERE id = ?'.format(assignments),
+            fields.values() + [job_id])
+
+
+@contextmanager
+def _connect():
+    with state.database('jobs', _SCHEMA) as connection:
+        columns = [c['name'] for c in
+                   connection.execute('PRAGMA table_info(import_job)')]
+        for name, column_type in _COLUMNS:
+            if name not in columns:
+                connection.execute('ALTER TABLE import_job ADD COLUMN '
+                                   '{0} {1}'.format(name, column_type))
+        yield connection
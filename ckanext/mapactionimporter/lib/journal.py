@@ -0,0 +1,318 @@
+import errno
+import json
+import logging
+import os
+import socket
+import time
+import uuid
+from contextlib import contextmanager
+
+import ckan.plugins.toolkit as toolkit
+
+from ckanext.mapactionimporter.lib import idempotency, state
+
+log = logging.getLogger(__name__)
+
+OPEN = 'open'
+# Rolling back failed part way, and is left for recover() to finish
+FAILED = 'failed'
+
+_SCHEMA = (
+    '''
+    CREATE TABLE IF NOT EXISTS import_journal (
+        id TEXT PRIMARY KEY,
+        dataset TEXT NOT NULL,
+        user TEXT,
+        status TEXT NOT NULL,
+        host TEXT NOT NULL,
+        pid INTEGER NOT NULL,
+        created REAL NOT NULL,
+        updated REAL NOT NULL
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS import_effect (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        journal_id TEXT NOT NULL,
+        kind TEXT NOT NULL,
+        data TEXT NOT NULL
+    )
+    ''',
+)
+
+
+class EffectSkipped(Exception):
+    """ Raised by an undo function that found the effect best left alone
+
+    For example because the dataset has been changed since by someone
+    else. The effect is dropped from the journal, and the reason reported.
+    """
+
+
+@contextmanager
+def unit_of_work(dataset, user=None):
+    """ Run the block as one import, undoing its side effects if it fails
+
+    Yields an ImportJournal on which the block records each side effect
+    before making it. The journal is kept on disk, so the effects of an
+    import that dies part way can be undone by recover().
+    """
+    journal = ImportJournal.begin(dataset, user)
+    try:
+        yield journal
+    except:
+        journal.rollback()
+        raise
+
+    journal.commit()
+
+
+class ImportJournal(object):
+    """ Write-ahead record of the side effects of one import
+
+    Each effect is recorded before it is made, so an effect may have been
+    recorded but never made, and undoing one has to allow for that.
+    """
+
+    def __init__(self, journal_id):
+        self.id = journal_id
+        # Reasons for effects left alone by the last rollback()
+        self.skipped = []
+
+    @classmethod
+    def begin(cls, dataset, user=None):
+        journal_id = str(uuid.uuid4())
+        now = time.time()
+        with _connect() as connection:
+            connection.execute(
+                'INSERT INTO import_journal '
+                '(id, dataset, user, status, host, pid, created, updated) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                (journal_id, dataset, user, OPEN, socket.gethostname(),
+                 os.getpid(), now, now))
+
+        return cls(journal_id)
+
+    def record(self, kind, **data):
+        """ Record an effect about to be made, returning its id
+
+        kind is one of the keys of UNDO, which is called with data to
+        undo the effect.
+        """
+        with _connect() as connection:
+            cursor = connection.execute(
+                'INSERT INTO import_effect (journal_id, kind, data) '
+                'VALUES (?, ?, ?)', (self.id, kind, json.dumps(data)))
+            connection.execute(
+                'UPDATE import_journal SET updated = ? WHERE id = ?',
+                (time.time(), self.id))
+
+        return cursor.lastrowid
+
+    def commit(self):
+        """ Keep the import's effects """
+        with _connect() as connection:
+            connection.execute('BEGIN IMMEDIATE')
+            try:
+                _delete(connection, self.id)
+                connection.execute('COMMIT')
+            except:
+                connection.execute('ROLLBACK')
+                raise
+
+    def rollback(self):
+        """ Undo the import's effects, newest first
+
+        Returns whether they were all undone. Any that could not be are
+        left for recover().
+        """
+        import ckan.model as model
+
+        # The import may have failed part way through a database write
+        model.Session.rollback()
+
+        context = _undo_context()
+        failed = False
+        with _connect() as connection:
+            effects = connection.execute(
+                'SELECT * FROM import_effect WHERE journal_id = ? '
+                'ORDER BY id DESC', (self.id,)).fetchall()
+
+        self.skipped = []
+        for effect in effects:
+            try:
+                UNDO[effect['kind']](context, **json.loads(effect['data']))
+            except EffectSkipped as e:
+                log.warning('Not undoing {0} of import {1}: {2}'.format(
+                    effect['kind'], self.id, e))
+                self.skipped.append(unicode(e))
+            except Exception:
+                log.exception('Unable to undo {0} of import {1}'.format(
+                    effect['kind'], self.id))
+                model.Session.rollback()
+                failed = True
+                continue
+
+            with _connect() as connection:
+                connection.execute('DELETE FROM import_effect WHERE id = ?',
+                                   (effect['id'],))
+
+        with _connect() as connection:
+            if failed:
+                connection.execute(
+                    'UPDATE import_journal SET status = ?, updated = ? '
+                    'WHERE id = ?', (FAILED, time.time(), self.id))
+            else:
+                _delete(connection, self.id)
+
+        return not failed
+
+
+def recover():
+    """ Roll back imports that died, or that failed to roll back
+
+    An import is taken to have died if its process is no longer running
+    on this host, or if it has made no progress for import_claim_timeout
+    seconds. Returns a dictionary for each import rolled back, with
+    whether rolling it back succeeded and why any of its effects were
+    left alone.
+    """
+    timeout = state.claim_timeout()
+
+    with _connect() as connection:
+        rows = connection.execute('SELECT * FROM import_journal').fetchall()
+
+    results = []
+    for row in rows:
+        if row['status'] == OPEN and not _abandoned(row, timeout):
+            continue
+
+        log.info('Rolling back import {0} of {1}'.format(
+            row['id'], row['dataset']))
+        import_journal = ImportJournal(row['id'])
+        undone = import_journal.rollback()
+        results.append({
+            'id': row['id'],
+            'dataset': row['dataset'],
+            'started': row['created'],
+            'undone': undone,
+            'skipped': import_journal.skipped,
+        })
+
+    return results
+
+
+def _abandoned(row, timeout):
+    if not state.process_running(row['host'], row['pid']):
+        return True
+
+    return row['updated'] < time.time() - timeout
+
+
+def _undo_file(context, path):
+    try:
+        os.remove(path)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+
+
+def _undo_package_created(context, name, sha256):
+    try:
+        dataset = toolkit.get_action('package_show')(
+            dict(context), {'id': name})
+    except toolkit.ObjectNotFound:
+        return
+
+    # Only remove the dataset if this import created it, in case the
+    # import died before creating it and another has since
+    if not idempotency.imported_from(dataset, sha256):
+        raise EffectSkipped(
+            "Dataset '{0}' was created by another import".format(name))
+
+    toolkit.get_action('dataset_purge')(dict(context), {'id': dataset['id']})
+
+
+def _undo_package_updated(context, dataset, sha256=None):
+    try:
+        current = toolkit.get_action('package_show')(
+            dict(context), {'id': dataset['id']})
+    except toolkit.ObjectNotFound:
+        raise EffectSkipped(
+            "Dataset '{0}' has since been deleted".format(dataset['name']))
+
+    # The update failed if the dataset doesn't carry this import's archive,
+    # or it has been corrected again since, which mustn't be overwritten
+    if sha256 is None or not idempotency.imported_from(current, sha256):
+        raise EffectSkipped(
+            "Dataset '{0}' is not as this import left it".format(
+                dataset['name']))
+
+    toolkit.get_action('package_update')(dict(context), dataset)
+
+
+def _undo_member_created(context, group, dataset):
+    try:
+        toolkit.get_action('member_delete')(dict(context), {
+            'id': group,
+            'object': dataset,
+            'object_type': 'package',
+        })
+    except toolkit.ObjectNotFound:
+        pass
+
+
+def _undo_version_linked(context, dataset, parent=None,
+                         parent_created=False):
+    # The link itself goes when the dataset, created by the same import, is
+    # purged by undoing its package_created effect. The parent dataset that
+    # groups the versions is purged too if the link created it and no other
+    # version has been linked to it since.
+    if not parent_created:
+        return
+
+    try:
+        relationships = toolkit.get_action('package_relationships_list')(
+            dict(context), {'id': parent})
+    except toolkit.ObjectNotFound:
+        return
+
+    others = [r for r in relationships
+              if dataset not in (r['subject'], r['object'])]
+    if others:
+        raise EffectSkipped(
+            "Dataset '{0}' has other versions linked to it".format(parent))
+
+    toolkit.get_action('dataset_purge')(dict(context), {'id': parent})
+
+
+UNDO = {
+    'file': _undo_file,
+    'package_created': _undo_package_created,
+    'package_updated': _undo_package_updated,
+    'member_created': _undo_member_created,
+    'version_linked': _undo_version_linked,
+}
+
+
+def _undo_context():
+    import ckan.model as model
+
+    site_user = toolkit.get_action('get_site_user')({'ignore_auth': True}, {})
+    return {
+        'model': model,
+        'session': model.Session,
+        'user': site_user['name'],
+        'ignore_auth': True,
+    }
+
+
+def _delete(connection, journal_id):
+    connection.execute('DELETE FROM import_effect WHERE journal_id = ?',
+                       (journal_id,))
+    connection.execute('DELETE FROM import_journal WHERE id = ?',
+                       (journal_id,))
+
+
+def _connect():
+    return state.database('journal', *_SCHEMA)
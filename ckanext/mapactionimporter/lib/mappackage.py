@@ -1,42 +1,21 @@
+import copy
+import hashlib
 import os
 
 import logging
-import shutil
-import tempfile
+import threading
 import zipfile
 
 from ckan.common import _
 
-from defusedxml.ElementTree import parse, ParseError
+from defusedxml.ElementTree import iterparse, ParseError
 from slugify import slugify
 
-log = logging.getLogger(__name__)
-
-# Valid CKAN tags must only contain alphanumeric characters or symbols: -_.
-PRODUCT_THEMES = (
-    "Affected Population",
-    "Agriculture",
-    "Appeals",
-    "Camp Coordination or Management",
-    "Early Recovery",
-    "Education",
-    "Emergency Shelter",
-    "Emergency Telecommunications",
-    "Environmental Aspects",
-    "Health",
-    "Logistics",
-    "Nutrition",
-    "P-codes",
-    "Population Baseline",
-    "Orientation and Reference",
-    "Search and Rescue or Evacuation Planning",
-    "Search and Rescue Sectors",
-    "Security and Safety and Protection",
-    "Situation and Damage",
-    "Water Sanitation and Hygiene",
-    "Who-What-Where",
-)
+from ckanext.mapactionimporter.lib import themes
+# Also imported from here by existing code
+from ckanext.mapactionimporter.lib.themes import PRODUCT_THEMES
 
+log = logging.getLogger(__name__)
 
 EXCLUDE_TAGS = (
     'operationID',
@@ -48,17 +27,209 @@ EXCLUDE_TAGS = (
 )
 
 
+COPY_BUFFER_SIZE = 64 * 1024
+
+# Default limits on the metadata XML. Real metadata is a few kilobytes.
+MAX_METADATA_BYTES = 1024 * 1024
+MAX_METADATA_ELEMENTS = 10000
+MAX_METADATA_DEPTH = 32
+
+# Default limits on the archive, checked against its central directory
+# before anything in it is decompressed. 0 is no limit.
+MAX_ENTRIES = 1000
+MAX_TOTAL_SIZE = 4 * 1024 * 1024 * 1024
+MAX_MEMBER_SIZE = 2 * 1024 * 1024 * 1024
+MAX_COMPRESSION_RATIO = 100
+# Members smaller than this may be compressed by any ratio
+RATIO_MIN_SIZE = 1024 * 1024
+
+NESTED_ARCHIVE_EXTENSIONS = (
+    '.7z',
+    '.bz2',
+    '.gz',
+    '.rar',
+    '.tar',
+    '.tgz',
+    '.xz',
+    '.zip',
+)
+
+
 class MapPackageException(Exception):
     pass
 
 
-def map_metadata_to_ckan_extras(et):
-    map_metadata = {}
-    for e in et.findall('./mapdata/*'):
-        if e.tag in EXCLUDE_TAGS:
+class MetadataIndex(object):
+    """ The mapdata fields of a metadata document, read in a single pass
+
+    fields maps each tag to the text of its first mapdata element, extras
+    holds the fields of the top level mapdata that are stored as dataset
+    extras and themes lists the text of every theme in document order.
+    """
+
+    def __init__(self, et=None):
+        self.fields = {}
+        self.extras = {}
+        self.themes = []
+
+        if et is None:
+            return
+
+        root = et.getroot() if hasattr(et, 'getroot') else et
+        top_level = root.findall('mapdata')
+        for mapdata in root.iter('mapdata'):
+            if mapdata is root:
+                continue
+            is_top_level = any(mapdata is m for m in top_level)
+            for e in _child_elements(mapdata):
+                self.add_field(e.tag, e.text, is_top_level)
+            self.themes.extend(theme.text for theme in mapdata.iter('theme'))
+
+    def add_field(self, tag, text, top_level=True):
+        self.fields.setdefault(tag, text)
+        if top_level and tag not in EXCLUDE_TAGS:
+            self.extras[tag] = text
+
+
+def _child_elements(element):
+    # lxml includes comments and processing instructions
+    return (e for e in element if isinstance(e.tag, basestring))
+
+
+def parse_metadata(fp, max_bytes=0, max_elements=0, max_depth=0):
+    """ Read the mapdata fields of a metadata document into a MetadataIndex
+
+    Streams the document, keeping only the element being read, and stops
+    at the end of the first mapdata element. Documents larger than
+    max_bytes, with more than max_elements elements or nested more than
+    max_depth deep are rejected before they are read in full; 0 is no
+    limit. Raises ParseError for malformed XML.
+    """
+    metadata = MetadataIndex()
+    stack = []
+    mapdata_depth = None
+    elements = 0
+
+    for event, element in iterparse(_LimitedFile(fp, max_bytes),
+                                    events=('start', 'end')):
+        if event == 'start':
+            stack.append(element)
+            elements += 1
+            if max_elements and elements > max_elements:
+                raise MapPackageException(
+                    _('Metadata XML has more than {0} elements').format(
+                        max_elements))
+            if max_depth and len(stack) > max_depth:
+                raise MapPackageException(
+                    _('Metadata XML is nested more than {0} levels deep').format(
+                        max_depth))
+            if (mapdata_depth is None and element.tag == 'mapdata' and
+                    len(stack) > 1):
+                mapdata_depth = len(stack)
             continue
-        map_metadata[e.tag] = e.text
-    return map_metadata
+
+        depth = len(stack)
+        if mapdata_depth is not None:
+            if depth == mapdata_depth:
+                break
+            if depth == mapdata_depth + 1:
+                metadata.add_field(element.tag, element.text,
+                                   top_level=mapdata_depth == 2)
+            if element.tag == 'theme':
+                metadata.themes.append(element.text)
+
+        # Everything needed from the element has been read
+        stack.pop()
+        if stack:
+            stack[-1].remove(element)
+
+    return metadata
+
+
+class _LimitedFile(object):
+    """ Read-only file raising MapPackageException past max_bytes """
+
+    def __init__(self, fp, max_bytes):
+        self._fp = fp
+        self._max_bytes = max_bytes
+        self._bytes = 0
+
+    def read(self, size=-1):
+        data = self._fp.read(size)
+        self._bytes += len(data)
+        if self._max_bytes and self._bytes > self._max_bytes:
+            raise MapPackageException(
+                _('Metadata XML is larger than {0} bytes').format(
+                    self._max_bytes))
+
+        return data
+
+
+def index_metadata(et):
+    """ Return a MetadataIndex of the document, unless given one already """
+    if isinstance(et, MetadataIndex):
+        return et
+
+    return MetadataIndex(et)
+
+
+def map_metadata_to_ckan_extras(et):
+    return dict(index_metadata(et).extras)
+
+
+def file_sha256(fp):
+    """ Return the hex SHA-256 digest of the rest of a file """
+    digest = hashlib.sha256()
+    for chunk in iter(lambda: fp.read(COPY_BUFFER_SIZE), ''):
+        digest.update(chunk)
+
+    return digest.hexdigest()
+
+
+def check_archive(z, max_entries=MAX_ENTRIES, max_total_size=MAX_TOTAL_SIZE,
+                  max_member_size=MAX_MEMBER_SIZE,
+                  max_compression_ratio=MAX_COMPRESSION_RATIO,
+                  allow_nested_archives=False):
+    """ Reject a zip that would be too costly to import
+
+    Only the central directory is read, so this is cheap however large or
+    highly compressed the members are. Members can't decompress to more
+    than the central directory says, as reading them checks their sizes.
+    """
+    infos = z.infolist()
+    if max_entries and len(infos) > max_entries:
+        raise MapPackageException(
+            _('Zip file has {0} files, the limit is {1}').format(
+                len(infos), max_entries))
+
+    total_size = 0
+    for info in infos:
+        filename = _member_filename(info)
+
+        if max_member_size and info.file_size > max_member_size:
+            raise MapPackageException(
+                _("'{0}' is larger than {1} bytes").format(
+                    filename, max_member_size))
+
+        if (max_compression_ratio and info.file_size > RATIO_MIN_SIZE and
+                info.file_size > max_compression_ratio *
+                max(info.compress_size, 1)):
+            raise MapPackageException(
+                _("'{0}' is compressed more than {1} times").format(
+                    filename, max_compression_ratio))
+
+        if (not allow_nested_archives and
+                filename.lower().endswith(NESTED_ARCHIVE_EXTENSIONS)):
+            raise MapPackageException(
+                _("'{0}' is an archive inside the zip file").format(
+                    filename))
+
+        total_size += info.file_size
+
+    if max_total_size and total_size > max_total_size:
+        raise MapPackageException(
+            _('Zip file contents are larger than {0} bytes').format(
+                max_total_size))
 
 
 def join_lines(text):
@@ -69,55 +240,307 @@ def join_lines(text):
     return ' '.join(text.splitlines())
 
 
-def to_dataset(map_package):
-    # Extract the map package
-    tempdir = tempfile.mkdtemp('-mapactionzip')
+class MapPackageMember(object):
+    """ A file inside a map package, read lazily from the zip
+
+    Members of the same package can be read from different threads at
+    once: pass them all the same lock.
+    """
+
+    def __init__(self, zip_file, zip_info, filename, lock=None):
+        self.name = os.path.basename(filename)
+        self.size = zip_info.file_size
+        self.crc = zip_info.CRC
+        # Set once the member has been read through
+        self.sha256 = None
+        self._zip_file = zip_file
+        self._zip_info = zip_info
+        self._lock = lock or threading.Lock()
+
+    def open(self):
+        return MapPackageFile(self._zip_file, self._zip_info, self.name,
+                              self._lock, member=self)
+
+
+class ExtractedMember(object):
+    """ A file from a map package that has been extracted to disk """
+
+    def __init__(self, path, crc, sha256=None):
+        self.name = os.path.basename(path)
+        self.size = os.path.getsize(path)
+        self.crc = crc
+        self.sha256 = sha256
+        self.path = path
+
+    def open(self):
+        return open(self.path, 'rb')
+
+
+class MapPackageFile(object):
+    """ Read-only file object decompressing a zip member on demand
+
+    Supports the seek()/tell() calls made by CKAN's uploader. Seeking
+    is lazy: the member is only re-read from the start if an earlier
+    position is actually read again. Reading to the end verifies the
+    member and records its SHA-256 digest on member.
+    """
+
+    def __init__(self, zip_file, zip_info, name, lock, member=None):
+        self.name = name
+        self.size = zip_info.file_size
+        self._zip_info = zip_info
+        self._member = member
+        # A copy of the ZipFile reading through its own view of the
+        # archive, as python 2 ZipFiles share one file position between
+        # all their open members
+        self._zip_file = copy.copy(zip_file)
+        self._zip_file.fp = _SharedFile(zip_file.fp, lock)
+        self._stream = None
+        self._stream_pos = 0
+        self._pos = 0
+
+    def read(self, size=-1):
+        if self._stream is None or self._stream_pos > self._pos:
+            self._reopen()
+
+        while self._stream_pos < self._pos:
+            skipped = self._stream.read(
+                min(COPY_BUFFER_SIZE, self._pos - self._stream_pos))
+            if not skipped:
+                break
+            self._stream_pos += len(skipped)
+
+        data = self._stream.read(size)
+        self._stream_pos += len(data)
+        self._pos = self._stream_pos
+
+        if self._stream.sha256 is not None and self._member is not None:
+            self._member.sha256 = self._stream.sha256
+
+        return data
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self._pos
+        elif whence == os.SEEK_END:
+            offset += self.size
+
+        self._pos = max(offset, 0)
+
+    def tell(self):
+        return self._pos
+
+    def close(self):
+        if self._stream is not None:
+            self._stream.close()
+            self._stream = None
+
+    def _reopen(self):
+        self.close()
+        self._stream = _VerifiedStream(self._zip_file, self._zip_info,
+                                       self.name)
+        self._stream_pos = 0
+
+
+class _VerifiedStream(object):
+    """ A zip member's data, checked as it is read
+
+    The data is hashed on the way through, and once the end is reached
+    sha256 is set to its digest, so reading a member once both copies and
+    hashes it. Python 2's zipfile checks the member's CRC at the end, but
+    not its size, which is checked here.
+    """
+
+    def __init__(self, zip_file, zip_info, filename):
+        self.sha256 = None
+        self._stream = zip_file.open(zip_info)
+        self._size = zip_info.file_size
+        self._filename = filename
+        self._digest = hashlib.sha256()
+        self._position = 0
+
+    def read(self, size=-1):
+        try:
+            data = self._stream.read(size)
+        except zipfile.BadZipfile:
+            # Raised for a bad CRC
+            raise MapPackageException(
+                _("'{0}' is corrupt").format(self._filename))
+
+        self._position += len(data)
+        _check_member_size(self._position, self._size, self._filename)
+        self._digest.update(data)
+
+        if (size < 0 or (size and not data)) and self.sha256 is None:
+            if self._position != self._size:
+                raise MapPackageException(
+                    _("'{0}' is corrupt").format(self._filename))
+            self.sha256 = self._digest.hexdigest()
+
+        return data
+
+    def close(self):
+        self._stream.close()
+
+
+class _SharedFile(object):
+    """ View of a file, with its own position, for use from several threads """
+
+    def __init__(self, fp, lock):
+        self._fp = fp
+        self._lock = lock
+        self._pos = 0
+
+    def read(self, size=-1):
+        with self._lock:
+            self._fp.seek(self._pos)
+            data = self._fp.read(size)
+            self._pos = self._fp.tell()
+
+        return data
 
-    metadata_paths = []
-    file_paths = []
-    try:
-        with zipfile.ZipFile(map_package, 'r') as z:
-            for i in z.infolist():
-                filename = i.filename.encode('cp437')
-                full_path = os.path.join(tempdir, filename)
+    def seek(self, offset, whence=os.SEEK_SET):
+        with self._lock:
+            if whence == os.SEEK_CUR:
+                offset += self._pos
+                whence = os.SEEK_SET
+            self._fp.seek(offset, whence)
+            self._pos = self._fp.tell()
 
-                with open(full_path, 'wb') as outputfile:
-                    shutil.copyfileobj(z.open(i.filename), outputfile)
+    def tell(self):
+        return self._pos
 
-                if filename.endswith('.xml'):
-                    metadata_paths.append(full_path)
-                else:
-                    file_paths.append(full_path)
+    def close(self):
+        pass
+
+
+def to_dataset(map_package, workspace=None):
+    """ Read a map package
+
+    By default the files in the package are returned as lazy
+    MapPackageMember handles which stream straight out of the zip. If an
+    ImportWorkspace is given they are extracted into it instead.
+    """
+    dataset_info = read_metadata(map_package)
+    dataset_info['members'] = read_members(dataset_info, workspace)
+
+    return dataset_info
+
+
+def read_metadata(map_package, max_bytes=MAX_METADATA_BYTES,
+                  max_elements=MAX_METADATA_ELEMENTS,
+                  max_depth=MAX_METADATA_DEPTH, **archive_limits):
+    """ First phase of reading a map package
+
+    Checks the zip's central directory with check_archive(), passing it
+    archive_limits, then locates the metadata XML and parses it without
+    reading any of the other files in the package, so that invalid
+    packages can be rejected cheaply. The other limits are passed to
+    parse_metadata(). Pass the result to read_members() to get the files.
+    """
+    try:
+        z = zipfile.ZipFile(map_package, 'r')
     except zipfile.BadZipfile:
         raise MapPackageException(_('File is not a zip file'))
 
+    check_archive(z, **archive_limits)
+
+    metadata_infos = [i for i in z.infolist()
+                      if _member_filename(i).endswith('.xml')]
+
     # Expect a single metadata file
-    if len(metadata_paths) == 0:
+    if len(metadata_infos) == 0:
         raise MapPackageException(_('Could not find metadata XML in zip file'))
-    metadata_file = metadata_paths[0]
+    metadata_info = metadata_infos[0]
+
+    if max_bytes and metadata_info.file_size > max_bytes:
+        raise MapPackageException(
+            _('Metadata XML is larger than {0} bytes').format(max_bytes))
 
     try:
-        et = parse(metadata_file)
+        metadata = parse_metadata(z.open(metadata_info), max_bytes=max_bytes,
+                                  max_elements=max_elements,
+                                  max_depth=max_depth)
     except ParseError as e:
         raise MapPackageException(_("Error parsing XML: '{0}'".format(
             e.msg.args[0])))
+    except zipfile.BadZipfile:
+        raise MapPackageException(_('File is not a zip file'))
 
-    dataset_dict = populate_dataset_dict_from_xml(et)
+    dataset_dict = populate_dataset_dict_from_xml(metadata)
     # Not currently in the metadata
     dataset_dict['license_id'] = 'notspecified'
 
     dataset_info = {
-        'status': get_mandatory_text_node(et, 'status'),
+        'status': get_mandatory_text_node(metadata, 'status'),
         'dataset_dict': dataset_dict,
-        'file_paths': file_paths,
         'name': dataset_dict['name'],
-        'operation_id': get_mandatory_text_node(et, 'operationID'),
+        'operation_id': get_mandatory_text_node(metadata, 'operationID'),
+        'themes': metadata.themes,
+        'zip_file': z,
     }
 
     return dataset_info
 
 
+def read_members(dataset_info, workspace=None):
+    """ Second phase of reading a map package
+
+    Returns the files in the package other than the metadata, either
+    streamed from the zip or extracted into the given workspace.
+    """
+    z = dataset_info['zip_file']
+    lock = threading.Lock()
+    members = []
+    try:
+        for i in z.infolist():
+            filename = _member_filename(i)
+
+            if filename.endswith('.xml'):
+                continue
+            elif workspace is not None:
+                workspace.reserve(i.file_size)
+                full_path = os.path.join(workspace.path, filename)
+
+                with open(full_path, 'wb') as outputfile:
+                    sha256 = _copy_member(z, i, outputfile, filename)
+
+                members.append(ExtractedMember(full_path, i.CRC, sha256))
+            else:
+                members.append(MapPackageMember(z, i, filename, lock))
+    except zipfile.BadZipfile:
+        raise MapPackageException(_('File is not a zip file'))
+
+    return members
+
+
+def _member_filename(zip_info):
+    return zip_info.filename.encode('cp437')
+
+
+def _copy_member(z, zip_info, destination, filename):
+    """ Copy a member to a file, returning its SHA-256 digest """
+    source = _VerifiedStream(z, zip_info, filename)
+    try:
+        for data in iter(lambda: source.read(COPY_BUFFER_SIZE), ''):
+            destination.write(data)
+    finally:
+        source.close()
+
+    return source.sha256
+
+
+def _check_member_size(nbytes, size, filename):
+    # Python 2's zipfile decompresses however much data there is, whatever
+    # the central directory says
+    if nbytes > size:
+        raise MapPackageException(
+            _("'{0}' is larger than the zip file says").format(filename))
+
+
 def populate_dataset_dict_from_xml(et):
+    et = index_metadata(et)
+
     # Extract key metadata
     dataset_dict = {}
     dataset_dict['title'] = join_lines(get_text_node(et, 'title'))
@@ -144,20 +567,20 @@ def populate_dataset_dict_from_xml(et):
 
     dataset_dict['version'] = version_number
 
-    for theme in et.findall('.//mapdata//theme'):
-        if theme.text in PRODUCT_THEMES:
-            dataset_dict.setdefault('product_themes', []).append(theme.text)
-        else:
+    for text in et.themes:
+        theme = themes.lookup(text)
+        if theme is None:
             log.error(
                 "Product theme '{0}' not defined in PRODUCT_THEMES".format(
-                    theme.text))
+                    text))
+        elif theme not in dataset_dict.get('product_themes', []):
+            dataset_dict.setdefault('product_themes', []).append(theme)
 
     summary = get_text_node(et, 'summary')
     dataset_dict['notes'] = join_lines(summary)
 
     dataset_dict['extras'] = [
-        {'key': k, 'value': v} for (k, v) in
-        map_metadata_to_ckan_extras(et).items()
+        {'key': k, 'value': v} for (k, v) in et.extras.items()
     ]
 
     return dataset_dict
@@ -173,8 +596,4 @@ def get_mandatory_text_node(et, name):
 
 
 def get_text_node(et, name):
-    element = et.find('.//mapdata/{0}'.format(name))
-    if element is not None:
-        return element.text
-
-    return None
+    return index_metadata(et).fields.get(name)
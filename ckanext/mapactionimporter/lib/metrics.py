@@ -0,0 +1,269 @@
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+import ckan.plugins.toolkit as toolkit
+
+log = logging.getLogger(__name__)
+
+SECONDS_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+
+class ImportMetrics(object):
+    """ Records the wall time, bytes and calls of each stage of an import
+
+    Stages are started in turn with start_stage(), each ending when the
+    next one starts. observe() records work done within a stage, such as
+    each file uploaded, from any thread.
+    """
+
+    def __init__(self):
+        self.fields = {}
+        self.stages = OrderedDict()
+        self._lock = threading.Lock()
+        self._start = time.time()
+        self._stage = None
+        self._stage_start = None
+
+    def annotate(self, **fields):
+        """ Add fields to the import's log line """
+        self.fields.update(fields)
+
+    def start_stage(self, stage):
+        now = time.time()
+        with self._lock:
+            self._end_stage(now)
+            self._stage = stage
+            self._stage_start = now
+
+    def observe(self, stage, seconds=0, bytes=0, calls=1):
+        with self._lock:
+            stats = self._stats(stage)
+            stats['seconds'] += seconds
+            stats['bytes'] += bytes
+            stats['calls'] += calls
+
+    def finish(self, outcome):
+        """ End the import, returning its record """
+        now = time.time()
+        with self._lock:
+            self._end_stage(now)
+            self._stage = None
+
+        record = dict(self.fields)
+        record.update({
+            'outcome': outcome,
+            'seconds': round(now - self._start, 6),
+            'stages': OrderedDict(
+                (stage, dict(stats, seconds=round(stats['seconds'], 6)))
+                for stage, stats in self.stages.items()),
+        })
+
+        return record
+
+    def _end_stage(self, now):
+        if self._stage is not None:
+            stats = self._stats(self._stage)
+            stats['seconds'] += now - self._stage_start
+            stats['calls'] += 1
+
+    def _stats(self, stage):
+        return self.stages.setdefault(
+            stage, {'seconds': 0.0, 'bytes': 0, 'calls': 0})
+
+
+class MetricsSink(object):
+    """ Receives the record of each import made by this process
+
+    Subclasses override record(), which is called after each import with
+    the dictionary returned by ImportMetrics.finish(). The base class
+    discards it.
+    """
+
+    def record(self, import_record):
+        pass
+
+
+class PrometheusFileSink(MetricsSink):
+    """ Aggregates imports into a file in Prometheus text format
+
+    The file is rewritten after each import, so that it can be read by the
+    node exporter's textfile collector or just looked at. Each process
+    needs its own file: '{pid}' in the path is replaced by the process id.
+    """
+
+    def __init__(self, path, buckets=SECONDS_BUCKETS):
+        self.path = path.format(pid=os.getpid())
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self._imports = {}
+        self._import_seconds = _Histogram(self.buckets)
+        self._stage_seconds = {}
+        self._stage_bytes = {}
+        self._stage_calls = {}
+
+    def record(self, import_record):
+        with self._lock:
+            outcome = import_record['outcome']
+            self._imports[outcome] = self._imports.get(outcome, 0) + 1
+            self._import_seconds.observe(import_record['seconds'])
+
+            for stage, stats in import_record['stages'].items():
+                if stage not in self._stage_seconds:
+                    self._stage_seconds[stage] = _Histogram(self.buckets)
+                self._stage_seconds[stage].observe(stats['seconds'])
+                self._stage_bytes[stage] = (
+                    self._stage_bytes.get(stage, 0) + stats['bytes'])
+                self._stage_calls[stage] = (
+                    self._stage_calls.get(stage, 0) + stats['calls'])
+
+            self._write(self.render())
+
+    def render(self):
+        lines = [
+            '# HELP mapactionimporter_imports_total Map package imports',
+            '# TYPE mapactionimporter_imports_total counter',
+        ]
+        for outcome, count in sorted(self._imports.items()):
+            lines.append('mapactionimporter_imports_total{{outcome="{0}"}} '
+                         '{1}'.format(outcome, count))
+
+        lines.extend([
+            '# HELP mapactionimporter_import_seconds Wall time of imports',
+            '# TYPE mapactionimporter_import_seconds histogram',
+        ])
+        lines.extend(self._import_seconds.render(
+            'mapactionimporter_import_seconds', {}))
+
+        lines.extend([
+            '# HELP mapactionimporter_stage_seconds Wall time of each import '
+            'stage',
+            '# TYPE mapactionimporter_stage_seconds histogram',
+        ])
+        for stage, histogram in sorted(self._stage_seconds.items()):
+            lines.extend(histogram.render(
+                'mapactionimporter_stage_seconds', {'stage': stage}))
+
+        for name, values, help_text in (
+                ('mapactionimporter_stage_bytes_total', self._stage_bytes,
+                 'Bytes processed by each import stage'),
+                ('mapactionimporter_stage_calls_total', self._stage_calls,
+                 'Calls made by each import stage')):
+            lines.extend([
+                '# HELP {0} {1}'.format(name, help_text),
+                '# TYPE {0} counter'.format(name),
+            ])
+            for stage, value in sorted(values.items()):
+                lines.append('{0}{{stage="{1}"}} {2}'.format(
+                    name, stage, value))
+
+        return '\n'.join(lines) + '\n'
+
+    def _write(self, text):
+        directory = os.path.dirname(self.path)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            f.write(text)
+        os.rename(tmp_path, self.path)
+
+
+class _Histogram(object):
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+    def render(self, name, labels):
+        def format_labels(extra=None):
+            items = sorted(labels.items()) + (extra or [])
+            if not items:
+                return ''
+            return '{{{0}}}'.format(','.join(
+                '{0}="{1}"'.format(k, v) for k, v in items))
+
+        lines = []
+        for bound, count in zip(self.buckets, self.counts):
+            lines.append('{0}_bucket{1} {2}'.format(
+                name, format_labels([('le', repr(float(bound)))]), count))
+        lines.append('{0}_bucket{1} {2}'.format(
+            name, format_labels([('le', '+Inf')]), self.count))
+        lines.append('{0}_sum{1} {2!r}'.format(
+            name, format_labels(), self.sum))
+        lines.append('{0}_count{1} {2}'.format(
+            name, format_labels(), self.count))
+
+        return lines
+
+
+_sink = None
+_sink_config = None
+_sink_lock = threading.Lock()
+
+
+def get_sink():
+    """ Return the configured MetricsSink, or None """
+    global _sink, _sink_config
+
+    config = toolkit.config
+    sink_config = (
+        config.get('ckanext.mapactionimporter.metrics_sink'),
+        config.get('ckanext.mapactionimporter.metrics_file'),
+    )
+
+    with _sink_lock:
+        if sink_config != _sink_config:
+            _sink = _create_sink(*sink_config)
+            _sink_config = sink_config
+
+        return _sink
+
+
+def _create_sink(name, path):
+    if not name:
+        return None
+
+    if name == 'prometheus':
+        if not path:
+            from ckanext.mapactionimporter.lib import state
+            path = os.path.join(state.state_dir('metrics'),
+                                'mapactionimporter-{pid}.prom')
+        return PrometheusFileSink(path)
+
+    # Any other sink is given as "package.module:factory"
+    module_name, separator, attr = name.partition(':')
+    module = __import__(module_name, fromlist=[attr])
+    return getattr(module, attr)()
+
+
+def record_import(import_record):
+    """ Log an import's record and pass it to the metrics sink """
+    # Metrics must not fail the import
+    try:
+        try:
+            text = json.dumps(import_record, default=repr)
+        except UnicodeDecodeError:
+            # A field, such as the filename, is a byte string that isn't
+            # UTF-8
+            text = repr(import_record)
+        log.info('Import {0}'.format(text))
+    except Exception:
+        log.exception('Unable to log import metrics')
+
+    try:
+        sink = get_sink()
+        if sink is not None:
+            sink.record(import_record)
+    except Exception:
+        log.exception('Unable to record import metrics')
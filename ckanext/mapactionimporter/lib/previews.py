@@ -0,0 +1,100 @@
+import hashlib
+import logging
+import os
+import zlib
+from contextlib import closing
+from StringIO import StringIO
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+log = logging.getLogger(__name__)
+
+# Longest side, in pixels, of the previews made of each map: a thumbnail
+# for listings and a preview for the dataset page
+PREVIEW_SIZES = (256, 1200)
+JPEG_QUALITY = 85
+# Images are decoded whole before they are scaled down, at three bytes a
+# pixel, so larger ones are skipped. JPEGs are decoded at a reduced scale,
+# which is what is counted for them.
+MAX_PIXELS = 50 * 1000 * 1000
+
+RASTER_EXTENSIONS = ('.jpeg', '.jpg', '.png', '.tif', '.tiff', '.gif')
+
+
+def available():
+    return Image is not None
+
+
+def preview_sources(members):
+    """ Return the members to make previews of
+
+    Pillow can't render PDFs, but each PDF in a map package comes with an
+    image of the same map, which serves as the preview for both.
+    """
+    return [m for m in members
+            if os.path.splitext(m.name)[1].lower() in RASTER_EXTENSIONS]
+
+
+def make_previews(member, sizes=PREVIEW_SIZES, max_pixels=MAX_PIXELS):
+    """ Return a PreviewMember for each size, largest first
+
+    Returns nothing if the member can't be read as an image, or if it has
+    more than max_pixels pixels, so a bad image never fails an import.
+    """
+    previews = []
+    try:
+        with closing(member.open()) as f:
+            # Only the header is read until the image is converted
+            image = Image.open(f)
+            # JPEGs are decoded at the smallest scale that is still large
+            # enough, which is much quicker than decoding 300dpi maps whole
+            image.draft('RGB', (max(sizes), max(sizes)))
+
+            width, height = image.size
+            if max_pixels and width * height > max_pixels:
+                log.warning(
+                    'Not making a preview of {0}, which is {1}x{2} '
+                    'pixels'.format(member.name, width, height))
+                return []
+
+            image = image.convert('RGB')
+
+        for size in sorted(sizes, reverse=True):
+            # Each size is scaled down from the one before
+            image.thumbnail((size, size), Image.ANTIALIAS)
+            previews.append(PreviewMember(member, size, image))
+    except Exception:
+        log.warning('Unable to make a preview of {0}'.format(member.name),
+                    exc_info=True)
+        return []
+
+    return previews
+
+
+class PreviewMember(object):
+    """ A preview image made from a file in a map package
+
+    Has the same attributes as the package's own members, so is uploaded
+    in the same way.
+    """
+
+    def __init__(self, source, size, image):
+        stem = os.path.splitext(source.name)[0]
+        self.name = '{0}-preview-{1}.jpeg'.format(stem, size)
+        self.derived_from = source.name
+
+        output = StringIO()
+        image.save(output, 'JPEG', quality=JPEG_QUALITY, optimize=True,
+                   progressive=True)
+        self._data = output.getvalue()
+
+        self.size = len(self._data)
+        self.crc = zlib.crc32(self._data) & 0xffffffff
+        self.sha256 = hashlib.sha256(self._data).hexdigest()
+
+    def open(self):
+        return StringIO(self._data)
+
@@ -0,0 +1,87 @@
+import errno
+import os
+import socket
+import sqlite3
+import tempfile
+from contextlib import contextmanager
+
+import ckan.plugins.toolkit as toolkit
+
+# Seconds without progress after which an import is taken to have died
+CLAIM_TIMEOUT = 3600
+
+
+def state_dir(*parts):
+    """ Return (creating it if needed) a directory for the importer's files
+
+    Defaults to a mapactionimporter directory under ckan.storage_path, or
+    under the system temporary directory if there is no storage path.
+    """
+    config = toolkit.config
+    root = config.get('ckanext.mapactionimporter.state_dir')
+    if not root:
+        root = os.path.join(
+            config.get('ckan.storage_path') or tempfile.gettempdir(),
+            'mapactionimporter')
+
+    path = os.path.join(root, *parts)
+    if not os.path.isdir(path):
+        try:
+            os.makedirs(path)
+        except OSError:
+            # Created by another process in the meantime
+            if not os.path.isdir(path):
+                raise
+
+    return path
+
+
+def connect(name):
+    """ Open the named SQLite database in the state directory """
+    connection = sqlite3.connect(
+        os.path.join(state_dir(), '{0}.db'.format(name)), timeout=30)
+    connection.row_factory = sqlite3.Row
+
+    return connection
+
+
+@contextmanager
+def database(name, *schema):
+    """ Open the named SQLite database, creating its tables if needed
+
+    The connection autocommits, so the database is only locked for each
+    statement, with explicit transactions where they are needed, and is
+    closed when the block exits.
+    """
+    connection = connect(name)
+    connection.isolation_level = None
+    try:
+        for statement in schema:
+            connection.execute(statement)
+        yield connection
+    finally:
+        connection.close()
+
+
+def claim_timeout():
+    """ Return the seconds without progress after which an import has died
+    """
+    return toolkit.asint(toolkit.config.get(
+        'ckanext.mapactionimporter.import_claim_timeout', CLAIM_TIMEOUT))
+
+
+def process_running(host, pid):
+    """ Return whether a process is still running
+
+    Only processes on this host can be checked, so those on other hosts
+    are taken to be running.
+    """
+    if host != socket.gethostname():
+        return True
+
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+
+    return True
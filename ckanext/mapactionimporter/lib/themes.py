@@ -0,0 +1,171 @@
+import logging
+import re
+
+import ckan.plugins.toolkit as toolkit
+
+log = logging.getLogger(__name__)
+
+# Valid CKAN tags must only contain alphanumeric characters or symbols: -_.
+PRODUCT_THEMES = (
+    "Affected Population",
+    "Agriculture",
+    "Appeals",
+    "Camp Coordination or Management",
+    "Early Recovery",
+    "Education",
+    "Emergency Shelter",
+    "Emergency Telecommunications",
+    "Environmental Aspects",
+    "Health",
+    "Logistics",
+    "Nutrition",
+    "P-codes",
+    "Population Baseline",
+    "Orientation and Reference",
+    "Search and Rescue or Evacuation Planning",
+    "Search and Rescue Sectors",
+    "Security and Safety and Protection",
+    "Situation and Damage",
+    "Water Sanitation and Hygiene",
+    "Who-What-Where",
+)
+
+VOCABULARY = 'product_themes'
+
+# Lock held while the vocabulary is synchronised, so that web processes
+# starting at the same time don't create the same tags
+SYNC_LOCK_KEY = 0x6d617074
+
+# Names the clusters and map templates commonly use for the themes
+ALIASES = {
+    "3W": "Who-What-Where",
+    "4W": "Who-What-Where",
+    "CCCM": "Camp Coordination or Management",
+    "ETC": "Emergency Telecommunications",
+    "Pcodes": "P-codes",
+    "Place Codes": "P-codes",
+    "Shelter": "Emergency Shelter",
+    "WASH": "Water Sanitation and Hygiene",
+}
+
+_CONNECTIVES = frozenset(['and', 'or'])
+_WORD = re.compile(r'[^\W_]+', re.UNICODE)
+
+
+def normalise(text):
+    """ Fold case, whitespace, punctuation and connectives out of a theme
+
+    "Water, Sanitation & Hygiene" and "water sanitation and hygiene" both
+    become "watersanitationhygiene".
+    """
+    words = _WORD.findall(text.replace('&', ' and ').lower())
+    return ''.join(w for w in words if w not in _CONNECTIVES)
+
+
+class ThemeIndex(object):
+    """ Maps the spellings of product themes to their vocabulary names """
+
+    def __init__(self, themes=PRODUCT_THEMES, aliases=None):
+        self.themes = tuple(themes)
+        self._names = {}
+        for theme in self.themes:
+            self._names[normalise(theme)] = theme
+
+        for alias, theme in (aliases or {}).items():
+            name = self._names.get(normalise(theme))
+            if name is None:
+                log.error("Alias '{0}' is for unknown product theme "
+                          "'{1}'".format(alias, theme))
+                continue
+            self._names[normalise(alias)] = name
+
+    def lookup(self, text):
+        """ Return the product theme text stands for, or None """
+        if not text:
+            return None
+
+        return self._names.get(normalise(text))
+
+
+def parse_aliases(value):
+    """ Parse aliases configured one per line as "alias: theme" """
+    aliases = {}
+    for line in (value or '').splitlines():
+        if not line.strip():
+            continue
+        alias, separator, theme = line.partition(':')
+        if not separator:
+            log.error("Ignoring theme alias '{0}' with no ':'".format(line))
+            continue
+        aliases[alias.strip()] = theme.strip()
+
+    return aliases
+
+
+_index = None
+_index_config = None
+
+
+def get_index():
+    """ Return the ThemeIndex for the built-in and configured aliases """
+    global _index, _index_config
+
+    config = toolkit.config.get('ckanext.mapactionimporter.theme_aliases')
+    index = _index
+    if index is None or config != _index_config:
+        aliases = dict(ALIASES)
+        aliases.update(parse_aliases(config))
+        index = ThemeIndex(PRODUCT_THEMES, aliases)
+        _index, _index_config = index, config
+
+    return index
+
+
+def lookup(text):
+    return get_index().lookup(text)
+
+
+def sync_vocabulary(themes=PRODUCT_THEMES):
+    """ Make the product themes vocabulary hold exactly the given themes
+
+    Works out the tags to add and remove from one query and applies them
+    in a single transaction, which is rolled back on error. Running it
+    again, or from several processes at once, changes nothing more.
+    Returns what was changed.
+    """
+    import ckan.model as model
+
+    session = model.Session
+    try:
+        if session.bind.dialect.name == 'postgresql':
+            # Released when the transaction ends
+            session.execute('SELECT pg_advisory_xact_lock(:key)',
+                            {'key': SYNC_LOCK_KEY})
+
+        vocab = model.Vocabulary.get(VOCABULARY)
+        vocabulary_created = vocab is None
+        if vocabulary_created:
+            vocab = model.Vocabulary(VOCABULARY)
+            session.add(vocab)
+            session.flush()
+
+        tags = dict((tag.name, tag) for tag in vocab.tags)
+        created = sorted(set(themes) - set(tags))
+        deleted = sorted(set(tags) - set(themes))
+
+        for name in created:
+            session.add(model.Tag(name=name, vocabulary_id=vocab.id))
+        for name in deleted:
+            # Also removes the tag from datasets
+            session.delete(tags[name])
+
+        model.repo.commit()
+    except:
+        session.rollback()
+        raise
+
+    return {
+        'vocabulary_created': vocabulary_created,
+        'created': created,
+        'deleted': deleted,
+    }
@@ -0,0 +1,9 @@
+import os
+
+
+class FileUpload(object):
+    """ Stand-in for the cgi.FieldStorage the import actions expect """
+
+    def __init__(self, fp, filename=None):
+        self.file = fp
+        self.filename = filename or os.path.basename(fp.name)
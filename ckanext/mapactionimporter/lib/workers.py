@@ -0,0 +1,41 @@
+import multiprocessing
+import threading
+from multiprocessing.pool import ThreadPool
+
+_local = threading.local()
+
+
+def register_translator():
+    # https://github.com/ckan/ckanext-archiver/blob/master/ckanext/archiver/bin/common.py
+    # If not set (in cli access), patch the a translator with a mock, so the
+    # _() functions in logic layer don't cause failure.
+    # Registrations only apply to the current thread, so this also needs to
+    # be called in any worker thread that calls actions.
+    from paste.registry import Registry
+    from pylons import translator
+    from ckan.lib.cli import MockTranslator
+
+    if getattr(_local, 'registry', None) is None:
+        _local.registry = Registry()
+        _local.registry.prepare()
+        _local.registry.register(translator, MockTranslator())
+
+
+def pool(width, processes=False):
+    """ Return a pool of worker threads, or processes, that can call actions
+
+    Tasks that use the database should call model.Session.remove() when
+    they finish so that each task gets a fresh session.
+    """
+    if processes:
+        return multiprocessing.Pool(width, _init_worker_process)
+
+    return ThreadPool(width, register_translator)
+
+
+def _init_worker_process():
+    import ckan.model as model
+
+    # Database connections inherited from the parent can't be shared
+    model.meta.engine.dispose()
+    register_translator()
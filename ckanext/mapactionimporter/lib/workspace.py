@@ -0,0 +1,92 @@
+import logging
+import shutil
+import tempfile
+import threading
+
+from ckan.common import _
+
+from ckanext.mapactionimporter.lib.mappackage import MapPackageException
+
+log = logging.getLogger(__name__)
+
+_lock = threading.Lock()
+_bytes_in_flight = 0
+
+
+class WorkspaceQuotaExceeded(MapPackageException):
+    pass
+
+
+def bytes_in_flight():
+    """ Bytes currently reserved by open workspaces in this process """
+    return _bytes_in_flight
+
+
+class ImportWorkspace(object):
+    """ Scratch directory for a single import
+
+    Use as a context manager. The directory is created on first use and
+    removed, along with everything in it, when the block exits whether or
+    not the import succeeded.
+
+    Space must be reserved before it is written. quota limits the bytes
+    reserved by this workspace and global_quota the bytes reserved by all
+    workspaces in this process. Either may be 0 for no limit.
+    """
+
+    def __init__(self, quota=0, global_quota=0, base_dir=None):
+        self.quota = quota
+        self.global_quota = global_quota
+        self.base_dir = base_dir
+        self.reserved = 0
+        self._path = None
+
+    @property
+    def path(self):
+        if self._path is None:
+            self._path = tempfile.mkdtemp('-mapactionzip', dir=self.base_dir)
+
+        return self._path
+
+    def reserve(self, nbytes):
+        global _bytes_in_flight
+
+        if self.quota and self.reserved + nbytes > self.quota:
+            raise WorkspaceQuotaExceeded(
+                _('Map package is too large to import ({0} bytes, '
+                  'limit is {1} bytes)').format(
+                      self.reserved + nbytes, self.quota))
+
+        with _lock:
+            if (self.global_quota and
+                    _bytes_in_flight + nbytes > self.global_quota):
+                raise WorkspaceQuotaExceeded(
+                    _('Not enough space to import the map package, '
+                      'please try again later'))
+
+            _bytes_in_flight += nbytes
+
+        self.reserved += nbytes
+
+    def cleanup(self):
+        global _bytes_in_flight
+
+        if self._path is not None:
+            shutil.rmtree(self._path, ignore_errors=True)
+            self._path = None
+
+        with _lock:
+            _bytes_in_flight -= self.reserved
+
+        if self.reserved:
+            log.debug('Released {0} bytes of import workspace, '
+                      '{1} bytes still in flight'.format(
+                          self.reserved, _bytes_in_flight))
+
+        self.reserved = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.cleanup()
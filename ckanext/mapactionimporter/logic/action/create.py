@@ -1,12 +1,29 @@
-import os
 import cgi
+import logging
+import mimetypes
+import os
+import time
 import uuid
+from contextlib import closing
 
 from ckan.common import _
+import ckan.lib.uploader as uploader
 import ckan.logic as logic
 import ckan.plugins.toolkit as toolkit
 
-from ckanext.mapactionimporter.lib import mappackage
+from ckanext.mapactionimporter.lib import (
+    blobstore,
+    idempotency,
+    journal,
+    mappackage,
+    metrics,
+    previews,
+    themes,
+    workers,
+    workspace,
+)
+
+log = logging.getLogger(__name__)
 
 
 def create_dataset_from_zip(context, data_dict):
@@ -15,60 +32,412 @@ def create_dataset_from_zip(context, data_dict):
         msg = {'upload': [_('You must select a file to be imported')]}
         raise toolkit.ValidationError(msg)
 
+    # Each stage reported with _report_progress is timed, and the import
+    # is logged and passed to the metrics sink when it ends
+    import_metrics = context['metrics'] = metrics.ImportMetrics()
+    import_metrics.annotate(
+        filename=getattr(upload, 'filename', None), user=context.get('user'))
+    outcome = 'error'
     try:
-        dataset_info = mappackage.to_dataset(upload.file)
+        dataset = _create_dataset_from_zip(context, data_dict, upload)
+        outcome = 'success'
+        return dataset
+    except toolkit.ValidationError:
+        outcome = 'invalid'
+        raise
+    finally:
+        del context['metrics']
+        metrics.record_import(import_metrics.finish(outcome))
+
+
+def _create_dataset_from_zip(context, data_dict, upload):
+    with _get_workspace() as import_workspace:
+        _report_progress(context, 'read_metadata')
+        try:
+            dataset_info = mappackage.read_metadata(
+                upload.file, **_package_limits())
+        except (mappackage.MapPackageException) as e:
+            msg = {'upload': [e.args[0]]}
+            raise toolkit.ValidationError(msg)
+        context['metrics'].annotate(dataset=dataset_info['name'])
+
+        # A retried upload of the same archive waits for the original
+        # import if it is still in flight, then returns its dataset
+        _report_progress(context, 'archive_sha256')
+        sha256 = idempotency.archive_sha256(upload.file)
+        context['metrics'].observe('archive_sha256', calls=0,
+                                   bytes=_file_size(upload.file))
+        try:
+            with idempotency.claim(idempotency.import_key(sha256, dataset_info),
+                                   _claim_wait(context)) as import_claim:
+                context['claim'] = import_claim
+                try:
+                    return _import_claimed(context, data_dict, dataset_info,
+                                           sha256, import_workspace)
+                finally:
+                    del context['claim']
+        except idempotency.ImportInProgress:
+            msg = {'upload': [_('This package is already being imported. '
+                                'Try again once that import has finished.')]}
+            raise toolkit.ValidationError(msg)
+
+
+def _import_claimed(context, data_dict, dataset_info, sha256,
+                    import_workspace):
+    old_dataset = _get_dataset(context, dataset_info['name'])
+    if (old_dataset is not None and
+            idempotency.imported_from(old_dataset, sha256)):
+        context['metrics'].annotate(retry=True)
+        return old_dataset
+
+    dataset_info['dataset_dict']['extras'].append(
+        {'key': idempotency.ARCHIVE_SHA256_KEY, 'value': sha256})
+
+    return _import_dataset(context, data_dict, dataset_info, old_dataset,
+                           import_workspace)
+
+
+def create_datasets_from_zips(context, data_dict):
+    """ Import a batch of map packages
+
+    Each package is imported as by create_dataset_from_zip, in the order
+    given, but each event is looked up, and the user's access to it
+    checked, once for the whole batch rather than once per package.
+    Returns the result for each package, and a package that fails doesn't
+    stop the rest of the batch. A result_callback in the context is also
+    called with each result as soon as it is known.
+    """
+    uploads = toolkit.get_or_bust(data_dict, 'uploads')
+    package_data = dict((k, v) for k, v in data_dict.items()
+                        if k != 'uploads')
+
+    package_context = _get_context(context)
+    if 'claim_wait' in context:
+        package_context['claim_wait'] = context['claim_wait']
+    package_context['events'] = {}
+    package_context['access_checked'] = set()
+
+    results = []
+    for upload in uploads:
+        result = {
+            'filename': getattr(upload, 'filename', None),
+            'success': False,
+            'name': None,
+            'errors': None,
+        }
+        start = time.time()
+        try:
+            dataset = toolkit.get_action('create_dataset_from_mapaction_zip')(
+                dict(package_context), dict(package_data, upload=upload))
+            result.update(success=True, name=dataset['name'])
+        except toolkit.ValidationError as e:
+            result['errors'] = e.error_summary
+        except toolkit.NotAuthorized as e:
+            result['errors'] = {
+                _('Authorization'): e.args[0] if e.args else _('Not authorized')}
+        except Exception as e:
+            log.exception('Unable to import {0}'.format(result['filename']))
+            result['errors'] = {_('Error'): repr(e)}
+        result['seconds'] = time.time() - start
+        results.append(result)
+
+        result_callback = context.get('result_callback')
+        if result_callback is not None:
+            result_callback(result)
+
+    imported = len([r for r in results if r['success']])
+    return {
+        'results': results,
+        'imported': imported,
+        'failed': len(results) - imported,
+    }
+
+
+def validate_zips(context, data_dict):
+    """ Check that a batch of map packages could be imported
+
+    Runs the checks made by create_dataset_from_zip on each package's
+    metadata, and whether its dataset and event exist, without reading
+    its other files or writing anything. Returns a report with the
+    results for each package, in the order given.
+    """
+    uploads = toolkit.get_or_bust(data_dict, 'uploads')
+    toolkit.check_access('validate_mapaction_zips', context, data_dict)
+
+    # Callers may ask for fewer workers than configured, but not more
+    width = toolkit.asint(toolkit.config.get(
+        'ckanext.mapactionimporter.validate_workers', 4))
+    if 'workers' in data_dict:
+        try:
+            workers_wanted = int(data_dict['workers'])
+        except (TypeError, ValueError):
+            workers_wanted = 0
+        if workers_wanted < 1:
+            raise toolkit.ValidationError(
+                {'workers': [_('Must be a positive integer')]})
+        width = min(width, workers_wanted)
+    # Events are looked up once for the whole batch
+    context = dict(context, events={})
+    tasks = [(context, upload) for upload in uploads]
+
+    if min(width, len(tasks)) <= 1:
+        results = [_validate_zip(task) for task in tasks]
+    else:
+        pool = workers.pool(min(width, len(tasks)))
+        try:
+            results = pool.map(_validate_zip_in_worker, tasks)
+        finally:
+            pool.close()
+            pool.join()
+
+    names = {}
+    for result in results:
+        if result['name'] is not None:
+            names.setdefault(result['name'], []).append(result)
+    for name, duplicates in names.items():
+        if len(duplicates) > 1:
+            for result in duplicates:
+                result['errors'].append(
+                    _("More than one package in the batch is for dataset '{0}'").format(name))
+
+    for result in results:
+        result['valid'] = not result['errors']
+
+    valid = len([r for r in results if r['valid']])
+    return {
+        'results': results,
+        'valid': valid,
+        'invalid': len(results) - valid,
+    }
+
+
+def _validate_zip(task):
+    context, upload = task
+    result = {
+        'filename': getattr(upload, 'filename', None),
+        'name': None,
+        'status': None,
+        'errors': [],
+        'warnings': [],
+    }
+
+    try:
+        if not _upload_attribute_is_valid(upload):
+            raise mappackage.MapPackageException(
+                _('You must select a file to be imported'))
+
+        dataset_info = mappackage.read_metadata(
+            upload.file, **_package_limits())
+        result['name'] = dataset_info['name']
+        result['status'] = dataset_info['status']
+
+        for theme in dataset_info['themes']:
+            if themes.lookup(theme) is None:
+                result['warnings'].append(
+                    _("Product theme '{0}' is not known and will be ignored").format(theme))
+
+        old_dataset = _get_dataset(context, dataset_info['name'])
+        _check_status(dataset_info, old_dataset)
+
+        if old_dataset is None:
+            _check_event_exists(context, dataset_info)
+    except mappackage.MapPackageException as e:
+        result['errors'].append(e.args[0])
+    except toolkit.ValidationError as e:
+        result['errors'].extend(e.error_dict['upload'])
+    except toolkit.NotAuthorized:
+        result['errors'].append(
+            _("Not authorized to read dataset '{0}'").format(result['name']))
+
+    return result
+
+
+def _validate_zip_in_worker(task):
+    context = task[0]
+    try:
+        return _validate_zip(task)
+    finally:
+        context['model'].Session.remove()
+
+
+def _import_dataset(context, data_dict, dataset_info, old_dataset,
+                    import_workspace):
+    # Reject the package before reading any of its files if it cannot
+    # be imported
+    _check_status(dataset_info, old_dataset)
+    if old_dataset is None:
+        _check_event_exists(context, dataset_info)
+
+    _report_progress(context, 'read_members')
+    try:
+        dataset_info['members'] = mappackage.read_members(
+            dataset_info,
+            workspace=None if _stream_uploads() else import_workspace)
     except (mappackage.MapPackageException) as e:
         msg = {'upload': [e.args[0]]}
         raise toolkit.ValidationError(msg)
-
+    if not _stream_uploads():
+        context['metrics'].observe(
+            'read_members', calls=0,
+            bytes=sum(m.size for m in dataset_info['members']))
+
+    if _make_previews():
+        _report_progress(context, 'previews')
+        dataset_info['members'] += _generate_previews(
+            dataset_info['members'], context.get('metrics'))
+
+    # Each side effect from here on is journaled, and undone if the import
+    # fails, or by "paster mapactionimporter recover" if it dies
+    with journal.unit_of_work(dataset_info['name'],
+                              context.get('user')) as import_journal:
+        context['journal'] = import_journal
+        try:
+            if old_dataset is not None:
+                return _update_dataset(context, old_dataset, dataset_info)
+
+            return _create_dataset(context, data_dict, dataset_info)
+        finally:
+            del context['journal']
+
+
+def _get_dataset(context, name):
     try:
-        old_dataset = toolkit.get_action('package_show')(
-            _get_context(context), {'id': dataset_info['name']})
+        return toolkit.get_action('package_show')(
+            _get_context(context), {'id': name})
+    except logic.NotFound:
+        return None
 
-        if dataset_info['status'] in ('New', 'Update'):
-            msg = {'upload': [_("Status is '{status}' but dataset '{name}' already exists").format(
-                status=dataset_info['status'], name=dataset_info['name'])]}
-            raise toolkit.ValidationError(msg)
 
-        return _update_dataset(context, old_dataset, dataset_info)
+def _dataset_exists(context, name):
+    try:
+        return _get_dataset(context, name) is not None
+    except toolkit.NotAuthorized:
+        return True
+
 
-    except logic.NotFound:
+def _check_status(dataset_info, old_dataset):
+    if old_dataset is None:
         if dataset_info['status'] == 'Correction':
             msg = {'upload': [_("Status is '{status}' but dataset '{name}' does not exist").format(
                 status=dataset_info['status'], name=dataset_info['name'])]}
             raise toolkit.ValidationError(msg)
+    elif dataset_info['status'] in ('New', 'Update'):
+        msg = {'upload': [_("Status is '{status}' but dataset '{name}' already exists").format(
+            status=dataset_info['status'], name=dataset_info['name'])]}
+        raise toolkit.ValidationError(msg)
 
-        return _create_dataset(context, data_dict, dataset_info)
 
+def _check_event_exists(context, dataset_info):
+    operation_id = _get_operation_id(dataset_info)
+
+    # Batches pass a dictionary in which each event is looked up once
+    events = context.get('events')
+    if events is not None and operation_id in events:
+        exists = events[operation_id]
+    else:
+        exists = _event_exists(context, operation_id)
+        if events is not None:
+            events[operation_id] = exists
+
+    if not exists:
+        msg = {'upload': [
+            _("Event with operationID '{0}' does not exist").format(
+                operation_id)]}
+        raise toolkit.ValidationError(msg)
 
-def _update_dataset(context, dataset_dict, dataset_info):
-    old_resource_ids = [r['id'] for r in dataset_dict.pop('resources')]
 
+def _event_exists(context, operation_id):
+    # Only whether the event exists is needed, so its datasets, users and
+    # so on are left out, which would otherwise be a search per lookup
     try:
-        _create_resources(context, dataset_dict, dataset_info['file_paths'])
-    except Exception as e:
-        # Resource creation failed, rollback
-        dataset_dict = toolkit.get_action('package_show')(
-            _get_context(context), {'id': dataset_dict['id']})
-        for resource in dataset_dict['resources']:
-            if resource['id'] not in old_resource_ids:
-                toolkit.get_action('resource_delete')(
-                    _get_context(context), {'id': resource['id']})
-        raise e
+        toolkit.get_action('group_show')(
+            _get_context(context),
+            data_dict={
+                'type': 'event',
+                'id': operation_id,
+                'include_datasets': False,
+                'include_extras': False,
+                'include_users': False,
+                'include_groups': False,
+                'include_tags': False,
+                'include_followers': False,
+            })
+    except logic.NotFound:
+        return False
+
+    return True
 
-    for resource_id in old_resource_ids:
-        toolkit.get_action('resource_delete')(
-            _get_context(context), {'id': resource_id})
 
-    dataset_dict = toolkit.get_action('package_show')(
-        _get_context(context), {'id': dataset_dict['id']})
+def _get_operation_id(dataset_info):
+    return dataset_info['operation_id'].zfill(5)
 
+
+def _update_dataset(context, dataset_dict, dataset_info):
+    # Resources whose files are unchanged are kept, so only new or changed
+    # files are uploaded. The dataset is then updated in one write, which
+    # also removes resources that are no longer in the package.
+    # Checked before any files are stored, as package_update would only
+    # refuse once they all had been
+    toolkit.check_access('package_update', _get_context(context),
+                         {'id': dataset_dict['id']})
+
+    old_resources = dict((r['name'], r) for r in dataset_dict['resources'])
+
+    resources = []
+    changed = []
+    for member in dataset_info['members']:
+        old_resource = old_resources.get(member.name)
+        if old_resource is not None and _is_unchanged(old_resource, member):
+            resources.append(old_resource)
+        else:
+            changed.append(len(resources))
+            resources.append(member)
+
+    _report_progress(context, 'resource_upload')
+    uploaded = _upload_resource_files(
+        [resources[i] for i in changed], context.get('metrics'),
+        context['journal'], context.get('claim'))
+    for i, resource in zip(changed, uploaded):
+        resources[i] = resource
+
+    # Restored only if the dataset still carries this import's archive
+    context['journal'].record(
+        'package_updated', dataset=dataset_dict,
+        sha256=_extra_value(dataset_info['dataset_dict'],
+                            idempotency.ARCHIVE_SHA256_KEY))
     dataset_dict.update(dataset_info['dataset_dict'])
+    dataset_dict['resources'] = resources
 
+    _report_progress(context, 'package_update')
     return toolkit.get_action('package_update')(
         _get_context(context), dataset_dict)
 
 
+def _is_unchanged(resource, member):
+    if (resource.get('zip_crc') != _format_crc(member.crc) or
+            str(resource.get('size')) != str(member.size)):
+        return False
+
+    if _compare_sha256() and resource.get('sha256'):
+        return resource['sha256'] == _member_sha256(member)
+
+    return True
+
+
+def _member_sha256(member):
+    # Known without reading the member again if it has been read through,
+    # as it is when extracted or uploaded
+    if member.sha256 is not None:
+        return member.sha256
+
+    with closing(member.open()) as the_file:
+        return mappackage.file_sha256(the_file)
+
+
+def _format_crc(crc):
+    return '{0:08x}'.format(crc)
+
+
 def _create_dataset(context, data_dict, dataset_info):
     private = data_dict.get('private', True)
 
@@ -83,57 +452,58 @@ def _create_dataset(context, data_dict, dataset_info):
 
     update_dict['private'] = private
 
-    operation_id = dataset_info['operation_id'].zfill(5)
-
-    try:
-        toolkit.get_action('group_show')(
-            _get_context(context),
-            data_dict={'type': 'event', 'id': operation_id})
-    except (logic.NotFound) as e:
-        msg = {'upload': [
-            _("Event with operationID '{0}' does not exist").format(
-                operation_id)]}
-        raise toolkit.ValidationError(msg)
+    operation_id = _get_operation_id(dataset_info)
 
-    # TODO:
-    # If we do this, we get an error "User foo not authorized to edit these groups
-    # update_dict['groups'] = [{'name': operation_id]
-
-    final_name = update_dict['name']
-    update_dict['name'] = '{0}-{1}'.format(final_name, uuid.uuid4())
-    dataset = toolkit.get_action('package_create')(
-        _get_context(context), update_dict)
-
-    try:
-        _create_resources(context, dataset, dataset_info['file_paths'])
-    except:
-        toolkit.get_action('package_delete')(_get_context(context),
-                                             {'id': dataset['id']})
-        raise
-
-    toolkit.get_action('member_create')(_get_context(context), {
+    create_context = _get_context(context)
+    member_dict = {
         'id': operation_id,
-        'object': dataset['id'],
         'object_type': 'package',
         'capacity': 'member',  # TODO: What does capacity mean in this context?
-    })
-
-    update_dict = toolkit.get_action('package_show')(
-        context, {'id': dataset['id']})
-    update_dict['name'] = final_name
+    }
+    _check_create_access(context, create_context, update_dict, member_dict)
+    create_context['ignore_auth'] = True
+
+    # The dataset is created complete, with its resources and event, in a
+    # single package write. Its files are stored first so that nothing is
+    # created if any of them fail.
+    _report_progress(context, 'resource_upload')
+    update_dict['resources'] = _upload_resource_files(
+        dataset_info['members'], context.get('metrics'), context['journal'],
+        context.get('claim'))
+    update_dict['groups'] = [{'name': operation_id}]
 
+    final_name = update_dict['name']
+    context['journal'].record(
+        'package_created', name=final_name,
+        sha256=_extra_value(update_dict, idempotency.ARCHIVE_SHA256_KEY))
+    _report_progress(context, 'package_create')
     try:
-        dataset = toolkit.get_action('package_update')(
-            _get_context(context), update_dict)
+        dataset = toolkit.get_action('package_create')(
+            create_context, update_dict)
     except toolkit.ValidationError as e:
         if _('That URL is already in use.') in e.error_dict.get('name', []):
             e.error_dict['name'] = [_('"%s" already exists.' % final_name)]
         raise e
 
+    if operation_id not in [g['name'] for g in dataset.get('groups', [])]:
+        # package_create only adds groups the user belongs to, which isn't
+        # the case for callers that ignore auth
+        _report_progress(context, 'member_create')
+        member_dict['object'] = dataset['id']
+        context['journal'].record('member_created', group=operation_id,
+                                  dataset=dataset['id'])
+        toolkit.get_action('member_create')(_get_context(context), member_dict)
+
     # TODO: Is there a neater way so we don't have to reverse engineer the
     # base name?
     base_name = '-'.join(final_name.split('-')[0:-1])
 
+    _report_progress(context, 'dataset_version_create')
+    # dataset_version_create creates the parent dataset that groups the
+    # versions if there isn't one yet, which is then undone with the link
+    context['journal'].record(
+        'version_linked', dataset=dataset['name'], parent=base_name,
+        parent_created=not _dataset_exists(context, base_name))
     toolkit.get_action('dataset_version_create')(
         _get_context(context), {
             'id': dataset['id'],
@@ -145,14 +515,169 @@ def _create_dataset(context, data_dict, dataset_info):
     return dataset
 
 
-def _create_resources(context, dataset, file_paths):
-    for resource_file in file_paths:
-        resource = {
-            'package_id': dataset['id'],
-            'path': resource_file,
-        }
-        _create_and_upload_local_resource(
-            _get_context(context), resource)
+def _check_create_access(context, create_context, dataset_dict, member_dict):
+    # Batches pass a set of the organizations and events the user is known
+    # to be able to add datasets to, which is all the checks depend on
+    access_checked = context.get('access_checked')
+    key = (dataset_dict.get('owner_org'), member_dict['id'])
+    if access_checked is not None and key in access_checked:
+        return
+
+    toolkit.check_access('package_create', create_context, dataset_dict)
+
+    # package_create only lets users who can edit a group add datasets to
+    # it, whereas members of the event can add datasets with member_create,
+    # so check that instead
+    toolkit.check_access('member_create', create_context, member_dict)
+
+    if access_checked is not None:
+        access_checked.add(key)
+
+
+def _upload_resource_files(members, import_metrics=None, import_journal=None,
+                           import_claim=None):
+    def upload(member):
+        start = time.time()
+        resource = _upload_resource_file(member, import_journal)
+        if import_metrics is not None:
+            import_metrics.observe('resource_file', time.time() - start,
+                                   bytes=member.size)
+        # Storing the files can take longer than the claim timeout
+        if import_claim is not None:
+            import_claim.refresh()
+        return resource
+
+    width = min(_upload_workers(), len(members))
+    try:
+        if width <= 1:
+            return [upload(m) for m in members]
+
+        pool = workers.pool(width)
+        try:
+            return pool.map(upload, members)
+        finally:
+            pool.close()
+            pool.join()
+    except mappackage.MapPackageException as e:
+        # A member that turned out not to match the central directory
+        raise toolkit.ValidationError({'upload': [e.args[0]]})
+
+
+def _generate_previews(members, import_metrics=None):
+    """ Return preview images of the members, to add as resources """
+    def generate(member):
+        start = time.time()
+        member_previews = previews.make_previews(
+            member, _preview_sizes(), _preview_max_pixels())
+        if import_metrics is not None:
+            import_metrics.observe('preview', time.time() - start,
+                                   bytes=member.size)
+        return member_previews
+
+    sources = previews.preview_sources(members)
+    width = min(_preview_workers(), len(sources))
+    if width <= 1:
+        results = [generate(m) for m in sources]
+    else:
+        # Pillow releases the GIL while decoding and resizing
+        pool = workers.pool(width)
+        try:
+            results = pool.map(generate, sources)
+        finally:
+            pool.close()
+            pool.join()
+
+    return [p for member_previews in results for p in member_previews]
+
+
+def _upload_resource_file(member, import_journal=None):
+    """ Write a map package file to resource storage
+
+    Returns the resource's dictionary. Its id is assigned here so that the
+    file can be stored before the resource exists. The file is recorded
+    in import_journal, where it is in local storage.
+    """
+    resource = {
+        'id': str(uuid.uuid4()),
+        'name': member.name,
+        # CKAN only guesses the format of resources without an id
+        'format': _guess_format(member.name),
+        # Used to find unchanged files when the dataset is corrected, and
+        # with sha256 to check downloads
+        'size': member.size,
+        'zip_crc': _format_crc(member.crc),
+    }
+    derived_from = getattr(member, 'derived_from', None)
+    if derived_from is not None:
+        # A preview made by the importer
+        resource['derived_from'] = derived_from
+
+    with closing(member.open()) as the_file:
+        resource['upload'] = _UploadLocalFileStorage(the_file, member.name)
+        upload = uploader.get_resource_uploader(resource)
+        max_size = uploader.get_max_resource_size()
+
+        if import_journal is not None and hasattr(upload, 'get_path'):
+            import_journal.record('file', path=upload.get_path(resource['id']))
+
+        store = _get_blob_store(upload)
+        if store is None:
+            upload.upload(resource['id'], max_size)
+        else:
+            _upload_to_blob_store(store, upload, resource, member, max_size)
+
+    # Worked out as the file was uploaded, where it was read from the zip
+    resource['sha256'] = _member_sha256(member)
+
+    return resource
+
+
+def _upload_to_blob_store(store, upload, resource, member, max_size):
+    path = upload.get_path(resource['id'])
+
+    candidates = store.find(member.crc, member.size)
+    if candidates:
+        member_sha256 = _member_sha256(member)
+        for blob, sha256 in candidates:
+            if sha256 == member_sha256:
+                if member.size > max_size * 1024 * 1024:
+                    raise toolkit.ValidationError(
+                        {'upload': ['File upload too large']})
+
+                store.link(blob, path)
+                return
+
+    upload.upload(resource['id'], max_size)
+
+    store.add(path, member.crc, member.size, _member_sha256(member))
+
+
+def _get_blob_store(upload):
+    # Only CKAN's own local file storage can be deduplicated
+    if not toolkit.asbool(toolkit.config.get(
+            'ckanext.mapactionimporter.deduplicate_uploads', False)):
+        return None
+
+    if type(upload) is not uploader.ResourceUpload or not upload.storage_path:
+        return None
+
+    return blobstore.default_blob_store()
+
+
+def _extra_value(dataset_dict, key):
+    for extra in dataset_dict.get('extras', []):
+        if extra['key'] == key:
+            return extra['value']
+
+
+def _guess_format(filename):
+    mimetype, encoding = mimetypes.guess_type(filename)
+    if mimetype:
+        extension = mimetypes.guess_extension(mimetype)
+        if extension:
+            return extension[1:]
+
+    return ''
 
 
 def _get_context(context):
@@ -164,27 +689,133 @@ def _get_context(context):
     }
 
 
+def _report_progress(context, stage):
+    # Asynchronous imports pass a callback to record the stage reached
+    progress = context.get('progress')
+    if progress is not None:
+        progress(stage)
+
+    import_metrics = context.get('metrics')
+    if import_metrics is not None:
+        import_metrics.start_stage(stage)
+
+    import_claim = context.get('claim')
+    if import_claim is not None:
+        import_claim.refresh()
+
+
+def _file_size(fp):
+    position = fp.tell()
+    fp.seek(0, os.SEEK_END)
+    size = fp.tell()
+    fp.seek(position)
+
+    return size
+
+
 def _upload_attribute_is_valid(upload):
     return hasattr(upload, 'file') and hasattr(upload.file, 'read')
 
 
-def _create_and_upload_local_resource(context, resource):
-    path = resource['path']
-    del resource['path']
-    with open(path, 'r') as the_file:
-        _create_and_upload_resource(context, resource, the_file)
+def _get_workspace():
+    config = toolkit.config
+    return workspace.ImportWorkspace(
+        quota=toolkit.asint(
+            config.get('ckanext.mapactionimporter.import_quota', 0)),
+        global_quota=toolkit.asint(
+            config.get('ckanext.mapactionimporter.global_quota', 0)),
+        base_dir=config.get('ckanext.mapactionimporter.workspace_dir'))
+
+
+def _package_limits():
+    config = toolkit.config
+    return {
+        'max_bytes': toolkit.asint(config.get(
+            'ckanext.mapactionimporter.metadata_max_bytes',
+            mappackage.MAX_METADATA_BYTES)),
+        'max_elements': toolkit.asint(config.get(
+            'ckanext.mapactionimporter.metadata_max_elements',
+            mappackage.MAX_METADATA_ELEMENTS)),
+        'max_depth': toolkit.asint(config.get(
+            'ckanext.mapactionimporter.metadata_max_depth',
+            mappackage.MAX_METADATA_DEPTH)),
+        'max_entries': toolkit.asint(config.get(
+            'ckanext.mapactionimporter.max_entries',
+            mappackage.MAX_ENTRIES)),
+        'max_total_size': toolkit.asint(config.get(
+            'ckanext.mapactionimporter.max_total_size',
+            mappackage.MAX_TOTAL_SIZE)),
+        'max_member_size': toolkit.asint(config.get(
+            'ckanext.mapactionimporter.max_member_size',
+            mappackage.MAX_MEMBER_SIZE)),
+        'max_compression_ratio': toolkit.asint(config.get(
+            'ckanext.mapactionimporter.max_compression_ratio',
+            mappackage.MAX_COMPRESSION_RATIO)),
+        'allow_nested_archives': toolkit.asbool(config.get(
+            'ckanext.mapactionimporter.allow_nested_archives', False)),
+    }
+
+
+def _claim_wait(context):
+    # Seconds to wait for an import of the same package that is already in
+    # flight. Background imports pass None in the context to wait for as
+    # long as it takes, but web requests shouldn't be held up for long.
+    if 'claim_wait' in context:
+        return context['claim_wait']
+
+    return toolkit.asint(toolkit.config.get(
+        'ckanext.mapactionimporter.import_claim_wait', 30))
+
+
+def _stream_uploads():
+    return toolkit.asbool(
+        toolkit.config.get('ckanext.mapactionimporter.stream_uploads', True))
+
+
+def _compare_sha256():
+    return toolkit.asbool(
+        toolkit.config.get('ckanext.mapactionimporter.compare_sha256', False))
+
+
+def _upload_workers():
+    return toolkit.asint(
+        toolkit.config.get('ckanext.mapactionimporter.upload_workers', 1))
+
+
+def _make_previews():
+    if not toolkit.asbool(toolkit.config.get(
+            'ckanext.mapactionimporter.previews', False)):
+        return False
+
+    if not previews.available():
+        log.warning('Previews are turned on but Pillow is not installed')
+        return False
+
+    return True
+
+
+def _preview_sizes():
+    sizes = toolkit.config.get('ckanext.mapactionimporter.preview_sizes')
+    if not sizes:
+        return previews.PREVIEW_SIZES
+
+    return [int(size) for size in sizes.split()]
+
+
+def _preview_max_pixels():
+    return toolkit.asint(toolkit.config.get(
+        'ckanext.mapactionimporter.preview_max_pixels', previews.MAX_PIXELS))
 
 
-def _create_and_upload_resource(context, resource, the_file):
-    resource['url'] = 'url'
-    resource['url_type'] = 'upload'
-    resource['upload'] = _UploadLocalFileStorage(the_file)
-    resource['name'] = os.path.basename(the_file.name)
-    toolkit.get_action('resource_create')(context, resource)
+def _preview_workers():
+    return toolkit.asint(
+        toolkit.config.get('ckanext.mapactionimporter.preview_workers', 2))
 
 
 class _UploadLocalFileStorage(cgi.FieldStorage):
-    def __init__(self, fp, *args, **kwargs):
-        self.name = fp.name
-        self.filename = fp.name
+    # Named after the member rather than the file object, which for
+    # previews is a StringIO with no name
+    def __init__(self, fp, name, *args, **kwargs):
+        self.name = name
+        self.filename = name
         self.file = fp
@@ -0,0 +1,25 @@
+from ckan.common import _
+import ckan.plugins.toolkit as toolkit
+
+from ckanext.mapactionimporter.lib import jobs
+
+
+def import_status(context, data_dict):
+    job_id = toolkit.get_or_bust(data_dict, 'id')
+
+    job = jobs.get_job(job_id)
+    if job is None:
+        raise toolkit.ObjectNotFound(_('Import job not found'))
+
+    toolkit.check_access('mapaction_import_status', context, job)
+
+    return {
+        'id': job['id'],
+        'filename': job['filename'],
+        'status': job['status'],
+        'stage': job['stage'],
+        'dataset': job['dataset'],
+        'error': job['error'],
+        'created': job['created'],
+        'updated': job['updated'],
+    }
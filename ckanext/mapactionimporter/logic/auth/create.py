@@ -0,0 +1,11 @@
+import ckan.plugins.toolkit as toolkit
+
+
+def validate_zips(context, data_dict):
+    # Anyone who can import map packages can check them first
+    try:
+        toolkit.check_access('package_create', context)
+    except toolkit.NotAuthorized:
+        return {'success': False}
+
+    return {'success': True}
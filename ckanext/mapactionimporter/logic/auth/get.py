@@ -0,0 +1,3 @@
+def import_status(context, data_dict):
+    # Only the user who started the import (or a sysadmin) can follow it
+    return {'success': data_dict.get('user') == context.get('user')}
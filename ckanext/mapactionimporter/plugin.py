@@ -1,54 +1,39 @@
+import ckan.logic.action.create
+import ckan.logic.action.delete
 import ckan.plugins as plugins
 import ckan.plugins.toolkit as toolkit
 import ckanext.mapactionimporter.logic.action.create
+import ckanext.mapactionimporter.logic.action.get
+import ckanext.mapactionimporter.logic.auth.create
+import ckanext.mapactionimporter.logic.auth.get
+
+from .lib import themes
+from .lib.cache import TTLCache
+from .lib.themes import PRODUCT_THEMES
+from .lib.workers import register_translator  # noqa
+
+# The product themes vocabulary only changes when create_product_themes
+# runs, so templates share a cached copy
+_product_themes_cache = TTLCache(300)
 
-from collections import OrderedDict
-from .lib.mappackage import PRODUCT_THEMES
-
-def register_translator():
-    # https://github.com/ckan/ckanext-archiver/blob/master/ckanext/archiver/bin/common.py
-    # If not set (in cli access), patch the a translator with a mock, so the
-    # _() functions in logic layer don't cause failure.
-    from paste.registry import Registry
-    from pylons import translator
-    from ckan.lib.cli import MockTranslator
-    if 'registery' not in globals():
-        global registry
-        registry = Registry()
-        registry.prepare()
-
-    if 'translator_obj' not in globals():
-        global translator_obj
-        translator_obj = MockTranslator()
-        registry.register(translator, translator_obj)
 
 def create_product_themes():
-    register_translator()
+    """ Synchronise the product themes vocabulary with PRODUCT_THEMES
 
-    user = toolkit.get_action('get_site_user')({'ignore_auth': True}, {})
-    context = {'user': user['name']}
+    Returns the changes made, as reported by themes.sync_vocabulary().
+    """
     try:
-        data = {'id': 'product_themes'}
-        vocab = toolkit.get_action('vocabulary_show')(context, data)
-        tags = toolkit.get_action('tag_list')(context, {'vocabulary_id': vocab['id']})
-        for tag in PRODUCT_THEMES:
-            if tag in tags:
-                tags.remove(tag)
-            else:
-                data = {'name': tag, 'vocabulary_id': vocab['id'], 'display_name': "Foo"}
-                toolkit.get_action('tag_create')(context, data)
-        for tag in tags:
-            data = {'name': tag, 'vocabulary_id': vocab['id']}
-            toolkit.get_action('tag_delete')(context, data)
-    except toolkit.ObjectNotFound:
-        data = {'name': 'product_themes'}
-        vocab = toolkit.get_action('vocabulary_create')(context, data)
-        for tag in PRODUCT_THEMES:
-            data = {'name': tag, 'vocabulary_id': vocab['id']}
-            toolkit.get_action('tag_create')(context, data)
+        return themes.sync_vocabulary(PRODUCT_THEMES)
+    finally:
+        _product_themes_cache.invalidate()
 
 
 def product_themes(query=None):
+    return _product_themes_cache.get(
+        query, lambda: _fetch_product_themes(query))
+
+
+def _fetch_product_themes(query):
     try:
         tag_list = toolkit.get_action('tag_list')
         product_themes = tag_list(
@@ -62,51 +47,65 @@ def product_themes(query=None):
         return []
 
 
+THEMES_FACET = 'vocab_product_themes'
+
+def _add_themes_facet(facets_dict, after=None):
+    facets = facets_dict.items()
+    keys = facets_dict.keys()
+    position = keys.index(after) + 1 if after in facets_dict else 0
+
+    # The label is translated for each request, into its language
+    facets.insert(position, (THEMES_FACET, toolkit._('Themes')))
+
+    # Python 2's OrderedDict is quicker to refill than to reorder
+    facets_dict.clear()
+    for key, label in facets:
+        facets_dict[key] = label
+
+    return facets_dict
+
+
+def _invalidates_product_themes(action):
+    def wrapper(context, data_dict):
+        try:
+            return action(context, data_dict)
+        finally:
+            _product_themes_cache.invalidate()
+
+    wrapper.__name__ = action.__name__
+    wrapper.__doc__ = action.__doc__
+    return wrapper
+
+
 class MapactionimporterPlugin(plugins.SingletonPlugin, toolkit.DefaultDatasetForm):
     plugins.implements(plugins.IDatasetForm)
     plugins.implements(plugins.IActions)
+    plugins.implements(plugins.IAuthFunctions)
     plugins.implements(plugins.IConfigurer)
+    plugins.implements(plugins.IConfigurable)
     plugins.implements(plugins.IRoutes, inherit=True)
     plugins.implements(plugins.IFacets, inherit=True)
     plugins.implements(plugins.ITemplateHelpers)
 
     # IFacets
     def dataset_facets(self, facets_dict, package_type):
-        #insert the Theme facet after Groups if it's there.
-        facets = facets_dict.items()
-        keys = facets_dict.keys()
-        facets_dict.clear()
-
-        position = 0 #default to the start.
-
-        if 'groups' in keys:
-            position = keys.index('groups') + 1
-
-        facets.insert(position, ('vocab_product_themes', plugins.toolkit._('Themes')))
-
-        for item in facets:
-            facets_dict[item[0]] = item[1]
-
-        return facets_dict
-
+        # Insert the Theme facet after Groups if it's there, otherwise at
+        # the start
+        return _add_themes_facet(facets_dict, after='groups')
 
     def group_facets(self, facets_dict, group_type, package_type):
-        #insert the Theme facet at the beginning
-        facets = facets_dict.items()
-        facets_dict.clear()
-
-        facets_dict['vocab_product_themes'] = plugins.toolkit._('Themes')
-        for item in facets:
-            facets_dict[item[0]] = item[1]
-
-        return facets_dict
-
+        # Insert the Theme facet at the beginning
+        return _add_themes_facet(facets_dict)
 
     def update_config(self, config_):
         toolkit.add_template_directory(config_, 'templates')
         toolkit.add_public_directory(config_, 'public')
         toolkit.add_resource('fanstatic', 'mapactionimporter')
 
+    def configure(self, config_):
+        _product_themes_cache.ttl = toolkit.asint(config_.get(
+            'ckanext.mapactionimporter.product_themes_cache_ttl', 300))
+
     def before_map(self, map_):
         map_.connect(
             'import_mapactionzip_form',
@@ -122,6 +121,41 @@ class MapactionimporterPlugin(plugins.SingletonPlugin, toolkit.DefaultDatasetFor
             action='import_dataset',
             conditions=dict(method=['POST']),
         )
+        map_.connect(
+            'import_mapactionzip_status',
+            '/import_mapactionzip/status/{id}',
+            controller='ckanext.mapactionimporter.controllers.zipimport:ZipImportController',
+            action='status',
+            conditions=dict(method=['GET']),
+        )
+        map_.connect(
+            'import_mapactionzip_upload_start',
+            '/import_mapactionzip/upload',
+            controller='ckanext.mapactionimporter.controllers.zipimport:ZipImportController',
+            action='upload_start',
+            conditions=dict(method=['POST']),
+        )
+        map_.connect(
+            'import_mapactionzip_upload_status',
+            '/import_mapactionzip/upload/{id}',
+            controller='ckanext.mapactionimporter.controllers.zipimport:ZipImportController',
+            action='upload_status',
+            conditions=dict(method=['GET']),
+        )
+        map_.connect(
+            'import_mapactionzip_upload_chunk',
+            '/import_mapactionzip/upload/{id}',
+            controller='ckanext.mapactionimporter.controllers.zipimport:ZipImportController',
+            action='upload_chunk',
+            conditions=dict(method=['POST']),
+        )
+        map_.connect(
+            'import_mapactionzip_upload_finish',
+            '/import_mapactionzip/upload/{id}/finish',
+            controller='ckanext.mapactionimporter.controllers.zipimport:ZipImportController',
+            action='upload_finish',
+            conditions=dict(method=['POST']),
+        )
 
         return map_
 
@@ -129,6 +163,24 @@ class MapactionimporterPlugin(plugins.SingletonPlugin, toolkit.DefaultDatasetFor
         return {
             'create_dataset_from_mapaction_zip':
             ckanext.mapactionimporter.logic.action.create.create_dataset_from_zip,
+            'create_datasets_from_mapaction_zips':
+            ckanext.mapactionimporter.logic.action.create.create_datasets_from_zips,
+            'mapaction_import_status':
+            ckanext.mapactionimporter.logic.action.get.import_status,
+            'validate_mapaction_zips':
+            ckanext.mapactionimporter.logic.action.create.validate_zips,
+            'tag_create': _invalidates_product_themes(
+                ckan.logic.action.create.tag_create),
+            'tag_delete': _invalidates_product_themes(
+                ckan.logic.action.delete.tag_delete),
+        }
+
+    def get_auth_functions(self):
+        return {
+            'mapaction_import_status':
+            ckanext.mapactionimporter.logic.auth.get.import_status,
+            'validate_mapaction_zips':
+            ckanext.mapactionimporter.logic.auth.create.validate_zips,
         }
 
     def get_helpers(self):
@@ -1,3 +1,6 @@
+import hashlib
+import json
+
 import ckan.tests.factories as factories
 import ckan.tests.helpers as helpers
 import ckan.plugins.toolkit as toolkit
@@ -100,3 +103,97 @@ class TestDataPackageController(FunctionalTestBaseClass):
         url = toolkit.url_for('import_mapactionzip')
         response = self._get_test_app().post(url, extra_environ=env, status=[401])
         assert_true('Unauthorized to create a dataset' in response.body)
+
+
+class TestChunkedUpload(FunctionalTestBaseClass):
+    def setup(self):
+        super(TestChunkedUpload, self).setup()
+        self.user = factories.User()
+        self.organization = factories.Organization(user=self.user)
+        factories.Group(name='00189', user=self.user)
+        self.env = {'REMOTE_USER': self.user['name'].encode('ascii')}
+        self.app = self._get_test_app()
+
+        with get_test_zip() as f:
+            self.data = f.read()
+
+    def start(self):
+        response = self.app.post(
+            toolkit.url_for('import_mapactionzip_upload_start'),
+            {'filename': 'MA001_Aptivate_Example.zip', 'size': len(self.data)},
+            extra_environ=self.env)
+
+        return json.loads(response.body)
+
+    def send_chunk(self, upload, offset, end, sha256=None, status=200):
+        chunk = self.data[offset:end]
+        url = '{0}?offset={1}&sha256={2}'.format(
+            toolkit.url_for('import_mapactionzip_upload_chunk',
+                            id=upload['id']),
+            offset, sha256 or hashlib.sha256(chunk).hexdigest())
+
+        response = self.app.post(
+            url, chunk, extra_environ=self.env, status=status,
+            content_type='application/octet-stream')
+
+        return json.loads(response.body)
+
+    def finish(self, upload, status=200):
+        response = self.app.post(
+            toolkit.url_for('import_mapactionzip_upload_finish',
+                            id=upload['id']),
+            {'owner_org': self.organization['id']},
+            extra_environ=self.env, status=status)
+
+        return json.loads(response.body)
+
+    def test_import_in_chunks(self):
+        upload = self.start()
+        middle = len(self.data) // 2
+
+        assert_equal(self.send_chunk(upload, 0, middle)['offset'], middle)
+        assert_equal(self.send_chunk(upload, middle, len(self.data))['offset'],
+                     len(self.data))
+
+        result = self.finish(upload)
+
+        assert_regexp_matches(result['url'], '/dataset/edit/189-ma001-v1')
+        dataset = helpers.call_action('package_show', id='189-ma001-v1')
+        assert_equal(dataset['owner_org'], self.organization['id'])
+
+    def test_resumes_after_bad_chunk(self):
+        upload = self.start()
+        middle = len(self.data) // 2
+        self.send_chunk(upload, 0, middle)
+
+        result = self.send_chunk(upload, middle, len(self.data),
+                                 sha256=hashlib.sha256('x').hexdigest(),
+                                 status=409)
+        assert_equal(result['offset'], middle)
+
+        status = json.loads(self.app.get(
+            toolkit.url_for('import_mapactionzip_upload_status',
+                            id=upload['id']),
+            extra_environ=self.env).body)
+        assert_equal(status['offset'], middle)
+
+        self.send_chunk(upload, middle, len(self.data))
+        self.finish(upload)
+
+    def test_cannot_finish_incomplete_upload(self):
+        upload = self.start()
+        self.send_chunk(upload, 0, 10)
+
+        result = self.finish(upload, status=409)
+
+        assert_equal(result['offset'], 10)
+
+    def test_other_users_upload_not_found(self):
+        upload = self.start()
+        other = factories.User()
+
+        self.app.get(
+            toolkit.url_for('import_mapactionzip_upload_status',
+                            id=upload['id']),
+            extra_environ={'REMOTE_USER': other['name'].encode('ascii')},
+            status=404)
@@ -0,0 +1,68 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from ckanext.mapactionimporter.lib import blobstore
+
+
+class TestBlobStore(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.store = blobstore.BlobStore(os.path.join(self.tmp_dir, 'blobs'))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _resource_file(self, name, contents):
+        path = os.path.join(self.tmp_dir, 'resources', name)
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'wb') as f:
+            f.write(contents)
+
+        return path
+
+    def test_nothing_found_in_empty_store(self):
+        self.assertEqual(self.store.find(0x1234abcd, 10), [])
+
+    def test_added_file_found_by_crc_and_size(self):
+        path = self._resource_file('a', 'contents')
+        blob = self.store.add(path, 0x1234abcd, 8, 'abc123')
+
+        self.assertEqual(self.store.find(0x1234abcd, 8), [(blob, 'abc123')])
+        self.assertEqual(self.store.find(0x1234abcd, 9), [])
+        self.assertEqual(self.store.references(blob), 1)
+
+    def test_linked_file_shares_blob(self):
+        blob = self.store.add(self._resource_file('a', 'contents'),
+                              0x1234abcd, 8, 'abc123')
+
+        path = os.path.join(self.tmp_dir, 'resources', 'b', 'c')
+        self.store.link(blob, path)
+
+        self.assertEqual(open(path, 'rb').read(), 'contents')
+        self.assertEqual(self.store.references(blob), 2)
+
+    def test_adding_stored_file_shares_existing_blob(self):
+        first = self._resource_file('a', 'contents')
+        blob = self.store.add(first, 0x1234abcd, 8, 'abc123')
+
+        second = self._resource_file('b', 'contents')
+        self.assertEqual(self.store.add(second, 0x1234abcd, 8, 'abc123'),
+                         blob)
+
+        self.assertEqual(os.stat(second).st_ino, os.stat(first).st_ino)
+        self.assertEqual(self.store.references(blob), 2)
+
+    def test_garbage_collection_removes_unreferenced_blobs(self):
+        used = self.store.add(self._resource_file('a', 'used'),
+                              1, 4, 'abc123')
+        unused_path = self._resource_file('b', 'unused')
+        unused = self.store.add(unused_path, 2, 6, 'def456')
+        os.remove(unused_path)
+
+        self.assertEqual(self.store.collect_garbage(), 6)
+
+        self.assertTrue(os.path.exists(used))
+        self.assertFalse(os.path.exists(unused))
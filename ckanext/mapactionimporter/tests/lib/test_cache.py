@@ -0,0 +1,59 @@
+import unittest
+
+import mock
+
+from ckanext.mapactionimporter.lib.cache import TTLCache
+
+
+class TestTTLCache(unittest.TestCase):
+    def setUp(self):
+        self.calls = []
+        self.cache = TTLCache(60)
+
+    def _compute(self, value):
+        def compute():
+            self.calls.append(value)
+            return value
+        return compute
+
+    def test_value_computed_once(self):
+        self.assertEqual(self.cache.get('a', self._compute(1)), 1)
+        self.assertEqual(self.cache.get('a', self._compute(2)), 1)
+
+        self.assertEqual(self.calls, [1])
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+
+    def test_values_cached_by_key(self):
+        self.cache.get('a', self._compute(1))
+        self.assertEqual(self.cache.get('b', self._compute(2)), 2)
+
+        self.assertEqual(self.cache.stats(),
+                         {'hits': 0, 'misses': 2, 'entries': 2})
+
+    def test_values_expire(self):
+        with mock.patch('time.time', return_value=1000):
+            self.cache.get('a', self._compute(1))
+        with mock.patch('time.time', return_value=1061):
+            self.assertEqual(self.cache.get('a', self._compute(2)), 2)
+
+    def test_invalidate(self):
+        self.cache.get('a', self._compute(1))
+        self.cache.invalidate()
+
+        self.assertEqual(self.cache.get('a', self._compute(2)), 2)
+
+    def test_value_computed_during_invalidation_not_stored(self):
+        def compute():
+            self.cache.invalidate()
+            return 1
+
+        self.cache.get('a', compute)
+
+        self.assertEqual(self.cache.get('a', self._compute(2)), 2)
+
+    def test_size_limited(self):
+        cache = TTLCache(60, max_entries=2)
+        for key in 'abc':
+            cache.get(key, self._compute(key))
+
+        self.assertEqual(cache.stats()['entries'], 1)
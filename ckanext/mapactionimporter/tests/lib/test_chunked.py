@@ -0,0 +1,149 @@
+import hashlib
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from StringIO import StringIO
+
+import ckan.plugins.toolkit as toolkit
+
+from ckanext.mapactionimporter.lib import chunked
+
+
+class TestChunkedUpload(unittest.TestCase):
+    def setUp(self):
+        self.state_dir = tempfile.mkdtemp()
+        toolkit.config['ckanext.mapactionimporter.state_dir'] = self.state_dir
+
+    def tearDown(self):
+        del toolkit.config['ckanext.mapactionimporter.state_dir']
+        shutil.rmtree(self.state_dir)
+
+    def _append(self, upload, offset, data, sha256=None):
+        return chunked.append(upload['id'], offset, StringIO(data),
+                              len(data),
+                              sha256 or hashlib.sha256(data).hexdigest())
+
+    def test_chunks_assembled(self):
+        upload = chunked.start('user', 'map.zip', 10)
+
+        self.assertEqual(self._append(upload, 0, 'abcde'), 5)
+        self.assertEqual(self._append(upload, 5, 'fghij',
+                                      hashlib.sha256('fghij').hexdigest()),
+                         10)
+
+        path = chunked.finish(upload['id'])
+        with open(path, 'rb') as f:
+            self.assertEqual(f.read(), 'abcdefghij')
+        self.assertIsNone(chunked.get_upload(upload['id']))
+
+    def test_chunk_with_wrong_checksum_refused(self):
+        upload = chunked.start('user', 'map.zip', 10)
+        self._append(upload, 0, 'abcde')
+
+        with self.assertRaises(chunked.ChunkedUploadException) as cm:
+            self._append(upload, 5, 'fghij', hashlib.sha256('x').hexdigest())
+
+        self.assertEqual(cm.exception.offset, 5)
+        self.assertEqual(chunked.get_upload(upload['id'])['offset'], 5)
+
+        # Resumed from the last good chunk
+        self._append(upload, 5, 'fghij')
+        with open(chunked.finish(upload['id']), 'rb') as f:
+            self.assertEqual(f.read(), 'abcdefghij')
+
+    def test_chunk_at_wrong_offset_refused(self):
+        upload = chunked.start('user', 'map.zip', 10)
+        self._append(upload, 0, 'abcde')
+
+        with self.assertRaises(chunked.ChunkedUploadException) as cm:
+            self._append(upload, 0, 'abcde')
+
+        self.assertEqual(cm.exception.offset, 5)
+
+    def test_short_chunk_refused(self):
+        upload = chunked.start('user', 'map.zip', 10)
+
+        with self.assertRaises(chunked.ChunkedUploadException):
+            chunked.append(upload['id'], 0, StringIO('abc'), 5,
+                           hashlib.sha256('abc').hexdigest())
+
+        self.assertEqual(chunked.get_upload(upload['id'])['offset'], 0)
+
+    def test_chunk_without_checksum_refused(self):
+        upload = chunked.start('user', 'map.zip', 10)
+
+        with self.assertRaises(chunked.ChunkedUploadException) as cm:
+            chunked.append(upload['id'], 0, StringIO('abcde'), 5, None)
+
+        self.assertIsNone(cm.exception.offset)
+        self.assertEqual(chunked.get_upload(upload['id'])['offset'], 0)
+
+    def test_upload_larger_than_limit_refused(self):
+        toolkit.config['ckanext.mapactionimporter.import_quota'] = '10'
+        try:
+            with self.assertRaises(chunked.ChunkedUploadException):
+                chunked.start('user', 'map.zip', 11)
+            chunked.start('user', 'map.zip', 10)
+        finally:
+            del toolkit.config['ckanext.mapactionimporter.import_quota']
+
+    def test_open_uploads_limited_per_user(self):
+        for i in range(chunked.MAX_OPEN_UPLOADS):
+            chunked.start('user', 'map.zip', 10)
+
+        with self.assertRaises(chunked.ChunkedUploadException):
+            chunked.start('user', 'map.zip', 10)
+        chunked.start('other', 'map.zip', 10)
+
+    def test_chunk_not_locked_out_by_another_upload(self):
+        # A chunk of one upload being received doesn't stop another
+        # upload's chunks being added
+        upload = chunked.start('user', 'map.zip', 10)
+        other = chunked.start('user', 'map.zip', 5)
+        test = self
+
+        class SlowClient(object):
+            def __init__(self):
+                self.data = StringIO('abcde')
+
+            def read(self, size):
+                if self.data.tell() == 0:
+                    test.assertEqual(test._append(other, 0, 'vwxyz'), 5)
+                return self.data.read(size)
+
+        chunked.append(upload['id'], 0, SlowClient(), 5,
+                       hashlib.sha256('abcde').hexdigest())
+
+        self.assertEqual(chunked.get_upload(upload['id'])['offset'], 5)
+        with open(chunked.finish(other['id']), 'rb') as f:
+            self.assertEqual(f.read(), 'vwxyz')
+
+    def test_chunk_past_end_refused(self):
+        upload = chunked.start('user', 'map.zip', 4)
+
+        with self.assertRaises(chunked.ChunkedUploadException):
+            self._append(upload, 0, 'abcde')
+
+    def test_incomplete_upload_cannot_finish(self):
+        upload = chunked.start('user', 'map.zip', 10)
+        self._append(upload, 0, 'abcde')
+
+        with self.assertRaises(chunked.ChunkedUploadException) as cm:
+            chunked.finish(upload['id'])
+
+        self.assertEqual(cm.exception.offset, 5)
+
+    def test_stale_uploads_removed(self):
+        toolkit.config['ckanext.mapactionimporter.upload_timeout'] = '1'
+        try:
+            upload = chunked.start('user', 'map.zip', 10)
+            time.sleep(1.1)
+            chunked.remove_stale()
+        finally:
+            del toolkit.config['ckanext.mapactionimporter.upload_timeout']
+
+        self.assertIsNone(chunked.get_upload(upload['id']))
+        self.assertEqual(
+            os.listdir(os.path.join(self.state_dir, 'chunks')), [])
@@ -0,0 +1,98 @@
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+import mock
+
+import ckan.plugins.toolkit as toolkit
+
+from ckanext.mapactionimporter.lib import idempotency
+
+
+class TestClaim(unittest.TestCase):
+    def setUp(self):
+        self.state_dir = tempfile.mkdtemp()
+        toolkit.config['ckanext.mapactionimporter.state_dir'] = self.state_dir
+
+    def tearDown(self):
+        del toolkit.config['ckanext.mapactionimporter.state_dir']
+        shutil.rmtree(self.state_dir)
+
+    @mock.patch.object(idempotency, 'POLL_INTERVAL', 0.01)
+    def test_second_claim_waits_for_first(self):
+        events = []
+
+        def second():
+            with idempotency.claim('key'):
+                events.append('second')
+
+        with idempotency.claim('key'):
+            thread = threading.Thread(target=second)
+            thread.start()
+            time.sleep(0.1)
+            events.append('first')
+
+        thread.join()
+
+        self.assertEqual(events, ['first', 'second'])
+
+    def test_different_keys_do_not_wait(self):
+        with idempotency.claim('key'):
+            with idempotency.claim('other key'):
+                pass
+
+    def test_claim_released_on_error(self):
+        try:
+            with idempotency.claim('key'):
+                raise ValueError()
+        except ValueError:
+            pass
+
+        with idempotency.claim('key'):
+            pass
+
+    @mock.patch.object(idempotency, 'POLL_INTERVAL', 0.01)
+    def test_stale_claim_taken_over(self):
+        idempotency._acquire('key', 0)
+        time.sleep(0.01)
+
+        with mock.patch.dict(toolkit.config, {
+                'ckanext.mapactionimporter.import_claim_timeout': '0'}):
+            with idempotency.claim('key'):
+                pass
+
+
+    @mock.patch.object(idempotency, 'POLL_INTERVAL', 0.01)
+    def test_wait_for_claim_limited(self):
+        with idempotency.claim('key'):
+            with self.assertRaises(idempotency.ImportInProgress):
+                with idempotency.claim('key', wait=0.05):
+                    pass
+
+    @mock.patch.object(idempotency, 'REFRESH_INTERVAL', 0)
+    def test_refreshed_claim_not_taken_over(self):
+        with mock.patch.dict(toolkit.config, {
+                'ckanext.mapactionimporter.import_claim_timeout': '1'}):
+            with idempotency.claim('key') as import_claim:
+                time.sleep(0.6)
+                import_claim.refresh()
+                time.sleep(0.6)
+
+                with self.assertRaises(idempotency.ImportInProgress):
+                    with idempotency.claim('key', wait=0):
+                        pass
+
+
+class TestImportedFrom(unittest.TestCase):
+    def test_matching_hash(self):
+        dataset = {'extras': [{'key': 'import_sha256', 'value': 'abc'}]}
+        self.assertTrue(idempotency.imported_from(dataset, 'abc'))
+
+    def test_different_hash(self):
+        dataset = {'extras': [{'key': 'import_sha256', 'value': 'abc'}]}
+        self.assertFalse(idempotency.imported_from(dataset, 'def'))
+
+    def test_no_hash(self):
+        self.assertFalse(idempotency.imported_from({'extras': []}, 'abc'))
@@ -0,0 +1,66 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from StringIO import StringIO
+
+import mock
+
+import ckan.plugins.toolkit as toolkit
+
+from ckanext.mapactionimporter.lib import jobs, state
+from ckanext.mapactionimporter.lib.upload import FileUpload
+
+
+class TestAbandonedJobs(unittest.TestCase):
+    def setUp(self):
+        self.state_dir = tempfile.mkdtemp()
+        toolkit.config['ckanext.mapactionimporter.state_dir'] = self.state_dir
+        toolkit.config['ckanext.mapactionimporter.async_worker_threads'] = '0'
+
+    def tearDown(self):
+        del toolkit.config['ckanext.mapactionimporter.state_dir']
+        del toolkit.config['ckanext.mapactionimporter.async_worker_threads']
+        shutil.rmtree(self.state_dir)
+
+    def _claim(self):
+        upload = FileUpload(StringIO('zip'), 'map.zip')
+        job_id = jobs.enqueue('user', upload, {})
+        self.assertEqual(jobs.claim_next_job()['id'], job_id)
+
+        return jobs.get_job(job_id)
+
+    def test_claimed_job_records_worker(self):
+        job = self._claim()
+
+        self.assertEqual(job['status'], jobs.RUNNING)
+        self.assertEqual(job['pid'], os.getpid())
+
+    def test_job_of_stopped_worker_failed(self):
+        job = self._claim()
+
+        with mock.patch.object(state, 'process_running', return_value=False):
+            self.assertEqual(jobs.recover(), [job['id']])
+
+        job = jobs.get_job(job['id'])
+        self.assertEqual(job['status'], jobs.ERROR)
+        self.assertIn('interrupted', job['error']['Error'])
+        self.assertFalse(os.path.exists(job['path']))
+
+    def test_job_without_progress_failed_when_next_job_claimed(self):
+        job = self._claim()
+        with jobs._connect() as connection:
+            connection.execute(
+                'UPDATE import_job SET updated = ? WHERE id = ?',
+                (time.time() - 7200, job['id']))
+
+        self.assertIsNone(jobs.claim_next_job())
+        self.assertEqual(jobs.get_job(job['id'])['status'], jobs.ERROR)
+
+    def test_running_job_left_alone(self):
+        job = self._claim()
+
+        self.assertEqual(jobs.recover(), [])
+        self.assertEqual(jobs.get_job(job['id'])['status'], jobs.RUNNING)
+        self.assertTrue(os.path.exists(job['path']))
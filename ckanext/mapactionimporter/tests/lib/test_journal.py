@@ -0,0 +1,194 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import mock
+
+import ckan.plugins.toolkit as toolkit
+
+from ckanext.mapactionimporter.lib import journal, state
+
+
+@mock.patch.object(journal, '_undo_context', lambda: {})
+class TestUnitOfWork(unittest.TestCase):
+    def setUp(self):
+        self.state_dir = tempfile.mkdtemp()
+        toolkit.config['ckanext.mapactionimporter.state_dir'] = self.state_dir
+        self.upload_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        del toolkit.config['ckanext.mapactionimporter.state_dir']
+        shutil.rmtree(self.state_dir)
+        shutil.rmtree(self.upload_dir)
+
+    def _upload(self, import_journal, name):
+        path = os.path.join(self.upload_dir, name)
+        import_journal.record('file', path=path)
+        open(path, 'w').close()
+
+        return path
+
+    def _journals(self):
+        with journal._connect() as connection:
+            return connection.execute(
+                'SELECT * FROM import_journal').fetchall()
+
+    def test_effects_kept_on_success(self):
+        with journal.unit_of_work('189-ma001-v1') as import_journal:
+            path = self._upload(import_journal, 'map.pdf')
+
+        self.assertTrue(os.path.exists(path))
+        self.assertEqual(self._journals(), [])
+
+    def test_effects_undone_on_failure(self):
+        paths = []
+        with self.assertRaises(ValueError):
+            with journal.unit_of_work('189-ma001-v1') as import_journal:
+                paths.append(self._upload(import_journal, 'map.pdf'))
+                # Recorded, but failed before it was made
+                import_journal.record(
+                    'file', path=os.path.join(self.upload_dir, 'map.jpeg'))
+                raise ValueError()
+
+        self.assertFalse(os.path.exists(paths[0]))
+        self.assertEqual(self._journals(), [])
+
+    def test_effects_undone_newest_first(self):
+        undone = []
+        with mock.patch.dict(journal.UNDO, {
+                'test': lambda context, n: undone.append(n)}):
+            with self.assertRaises(ValueError):
+                with journal.unit_of_work('189-ma001-v1') as import_journal:
+                    for n in range(3):
+                        import_journal.record('test', n=n)
+                    raise ValueError()
+
+        self.assertEqual(undone, [2, 1, 0])
+
+    def test_failed_undo_left_for_recovery(self):
+        failures = [IOError()]
+
+        def undo(context):
+            if failures:
+                raise failures.pop()
+
+        with mock.patch.dict(journal.UNDO, {'test': undo}):
+            with self.assertRaises(ValueError):
+                with journal.unit_of_work('189-ma001-v1') as import_journal:
+                    import_journal.record('test')
+                    raise ValueError()
+
+            self.assertEqual([j['status'] for j in self._journals()],
+                             [journal.FAILED])
+
+            results = journal.recover()
+
+        self.assertEqual([r['undone'] for r in results], [True])
+        self.assertEqual(self._journals(), [])
+
+    def test_recover_rolls_back_imports_that_died(self):
+        import_journal = journal.ImportJournal.begin('189-ma001-v1')
+        path = self._upload(import_journal, 'map.pdf')
+
+        with mock.patch.object(state, 'process_running', return_value=False):
+            results = journal.recover()
+
+        self.assertEqual([r['dataset'] for r in results], ['189-ma001-v1'])
+        self.assertFalse(os.path.exists(path))
+
+    def test_recover_leaves_imports_in_progress(self):
+        import_journal = journal.ImportJournal.begin('189-ma001-v1')
+        path = self._upload(import_journal, 'map.pdf')
+
+        self.assertEqual(journal.recover(), [])
+        self.assertTrue(os.path.exists(path))
+
+    def test_skipped_effects_reported(self):
+        def undo(context):
+            raise journal.EffectSkipped('Changed since')
+
+        with mock.patch.dict(journal.UNDO, {'test': undo}):
+            import_journal = journal.ImportJournal.begin('189-ma001-v1')
+            import_journal.record('test')
+
+            with mock.patch.object(state, 'process_running',
+                                   return_value=False):
+                [result] = journal.recover()
+
+        self.assertTrue(result['undone'])
+        self.assertEqual(result['skipped'], ['Changed since'])
+        self.assertEqual(self._journals(), [])
+
+
+class TestUndo(unittest.TestCase):
+    def setUp(self):
+        self.calls = []
+        self.datasets = {}
+
+        def get_action(name):
+            def action(context, data_dict):
+                self.calls.append((name, data_dict))
+                if name == 'package_show':
+                    if data_dict['id'] not in self.datasets:
+                        raise toolkit.ObjectNotFound()
+                    return self.datasets[data_dict['id']]
+                if name == 'package_relationships_list':
+                    return self.relationships
+            return action
+
+        patcher = mock.patch.object(toolkit, 'get_action', get_action)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.relationships = []
+
+    def _dataset(self, sha256):
+        dataset = {'id': 'abc', 'name': '189-ma001-v1',
+                   'extras': [{'key': 'import_sha256', 'value': sha256}]}
+        self.datasets['abc'] = dataset
+
+        return dataset
+
+    def _writes(self):
+        return [name for name, data_dict in self.calls
+                if name not in ('package_show', 'package_relationships_list')]
+
+    def test_update_undone_if_dataset_from_this_import(self):
+        self._dataset('new')
+
+        journal._undo_package_updated({}, {'id': 'abc', 'name': 'x'}, 'new')
+
+        self.assertEqual(self._writes(), ['package_update'])
+
+    def test_update_left_alone_if_dataset_changed_since(self):
+        self._dataset('later')
+
+        with self.assertRaises(journal.EffectSkipped):
+            journal._undo_package_updated(
+                {}, {'id': 'abc', 'name': '189-ma001-v1'}, 'new')
+
+        self.assertEqual(self._writes(), [])
+
+    def test_parent_created_by_link_purged(self):
+        self.relationships = [{'subject': '189-ma001-v1', 'object': '189-ma001',
+                               'type': 'child_of'}]
+
+        journal._undo_version_linked({}, '189-ma001-v1', '189-ma001', True)
+
+        self.assertEqual(self.calls[-1],
+                         ('dataset_purge', {'id': '189-ma001'}))
+
+    def test_parent_with_other_versions_left_alone(self):
+        self.relationships = [{'subject': '189-ma001-v2', 'object': '189-ma001',
+                               'type': 'child_of'}]
+
+        with self.assertRaises(journal.EffectSkipped):
+            journal._undo_version_linked({}, '189-ma001-v1', '189-ma001',
+                                         True)
+
+        self.assertEqual(self._writes(), [])
+
+    def test_existing_parent_left_alone(self):
+        journal._undo_version_linked({}, '189-ma001-v1', '189-ma001', False)
+
+        self.assertEqual(self.calls, [])
@@ -0,0 +1,355 @@
+import hashlib
+import os
+import unittest
+import zipfile
+from multiprocessing.pool import ThreadPool
+from StringIO import StringIO
+
+from defusedxml.ElementTree import parse, ParseError
+
+from ckanext.mapactionimporter.lib import mappackage, workspace
+
+
+def _data_path(filename):
+    return os.path.join(os.path.split(__file__)[0],
+                        '../test-data/', filename)
+
+
+class TestToDataset(unittest.TestCase):
+    zip_path = _data_path('MA001_Aptivate_Example.zip')
+
+    def setUp(self):
+        self.zip_file = open(self.zip_path, 'rb')
+        self.expected = {}
+        with zipfile.ZipFile(self.zip_path) as z:
+            for name in z.namelist():
+                if not name.endswith('.xml'):
+                    self.expected[name] = z.read(name)
+
+    def tearDown(self):
+        self.zip_file.close()
+
+    def test_members_are_streamed_from_zip(self):
+        dataset_info = mappackage.to_dataset(self.zip_file)
+        members = dataset_info['members']
+
+        self.assertEqual(sorted(m.name for m in members),
+                         sorted(self.expected.keys()))
+
+        for member in members:
+            self.assertTrue(isinstance(member, mappackage.MapPackageMember))
+            self.assertEqual(member.size, len(self.expected[member.name]))
+            self.assertEqual(member.open().read(), self.expected[member.name])
+
+    def test_members_can_be_extracted_to_workspace(self):
+        with workspace.ImportWorkspace() as ws:
+            dataset_info = mappackage.to_dataset(self.zip_file, workspace=ws)
+
+            for member in dataset_info['members']:
+                self.assertEqual(os.path.dirname(member.path), ws.path)
+                with member.open() as f:
+                    self.assertEqual(f.read(), self.expected[member.name])
+
+    def test_extraction_limited_by_workspace_quota(self):
+        with workspace.ImportWorkspace(quota=1000) as ws:
+            with self.assertRaises(mappackage.MapPackageException):
+                mappackage.to_dataset(self.zip_file, workspace=ws)
+
+    def test_member_file_supports_uploader_seeks(self):
+        dataset_info = mappackage.to_dataset(self.zip_file)
+        member = dataset_info['members'][0]
+        expected = self.expected[member.name]
+
+        f = member.open()
+        f.seek(0, os.SEEK_END)
+        self.assertEqual(f.tell(), len(expected))
+        self.assertEqual(f.read(), '')
+
+        f.seek(0)
+        self.assertEqual(f.read(10), expected[:10])
+        self.assertEqual(f.read(10), expected[10:20])
+
+        f.seek(5)
+        self.assertEqual(f.read(), expected[5:])
+        f.close()
+
+    def test_members_can_be_read_at_the_same_time(self):
+        dataset_info = mappackage.to_dataset(self.zip_file)
+        files = [m.open() for m in dataset_info['members']]
+        contents = dict((f.name, []) for f in files)
+
+        # Interleave reads from each member
+        while files:
+            for f in list(files):
+                data = f.read(1000)
+                if data:
+                    contents[f.name].append(data)
+                else:
+                    files.remove(f)
+
+        for name, chunks in contents.items():
+            self.assertEqual(''.join(chunks), self.expected[name])
+
+    def test_members_can_be_read_from_several_threads(self):
+        dataset_info = mappackage.to_dataset(self.zip_file)
+        members = dataset_info['members']
+
+        pool = ThreadPool(len(members))
+        try:
+            contents = pool.map(lambda m: m.open().read(), members)
+        finally:
+            pool.close()
+
+        for member, data in zip(members, contents):
+            self.assertEqual(data, self.expected[member.name])
+
+
+class TestMemberVerification(unittest.TestCase):
+    data = 'map data ' * 1000
+
+    def setUp(self):
+        f = StringIO()
+        with zipfile.ZipFile(f, 'w', zipfile.ZIP_DEFLATED) as z:
+            z.writestr('MA001.xml', '<mapdoc/>')
+            z.writestr('map.pdf', self.data)
+        f.seek(0)
+        self.zip_file = zipfile.ZipFile(f)
+        self.dataset_info = {'zip_file': self.zip_file}
+
+    def test_digest_recorded_when_streamed_member_read(self):
+        member = mappackage.read_members(self.dataset_info)[0]
+        self.assertIsNone(member.sha256)
+
+        f = member.open()
+        while f.read(1000):
+            pass
+
+        self.assertEqual(member.sha256, hashlib.sha256(self.data).hexdigest())
+
+    def test_digest_not_recorded_for_partial_read(self):
+        member = mappackage.read_members(self.dataset_info)[0]
+
+        member.open().read(1000)
+
+        self.assertIsNone(member.sha256)
+
+    def test_digest_recorded_when_member_extracted(self):
+        with workspace.ImportWorkspace() as ws:
+            member = mappackage.read_members(self.dataset_info, ws)[0]
+
+        self.assertEqual(member.sha256, hashlib.sha256(self.data).hexdigest())
+
+    def test_bad_crc_rejected(self):
+        self.zip_file.getinfo('map.pdf').CRC ^= 1
+        member = mappackage.read_members(self.dataset_info)[0]
+
+        with self.assertRaises(mappackage.MapPackageException) as cm:
+            member.open().read()
+
+        self.assertEqual(cm.exception.args[0], "'map.pdf' is corrupt")
+        self.assertIsNone(member.sha256)
+
+        with workspace.ImportWorkspace() as ws:
+            with self.assertRaises(mappackage.MapPackageException):
+                mappackage.read_members(self.dataset_info, ws)
+
+    def test_short_member_rejected(self):
+        self.zip_file.getinfo('map.pdf').file_size += 1
+        member = mappackage.read_members(self.dataset_info)[0]
+
+        with self.assertRaises(mappackage.MapPackageException):
+            member.open().read()
+
+
+class TestReadMetadata(unittest.TestCase):
+    def setUp(self):
+        self.opened = []
+        self.original_open = zipfile.ZipFile.open
+        opened = self.opened
+        original_open = self.original_open
+
+        def recording_open(z, name, *args, **kwargs):
+            opened.append(getattr(name, 'filename', name))
+            return original_open(z, name, *args, **kwargs)
+
+        zipfile.ZipFile.open = recording_open
+
+    def tearDown(self):
+        zipfile.ZipFile.open = self.original_open
+
+    def test_only_metadata_read_in_first_phase(self):
+        with open(_data_path('MA001_Aptivate_Example.zip'), 'rb') as f:
+            dataset_info = mappackage.read_metadata(f)
+
+            self.assertEqual(dataset_info['name'], '189-ma001-v1')
+            self.assertEqual(dataset_info['status'], 'New')
+            self.assertEqual(self.opened, ['MA001_Aptivate_Example.xml'])
+
+            members = mappackage.read_members(dataset_info)
+            self.assertEqual(len(members), 2)
+
+    def test_invalid_metadata_rejected_without_reading_files(self):
+        with open(_data_path('MA001_Special_Characters.zip'), 'rb') as f:
+            with self.assertRaises(mappackage.MapPackageException):
+                mappackage.read_metadata(f)
+
+        self.assertEqual(self.opened, ['MA001_Aptivate_Example.xml'])
+
+    def test_missing_metadata_rejected_without_reading_files(self):
+        with open(_data_path('MA001_Missing_Metadata.zip'), 'rb') as f:
+            with self.assertRaises(mappackage.MapPackageException):
+                mappackage.read_metadata(f)
+
+        self.assertEqual(self.opened, [])
+
+    def test_oversized_metadata_rejected_before_reading(self):
+        with open(_data_path('MA001_Aptivate_Example.zip'), 'rb') as f:
+            with self.assertRaises(mappackage.MapPackageException) as cm:
+                mappackage.read_metadata(f, max_bytes=100)
+
+        self.assertEqual(cm.exception.args[0],
+                         'Metadata XML is larger than 100 bytes')
+        self.assertEqual(self.opened, [])
+
+
+class TestCheckArchive(unittest.TestCase):
+    def _zip(self, members):
+        f = StringIO()
+        with zipfile.ZipFile(f, 'w', zipfile.ZIP_DEFLATED) as z:
+            for name, data in members:
+                z.writestr(name, data)
+        f.seek(0)
+
+        return zipfile.ZipFile(f)
+
+    def test_fixture_accepted(self):
+        with zipfile.ZipFile(_data_path('MA001_Aptivate_Example.zip')) as z:
+            mappackage.check_archive(z)
+
+    def test_too_many_entries_rejected_before_reading(self):
+        original_open = zipfile.ZipFile.open
+        zipfile.ZipFile.open = None
+        try:
+            with open(_data_path('MA001_Aptivate_Example.zip'), 'rb') as f:
+                with self.assertRaises(mappackage.MapPackageException) as cm:
+                    mappackage.read_metadata(f, max_entries=2)
+        finally:
+            zipfile.ZipFile.open = original_open
+
+        self.assertEqual(cm.exception.args[0],
+                         'Zip file has 3 files, the limit is 2')
+
+    def test_large_member_rejected(self):
+        z = self._zip([('map.pdf', 'x' * 1001)])
+
+        with self.assertRaises(mappackage.MapPackageException):
+            mappackage.check_archive(z, max_member_size=1000)
+
+    def test_large_total_size_rejected(self):
+        z = self._zip([('map.pdf', 'x' * 600), ('map.jpeg', 'x' * 600)])
+
+        mappackage.check_archive(z, max_member_size=1000)
+        with self.assertRaises(mappackage.MapPackageException):
+            mappackage.check_archive(z, max_total_size=1000)
+
+    def test_highly_compressed_member_rejected(self):
+        z = self._zip([('map.pdf', '\0' * 10 * 1024 * 1024)])
+
+        with self.assertRaises(mappackage.MapPackageException) as cm:
+            mappackage.check_archive(z)
+
+        self.assertEqual(cm.exception.args[0],
+                         "'map.pdf' is compressed more than 100 times")
+
+    def test_small_members_may_be_highly_compressed(self):
+        z = self._zip([('map.pdf', '\0' * 1024)])
+
+        mappackage.check_archive(z)
+
+    def test_nested_archive_rejected(self):
+        z = self._zip([('layers.ZIP', 'x')])
+
+        with self.assertRaises(mappackage.MapPackageException):
+            mappackage.check_archive(z)
+
+        mappackage.check_archive(z, allow_nested_archives=True)
+
+    def test_member_larger_than_central_directory_says_rejected(self):
+        z = self._zip([('MA001.xml', 'x'), ('map.pdf', 'x' * 1000)])
+        z.getinfo('map.pdf').file_size = 10
+        dataset_info = {'zip_file': z}
+
+        member = mappackage.read_members(dataset_info)[0]
+        with self.assertRaises(mappackage.MapPackageException):
+            member.open().read()
+
+        with workspace.ImportWorkspace() as import_workspace:
+            with self.assertRaises(mappackage.MapPackageException):
+                mappackage.read_members(dataset_info, import_workspace)
+
+
+class TestParseMetadata(unittest.TestCase):
+    metadata = """<?xml version="1.0" encoding="utf-8"?>
+<mapdoc>
+  <mapdata>
+    <operationID>00189</operationID>
+    <themes>
+      <theme>Health</theme>
+      <theme>Logistics</theme>
+    </themes>
+    <status>New</status>
+  </mapdata>
+  {trailer}
+</mapdoc>
+"""
+
+    def _parse(self, trailer='', **limits):
+        return mappackage.parse_metadata(
+            StringIO(self.metadata.format(trailer=trailer)), **limits)
+
+    def test_fields_and_themes_read(self):
+        metadata = self._parse()
+
+        self.assertEqual(metadata.fields['operationID'], '00189')
+        self.assertEqual(metadata.fields['status'], 'New')
+        self.assertEqual(metadata.themes, ['Health', 'Logistics'])
+        self.assertEqual(metadata.extras.keys(), [])
+
+    def test_same_results_as_tree(self):
+        xml = self.metadata.format(trailer='')
+        streamed = mappackage.parse_metadata(StringIO(xml))
+        indexed = mappackage.MetadataIndex(parse(StringIO(xml)))
+
+        self.assertEqual(streamed.fields, indexed.fields)
+        self.assertEqual(streamed.extras, indexed.extras)
+        self.assertEqual(streamed.themes, indexed.themes)
+
+    def test_reading_stops_after_mapdata(self):
+        metadata = self._parse(trailer='<unclosed>')
+
+        self.assertEqual(metadata.fields['status'], 'New')
+
+    def test_malformed_metadata_raises_parse_error(self):
+        with self.assertRaises(ParseError):
+            mappackage.parse_metadata(StringIO('<mapdoc><mapdata>'))
+
+    def test_it_raises_when_too_large(self):
+        with self.assertRaises(mappackage.MapPackageException) as cm:
+            self._parse(trailer=' ' * 100000, max_bytes=1000)
+
+        self.assertEqual(cm.exception.args[0],
+                         'Metadata XML is larger than 1000 bytes')
+
+    def test_it_raises_when_too_many_elements(self):
+        with self.assertRaises(mappackage.MapPackageException) as cm:
+            self._parse(max_elements=5)
+
+        self.assertEqual(cm.exception.args[0],
+                         'Metadata XML has more than 5 elements')
+
+    def test_it_raises_when_too_deep(self):
+        with self.assertRaises(mappackage.MapPackageException) as cm:
+            self._parse(max_depth=3)
+
+        self.assertEqual(cm.exception.args[0],
+                         'Metadata XML is nested more than 3 levels deep')
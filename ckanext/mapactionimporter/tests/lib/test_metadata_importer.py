@@ -67,6 +67,54 @@ class TestMapMetadataToCkanExtras(TestXmlParse):
         self.assertNotIn('themes', self.extras_dict)
 
 
+class TestMetadataIndex(TestXmlParse):
+    template_xml = """<?xml version="1.0" encoding="utf-8"?>
+<mapdoc>
+  <mapdata>
+    <!-- Comments are ignored -->
+    <operationID>{operationid}</operationID>
+    <title>{title}</title>
+    <status>{status}</status>
+    <summary>{summary}</summary>
+    <themes>
+      <theme>{theme}</theme>
+      <theme>Health</theme>
+    </themes>
+    <mapNumber>{mapnumber}</mapNumber>
+    <versionNumber>{versionnumber}</versionNumber>
+  </mapdata>
+</mapdoc>
+    """
+
+    def test_fields_indexed_by_tag(self):
+        metadata = mappackage.MetadataIndex(
+            self.parse_xml(operationid='00123', mapnumber='MA001'))
+
+        self.assertEqual(metadata.fields['operationID'], '00123')
+        self.assertEqual(metadata.fields['mapNumber'], 'MA001')
+
+    def test_themes_listed_in_order(self):
+        metadata = mappackage.MetadataIndex(
+            self.parse_xml(theme='Logistics'))
+
+        self.assertEqual(metadata.themes, ['Logistics', 'Health'])
+
+    def test_extras_exclude_dataset_fields(self):
+        metadata = mappackage.MetadataIndex(self.parse_xml())
+
+        self.assertEqual(sorted(metadata.extras.keys()),
+                         ['mapNumber', 'summary'])
+
+    def test_same_results_from_index_and_tree(self):
+        et = self.parse_xml()
+        metadata = mappackage.MetadataIndex(et)
+
+        self.assertEqual(mappackage.populate_dataset_dict_from_xml(metadata),
+                         mappackage.populate_dataset_dict_from_xml(et))
+        self.assertEqual(mappackage.get_text_node(metadata, 'title'),
+                         mappackage.get_text_node(et, 'title'))
+
+
 class TestPopulateDatasetDictFromXml(TestXmlParse):
     template_xml = """<?xml version="1.0" encoding="utf-8"?>
 <mapdoc>
@@ -140,6 +188,15 @@ class TestPopulateDatasetDictFromXml(TestXmlParse):
         self.assertTrue('Affected Population' in
                         dataset_dict['product_themes'])
 
+    def test_theme_spelling_variants_recovered(self):
+        et = self.parse_xml(theme='water, sanitation &amp; hygiene ')
+        self._add_to_etree(et, './/mapdata/themes', 'theme', 'WASH')
+
+        dataset_dict = mappackage.populate_dataset_dict_from_xml(et)
+
+        self.assertEqual(dataset_dict['product_themes'],
+                         ['Water Sanitation and Hygiene'])
+
     def test_it_raises_when_mandatory_field_missing(self):
         mandatory_fields = ('operationID',
                             'mapNumber',
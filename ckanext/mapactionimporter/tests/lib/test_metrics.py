@@ -0,0 +1,120 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import mock
+
+import ckan.plugins.toolkit as toolkit
+
+from ckanext.mapactionimporter.lib import metrics
+
+RECORDS = []
+
+
+class _ListSink(metrics.MetricsSink):
+    def record(self, import_record):
+        RECORDS.append(import_record)
+
+
+class TestImportMetrics(unittest.TestCase):
+    def test_stages_timed_in_turn(self):
+        import_metrics = metrics.ImportMetrics()
+        with mock.patch('time.time', side_effect=[10, 11, 13, 16]):
+            import_metrics.start_stage('read_metadata')
+            import_metrics.start_stage('package_create')
+            import_metrics.start_stage('package_create')
+            record = import_metrics.finish('success')
+
+        self.assertEqual(record['outcome'], 'success')
+        self.assertEqual(record['stages'].keys(),
+                         ['read_metadata', 'package_create'])
+        self.assertEqual(record['stages']['read_metadata']['seconds'], 1)
+        self.assertEqual(record['stages']['package_create'],
+                         {'seconds': 5, 'bytes': 0, 'calls': 2})
+
+    def test_observations_added_to_stage(self):
+        import_metrics = metrics.ImportMetrics()
+        import_metrics.observe('resource_file', 0.5, bytes=100)
+        import_metrics.observe('resource_file', 0.25, bytes=50)
+        import_metrics.annotate(dataset='189-ma001-v1')
+
+        record = import_metrics.finish('success')
+
+        self.assertEqual(record['dataset'], '189-ma001-v1')
+        self.assertEqual(record['stages']['resource_file'],
+                         {'seconds': 0.75, 'bytes': 150, 'calls': 2})
+
+
+class TestPrometheusFileSink(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'metrics-{pid}.prom')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_imports_aggregated_into_file(self):
+        sink = metrics.PrometheusFileSink(self.path, buckets=(1, 10))
+        for seconds in (0.5, 5):
+            sink.record({
+                'outcome': 'success',
+                'seconds': seconds,
+                'stages': {
+                    'package_create': {
+                        'seconds': seconds, 'bytes': 0, 'calls': 1},
+                },
+            })
+
+        with open(self.path.format(pid=os.getpid())) as f:
+            lines = f.read().splitlines()
+
+        self.assertIn('mapactionimporter_imports_total{outcome="success"} 2',
+                      lines)
+        self.assertIn('mapactionimporter_import_seconds_bucket{le="1.0"} 1',
+                      lines)
+        self.assertIn('mapactionimporter_import_seconds_bucket{le="+Inf"} 2',
+                      lines)
+        self.assertIn('mapactionimporter_import_seconds_sum 5.5', lines)
+        self.assertIn('mapactionimporter_stage_seconds_bucket'
+                      '{stage="package_create",le="10.0"} 2', lines)
+        self.assertIn('mapactionimporter_stage_calls_total'
+                      '{stage="package_create"} 2', lines)
+
+
+class TestRecordImport(unittest.TestCase):
+    def tearDown(self):
+        toolkit.config.pop('ckanext.mapactionimporter.metrics_sink', None)
+        del RECORDS[:]
+
+    def test_no_sink_by_default(self):
+        self.assertEqual(metrics.get_sink(), None)
+
+    def test_configured_sink_receives_records(self):
+        toolkit.config['ckanext.mapactionimporter.metrics_sink'] = \
+            'ckanext.mapactionimporter.tests.lib.test_metrics:_ListSink'
+
+        metrics.record_import({'outcome': 'success'})
+
+        self.assertEqual(RECORDS, [{'outcome': 'success'}])
+
+    def test_sink_errors_do_not_fail_import(self):
+        toolkit.config['ckanext.mapactionimporter.metrics_sink'] = \
+            'ckanext.mapactionimporter.tests.lib.test_metrics:_ListSink'
+
+        with mock.patch.object(_ListSink, 'record', side_effect=IOError):
+            metrics.record_import({'outcome': 'success'})
+
+    def test_filename_not_utf8_does_not_fail_import(self):
+        toolkit.config['ckanext.mapactionimporter.metrics_sink'] = \
+            'ckanext.mapactionimporter.tests.lib.test_metrics:_ListSink'
+        record = {'outcome': 'success', 'filename': 'carte-\xe9t\xe9.zip'}
+
+        with mock.patch.object(metrics.log, 'info') as info:
+            metrics.record_import(record)
+
+        self.assertIn(r'carte-\xe9t\xe9.zip', info.call_args[0][0])
+        self.assertEqual(RECORDS, [record])
+
+    def test_base_sink_discards_records(self):
+        metrics.MetricsSink().record({'outcome': 'success'})
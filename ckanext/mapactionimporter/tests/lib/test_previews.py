@@ -0,0 +1,98 @@
+import os
+import unittest
+from StringIO import StringIO
+
+from nose import SkipTest
+
+from ckanext.mapactionimporter.lib import mappackage, previews
+
+
+def _data_path(filename):
+    return os.path.join(os.path.split(__file__)[0],
+                        '../test-data/', filename)
+
+
+class _Member(object):
+    def __init__(self, name, data):
+        self.name = name
+        self._data = data
+
+    def open(self):
+        return StringIO(self._data)
+
+
+class TestPreviews(unittest.TestCase):
+    def setUp(self):
+        if not previews.available():
+            raise SkipTest('Pillow is not installed')
+
+    def test_previews_made_of_each_size(self):
+        member = mappackage.ExtractedMember(
+            _data_path('MA001_Aptivate_Example-300dpi.jpeg'), 0)
+
+        made = previews.make_previews(member, (100, 400))
+
+        self.assertEqual([p.name for p in made], [
+            'MA001_Aptivate_Example-300dpi-preview-400.jpeg',
+            'MA001_Aptivate_Example-300dpi-preview-100.jpeg',
+        ])
+        for preview, size in zip(made, (400, 100)):
+            self.assertEqual(preview.derived_from,
+                             'MA001_Aptivate_Example-300dpi.jpeg')
+            self.assertEqual(preview.size, len(preview.open().read()))
+
+            image = previews.Image.open(preview.open())
+            self.assertEqual(image.format, 'JPEG')
+            self.assertEqual(max(image.size), size)
+
+    def test_previews_much_smaller_than_original(self):
+        path = _data_path('MA001_Aptivate_Example-300dpi.jpeg')
+        member = mappackage.ExtractedMember(path, 0)
+
+        made = previews.make_previews(member)
+
+        self.assertTrue(made[0].size * 5 < os.path.getsize(path))
+
+    def _png(self, width, height):
+        output = StringIO()
+        previews.Image.new('RGB', (width, height), 'white').save(output, 'PNG')
+        return output.getvalue()
+
+    def test_nothing_made_of_image_with_too_many_pixels(self):
+        # PNGs aren't decoded at a reduced scale as JPEGs are, so the full
+        # size counts
+        member = _Member('map.png', self._png(2000, 1000))
+
+        self.assertEqual(
+            previews.make_previews(member, (100,), max_pixels=1000 * 1000),
+            [])
+
+    def test_previews_made_of_image_within_pixel_limit(self):
+        member = _Member('map.png', self._png(1000, 500))
+
+        made = previews.make_previews(member, (100,), max_pixels=1000 * 1000)
+
+        self.assertEqual([p.name for p in made], ['map-preview-100.jpeg'])
+
+    def test_large_jpeg_counted_at_reduced_scale(self):
+        member = mappackage.ExtractedMember(
+            _data_path('MA001_Aptivate_Example-300dpi.jpeg'), 0)
+        width, height = previews.Image.open(member.open()).size
+
+        made = previews.make_previews(member, (100,),
+                                      max_pixels=width * height // 4)
+
+        self.assertEqual(len(made), 1)
+
+    def test_nothing_made_of_invalid_image(self):
+        member = _Member('map.jpeg', 'not an image')
+
+        self.assertEqual(previews.make_previews(member), [])
+
+    def test_only_images_used_as_sources(self):
+        members = [_Member(name, '') for name in (
+            'map.pdf', 'map.JPG', 'map.png', 'map.xml')]
+
+        self.assertEqual(
+            [m.name for m in previews.preview_sources(members)],
+            ['map.JPG', 'map.png'])
@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+import unittest
+
+import ckan.plugins.toolkit as toolkit
+
+from ckanext.mapactionimporter.lib import themes
+
+# Theme spellings found in map package metadata, and the themes they are for
+SPELLINGS = (
+    ("Health", "Health"),
+    ("Health ", "Health"),
+    ("health", "Health"),
+    (" HEALTH\n", "Health"),
+    (u"Health", "Health"),
+    ("Affected population", "Affected Population"),
+    ("Affected_Population", "Affected Population"),
+    ("Camp Coordination/Management", "Camp Coordination or Management"),
+    ("Camp Coordination & Management", "Camp Coordination or Management"),
+    ("CCCM", "Camp Coordination or Management"),
+    ("Emergency Telecoms", None),
+    ("Emergency Telecommunications", "Emergency Telecommunications"),
+    ("ETC", "Emergency Telecommunications"),
+    ("Pcodes", "P-codes"),
+    ("P codes", "P-codes"),
+    ("P-Codes", "P-codes"),
+    ("Place codes", "P-codes"),
+    ("Orientation & Reference", "Orientation and Reference"),
+    ("Orientation / Reference", "Orientation and Reference"),
+    ("Search & Rescue / Evacuation Planning",
+     "Search and Rescue or Evacuation Planning"),
+    ("Search and rescue sectors", "Search and Rescue Sectors"),
+    ("Security, Safety & Protection", "Security and Safety and Protection"),
+    ("Situation & Damage", "Situation and Damage"),
+    ("Water, Sanitation and Hygiene", "Water Sanitation and Hygiene"),
+    ("Water, Sanitation & Hygiene", "Water Sanitation and Hygiene"),
+    ("WASH", "Water Sanitation and Hygiene"),
+    ("Wash", "Water Sanitation and Hygiene"),
+    ("Who What Where", "Who-What-Where"),
+    ("Who, What, Where", "Who-What-Where"),
+    ("3W", "Who-What-Where"),
+    ("Shelter", "Emergency Shelter"),
+    ("Population", None),
+    ("", None),
+    (None, None),
+)
+
+
+class TestNormalise(unittest.TestCase):
+    def test_product_themes_distinct_when_normalised(self):
+        normalised = set(themes.normalise(t) for t in themes.PRODUCT_THEMES)
+
+        self.assertEqual(len(normalised), len(themes.PRODUCT_THEMES))
+
+    def test_punctuation_case_and_connectives_folded(self):
+        self.assertEqual(themes.normalise('Water, Sanitation & Hygiene'),
+                         'watersanitationhygiene')
+
+
+class TestThemeIndex(unittest.TestCase):
+    def test_spellings(self):
+        index = themes.ThemeIndex(themes.PRODUCT_THEMES, themes.ALIASES)
+
+        for spelling, theme in SPELLINGS:
+            self.assertEqual(index.lookup(spelling), theme,
+                             'Looking up {0!r}'.format(spelling))
+
+    def test_product_themes_found_without_aliases(self):
+        index = themes.ThemeIndex()
+
+        for theme in themes.PRODUCT_THEMES:
+            self.assertEqual(index.lookup(theme), theme)
+
+    def test_alias_for_unknown_theme_ignored(self):
+        index = themes.ThemeIndex(aliases={'Roads': 'Transport'})
+
+        self.assertEqual(index.lookup('Roads'), None)
+
+
+class TestConfiguredAliases(unittest.TestCase):
+    def tearDown(self):
+        toolkit.config.pop('ckanext.mapactionimporter.theme_aliases', None)
+
+    def test_parse_aliases(self):
+        self.assertEqual(
+            themes.parse_aliases('\n  Food Security: Nutrition\nbad\n'),
+            {'Food Security': 'Nutrition'})
+
+    def test_configured_aliases_used(self):
+        self.assertEqual(themes.lookup('Food Security'), None)
+
+        toolkit.config['ckanext.mapactionimporter.theme_aliases'] = \
+            'Food Security: Nutrition'
+
+        self.assertEqual(themes.lookup('Food Security'), 'Nutrition')
+        self.assertEqual(themes.lookup('WASH'),
+                         'Water Sanitation and Hygiene')
@@ -0,0 +1,54 @@
+import os
+import unittest
+
+from ckanext.mapactionimporter.lib import workspace
+
+
+class TestImportWorkspace(unittest.TestCase):
+    def test_directory_removed_on_exit(self):
+        with workspace.ImportWorkspace() as ws:
+            path = ws.path
+            open(os.path.join(path, 'file.pdf'), 'w').close()
+
+        self.assertFalse(os.path.exists(path))
+
+    def test_directory_removed_on_error(self):
+        try:
+            with workspace.ImportWorkspace() as ws:
+                path = ws.path
+                raise ValueError()
+        except ValueError:
+            pass
+
+        self.assertFalse(os.path.exists(path))
+
+    def test_directory_only_created_when_used(self):
+        with workspace.ImportWorkspace() as ws:
+            self.assertEqual(ws._path, None)
+
+    def test_reservations_counted_in_flight_until_exit(self):
+        before = workspace.bytes_in_flight()
+
+        with workspace.ImportWorkspace() as ws:
+            ws.reserve(100)
+            ws.reserve(50)
+            self.assertEqual(workspace.bytes_in_flight(), before + 150)
+
+        self.assertEqual(workspace.bytes_in_flight(), before)
+
+    def test_it_raises_when_quota_exceeded(self):
+        with workspace.ImportWorkspace(quota=100) as ws:
+            ws.reserve(60)
+
+            with self.assertRaises(workspace.WorkspaceQuotaExceeded):
+                ws.reserve(60)
+
+    def test_it_raises_when_global_quota_exceeded(self):
+        quota = workspace.bytes_in_flight() + 100
+
+        with workspace.ImportWorkspace(global_quota=quota) as first:
+            first.reserve(60)
+
+            with workspace.ImportWorkspace(global_quota=quota) as second:
+                with self.assertRaises(workspace.WorkspaceQuotaExceeded):
+                    second.reserve(60)
@@ -1,13 +1,26 @@
+import hashlib
+import os
+import shutil
+import tempfile
+import zipfile
+from StringIO import StringIO
+
+import mock
+from nose import SkipTest
+
 import ckan.tests.helpers as helpers
 import ckan.tests.factories as factories
 import ckan.plugins.toolkit as toolkit
 import ckan.lib.uploader as uploader
 
+import ckanext.mapactionimporter.logic.action.create as create
+from ckanext.mapactionimporter.lib import idempotency, metrics, previews
 from ckanext.mapactionimporter.tests.helpers import (
     FunctionalTestBaseClass,
     assert_equal,
     assert_false,
     assert_raises,
+    assert_regexp_matches,
     assert_true,
     get_correction_zip,
     get_missing_fields_zip,
@@ -74,6 +87,92 @@ class TestCreateDatasetForEvent(TestDatasetForEvent):
                                       'MA001_Aptivate_Example-300dpi.pdf',
                                       'ma001aptivateexample-300dpi.pdf')
 
+    def test_resources_record_size_and_sha256(self):
+        dataset = helpers.call_action(
+            'create_dataset_from_mapaction_zip',
+            upload=_UploadFile(get_test_zip()))
+
+        with zipfile.ZipFile(get_test_zip()) as z:
+            for resource in dataset['resources']:
+                data = z.read(resource['name'])
+                assert_equal(int(resource['size']), len(data))
+                assert_equal(resource['sha256'],
+                             hashlib.sha256(data).hexdigest())
+
+    @helpers.change_config('ckanext.mapactionimporter.stream_uploads', False)
+    def test_extracted_resources_record_sha256(self):
+        dataset = helpers.call_action(
+            'create_dataset_from_mapaction_zip',
+            upload=_UploadFile(get_test_zip()))
+
+        with zipfile.ZipFile(get_test_zip()) as z:
+            for resource in dataset['resources']:
+                assert_equal(resource['sha256'], hashlib.sha256(
+                    z.read(resource['name'])).hexdigest())
+
+    @helpers.change_config('ckanext.mapactionimporter.previews', True)
+    @helpers.change_config('ckanext.mapactionimporter.preview_sizes', '100 400')
+    def test_previews_added_as_derived_resources(self):
+        if not previews.available():
+            raise SkipTest('Pillow is not installed')
+
+        dataset = helpers.call_action(
+            'create_dataset_from_mapaction_zip',
+            upload=_UploadFile(get_test_zip()))
+
+        derived = [r for r in dataset['resources'] if r.get('derived_from')]
+        assert_equal(len(dataset['resources']), 4)
+        assert_equal(sorted(r['name'] for r in derived), [
+            'MA001_Aptivate_Example-300dpi-preview-100.jpeg',
+            'MA001_Aptivate_Example-300dpi-preview-400.jpeg',
+        ])
+        for resource in derived:
+            assert_equal(resource['derived_from'],
+                         'MA001_Aptivate_Example-300dpi.jpeg')
+            assert_equal(resource['format'], 'JPEG')
+
+    @helpers.change_config('ckanext.mapactionimporter.upload_workers', 4)
+    def test_parallel_uploads_keep_package_order(self):
+        dataset = helpers.call_action(
+            'create_dataset_from_mapaction_zip',
+            upload=_UploadFile(get_test_zip()))
+
+        assert_equal([r['name'] for r in dataset['resources']],
+                     ['MA001_Aptivate_Example-300dpi.jpeg',
+                      'MA001_Aptivate_Example-300dpi.pdf'])
+        assert_equal([r['format'] for r in dataset['resources']],
+                     ['JPEG', 'PDF'])
+
+    @helpers.change_config('ckanext.mapactionimporter.deduplicate_uploads',
+                           True)
+    def test_identical_files_stored_once(self):
+        storage_path = tempfile.mkdtemp()
+        try:
+            with mock.patch.object(uploader, 'get_storage_path',
+                                   return_value=storage_path):
+                organization = factories.Organization(user=self.user)
+                version_1 = helpers.call_action(
+                    'create_dataset_from_mapaction_zip',
+                    context={'user': self.user['name']},
+                    upload=_UploadFile(get_test_zip()),
+                    owner_org=organization['id'])
+                # Version 2 has the same map files as version 1
+                version_2 = helpers.call_action(
+                    'create_dataset_from_mapaction_zip',
+                    upload=_UploadFile(get_update_zip()))
+
+                for resource_1, resource_2 in zip(version_1['resources'],
+                                                  version_2['resources']):
+                    upload = uploader.ResourceUpload(resource_1)
+                    path_1 = upload.get_path(resource_1['id'])
+                    path_2 = upload.get_path(resource_2['id'])
+
+                    assert_equal(resource_1['sha256'], resource_2['sha256'])
+                    assert_equal(os.stat(path_1).st_ino,
+                                 os.stat(path_2).st_ino)
+        finally:
+            shutil.rmtree(storage_path)
+
     def test_dataset_private_when_organization_specified(self):
         organization = factories.Organization(user=self.user)
         dataset = helpers.call_action(
@@ -185,6 +284,70 @@ class TestCreateDatasetForEvent(TestDatasetForEvent):
             dataset['name'],
             '189-ma001-v1')
 
+    def test_it_rolls_back_if_version_link_fails(self):
+        real_get_action = toolkit.get_action
+        stored = []
+
+        def failing_get_action(name):
+            if name == 'dataset_version_create':
+                def dataset_version_create(context, data_dict):
+                    raise toolkit.ValidationError({'id': ['Failed']})
+                return dataset_version_create
+            return real_get_action(name)
+
+        def recording_upload(upload, resource_id, max_size):
+            stored.append(upload.get_path(resource_id))
+            return real_upload(upload, resource_id, max_size)
+
+        real_upload = uploader.ResourceUpload.upload
+        with mock.patch.object(toolkit, 'get_action', failing_get_action), \
+                mock.patch.object(uploader.ResourceUpload, 'upload',
+                                  recording_upload):
+            with assert_raises(toolkit.ValidationError):
+                helpers.call_action(
+                    'create_dataset_from_mapaction_zip',
+                    upload=_UploadFile(get_test_zip()))
+
+        assert_equal(len(stored), 2)
+        for path in stored:
+            assert_false(os.path.exists(path))
+
+        with assert_raises(toolkit.ObjectNotFound):
+            helpers.call_action('package_show', id='189-ma001-v1')
+
+        # Nothing is left to stop the package being imported again
+        dataset = helpers.call_action(
+            'create_dataset_from_mapaction_zip',
+            upload=_UploadFile(get_test_zip()))
+        assert_equal(dataset['name'], '189-ma001-v1')
+
+    @helpers.change_config('ckanext.mapactionimporter.stream_uploads', False)
+    @helpers.change_config('ckanext.mapactionimporter.import_quota', 1000)
+    def test_it_raises_if_package_exceeds_import_quota(self):
+        with assert_raises(toolkit.ValidationError) as cm:
+            helpers.call_action(
+                'create_dataset_from_mapaction_zip',
+                upload=_UploadFile(get_test_zip()))
+
+        assert_regexp_matches(cm.exception.error_summary['Upload'],
+                              'Map package is too large to import')
+
+        datasets = helpers.call_action('package_list')
+        assert_equal(len(datasets), 0)
+
+    @helpers.change_config('ckanext.mapactionimporter.max_member_size', 1000)
+    def test_it_raises_if_member_exceeds_size_limit(self):
+        with assert_raises(toolkit.ValidationError) as cm:
+            helpers.call_action(
+                'create_dataset_from_mapaction_zip',
+                upload=_UploadFile(get_test_zip()))
+
+        assert_regexp_matches(cm.exception.error_summary['Upload'],
+                              'is larger than 1000 bytes')
+
+        datasets = helpers.call_action('package_list')
+        assert_equal(len(datasets), 0)
+
     def test_it_raises_if_file_has_special_characters(self):
         with assert_raises(toolkit.ValidationError) as cm:
             helpers.call_action(
@@ -283,10 +446,11 @@ class TestCreateDatasetForEvent(TestDatasetForEvent):
             })
 
     def test_error_when_status_is_update_and_dataset_exists(self):
+        # A different archive of the same map version
         helpers.call_action(
             'create_dataset_from_mapaction_zip',
             context={'user': self.user['name']},
-            upload=_UploadFile(get_update_zip()),
+            upload=_UploadFile(_with_zip_comment(get_update_zip())),
         )
 
         with assert_raises(toolkit.ValidationError) as cm:
@@ -304,6 +468,117 @@ class TestCreateDatasetForEvent(TestDatasetForEvent):
             })
 
 
+class TestCreateDatasetWrites(TestDatasetForEvent):
+    def test_dataset_written_in_a_single_package_create(self):
+        calls = []
+        real_get_action = toolkit.get_action
+
+        def recording_get_action(name):
+            action = real_get_action(name)
+
+            def record(context, data_dict=None):
+                calls.append((name, data_dict or {}))
+                return action(context, data_dict)
+            return record
+
+        with mock.patch.object(toolkit, 'get_action', recording_get_action):
+            dataset = helpers.call_action(
+                'create_dataset_from_mapaction_zip',
+                context={'user': self.user['name']},
+                upload=_UploadFile(get_test_zip()))
+
+        writes = [name for (name, data_dict) in calls
+                  if dataset['id'] in (data_dict.get('id'),
+                                       data_dict.get('package_id'),
+                                       data_dict.get('object')) and
+                  name in ('package_update', 'resource_create',
+                           'member_create')]
+        creates = [data_dict['name'] for (name, data_dict) in calls
+                   if name == 'package_create' and
+                   data_dict.get('name') == dataset['name']]
+
+        assert_equal(writes, [])
+        assert_equal(creates, ['189-ma001-v1'])
+
+        assert_equal(len(dataset['resources']), 2)
+        assert_equal([g['name'] for g in dataset['groups']], ['00189'])
+
+
+class TestImportMetrics(TestDatasetForEvent):
+    def test_import_stages_recorded(self):
+        with mock.patch.object(metrics, 'record_import') as record_import:
+            helpers.call_action(
+                'create_dataset_from_mapaction_zip',
+                context={'user': self.user['name']},
+                upload=_UploadFile(get_test_zip()))
+
+        [(record,), kwargs] = record_import.call_args
+        assert_equal(record['outcome'], 'success')
+        assert_equal(record['dataset'], '189-ma001-v1')
+        assert_equal(record['stages'].keys(), [
+            'read_metadata', 'archive_sha256', 'read_members',
+            'resource_upload', 'resource_file', 'package_create',
+            'dataset_version_create'])
+        assert_equal(record['stages']['resource_file']['calls'], 2)
+        assert_equal(record['stages']['archive_sha256']['bytes'],
+                     os.path.getsize(get_test_zip().name))
+
+    def test_invalid_import_recorded(self):
+        with mock.patch.object(metrics, 'record_import') as record_import:
+            with assert_raises(toolkit.ValidationError):
+                helpers.call_action(
+                    'create_dataset_from_mapaction_zip',
+                    context={'user': self.user['name']},
+                    upload=_UploadFile(get_not_zip()))
+
+        [(record,), kwargs] = record_import.call_args
+        assert_equal(record['outcome'], 'invalid')
+
+
+class TestRetriedImport(TestDatasetForEvent):
+    def test_retry_returns_existing_dataset(self):
+        dataset = helpers.call_action(
+            'create_dataset_from_mapaction_zip',
+            context={'user': self.user['name']},
+            upload=_UploadFile(get_test_zip()))
+
+        with mock.patch.object(create, '_upload_resource_files') as upload:
+            retried = helpers.call_action(
+                'create_dataset_from_mapaction_zip',
+                context={'user': self.user['name']},
+                upload=_UploadFile(get_test_zip()))
+
+        assert_false(upload.called)
+        assert_equal(retried['id'], dataset['id'])
+        assert_equal(retried['resources'], dataset['resources'])
+
+    def test_dataset_records_archive_hash(self):
+        dataset = helpers.call_action(
+            'create_dataset_from_mapaction_zip',
+            context={'user': self.user['name']},
+            upload=_UploadFile(get_test_zip()))
+
+        extras = dict((e['key'], e['value']) for e in dataset['extras'])
+        assert_equal(extras['import_sha256'],
+                     idempotency.archive_sha256(get_test_zip()))
+
+    def test_retry_during_import_refused_after_wait(self):
+        key = idempotency.import_key(
+            idempotency.archive_sha256(get_test_zip()),
+            {'name': '189-ma001-v1'})
+
+        with idempotency.claim(key):
+            with assert_raises(toolkit.ValidationError) as cm:
+                helpers.call_action(
+                    'create_dataset_from_mapaction_zip',
+                    context={'user': self.user['name'], 'claim_wait': 0},
+                    upload=_UploadFile(get_test_zip()))
+
+        assert_equal(cm.exception.error_summary, {
+            'Upload': 'This package is already being imported. Try again '
+                      'once that import has finished.'})
+
+
 class TestCorrectExistingDataset(TestDatasetForEvent):
     def setup(self):
         super(TestCorrectExistingDataset, self).setup()
@@ -315,6 +590,22 @@ class TestCorrectExistingDataset(TestDatasetForEvent):
             owner_org=self.organization['id']
         )
 
+    def test_no_files_stored_without_access_to_dataset(self):
+        helpers.call_action('package_patch', id=self.dataset['id'],
+                            private=False)
+        outsider = factories.User()
+        outsider_organization = factories.Organization(user=outsider)
+
+        with mock.patch.object(create, '_upload_resource_files') as upload:
+            with assert_raises(toolkit.NotAuthorized):
+                helpers.call_action(
+                    'create_dataset_from_mapaction_zip',
+                    context={'user': outsider['name']},
+                    upload=_UploadFile(get_correction_zip()),
+                    owner_org=outsider_organization['id'])
+
+        assert_false(upload.called)
+
     def test_updated_version_replaces_existing(self):
         assert_true(self.dataset['private'])
 
@@ -348,10 +639,48 @@ class TestCorrectExistingDataset(TestDatasetForEvent):
                                    key=lambda k: k['format'])
         assert_equal(len(updated_resources), 2)
 
+        # Only the JPEG is different in the correction
         assert_true(
             original_resources[0]['id'] != updated_resources[0]['id'])
-        assert_true(
-            original_resources[1]['id'] != updated_resources[1]['id'])
+        assert_equal(updated_resources[0]['size'], 1464780)
+        assert_equal(
+            original_resources[1]['id'], updated_resources[1]['id'])
+
+    def test_only_changed_files_uploaded(self):
+        with mock.patch.object(create, '_upload_resource_file',
+                               wraps=create._upload_resource_file) as upload:
+            helpers.call_action(
+                'create_dataset_from_mapaction_zip',
+                context={'user': self.user['name']},
+                upload=_UploadFile(get_correction_zip()),
+                owner_org=self.organization['id']
+            )
+
+        uploaded = [c[0][0].name for c in upload.call_args_list]
+        assert_equal(uploaded, ['MA001_Aptivate_Example-300dpi.jpeg'])
+
+    def test_removed_files_removed_from_dataset(self):
+        dataset = helpers.call_action('package_show', id=self.dataset['id'])
+        jpeg = [r for r in dataset['resources'] if r['format'] == 'JPEG'][0]
+        pdf = [r for r in dataset['resources'] if r['format'] == 'PDF'][0]
+
+        # Make the PDF look like a file from a different package
+        pdf['name'] = 'Another_File.pdf'
+        helpers.call_action('package_update', **dataset)
+
+        updated_dataset = helpers.call_action(
+            'create_dataset_from_mapaction_zip',
+            context={'user': self.user['name']},
+            upload=_UploadFile(get_correction_zip()),
+            owner_org=self.organization['id']
+        )
+
+        names = sorted(r['name'] for r in updated_dataset['resources'])
+        assert_equal(names, ['MA001_Aptivate_Example-300dpi.jpeg',
+                             'MA001_Aptivate_Example-300dpi.pdf'])
+        ids = [r['id'] for r in updated_dataset['resources']]
+        assert_false(jpeg['id'] in ids)
+        assert_false(pdf['id'] in ids)
 
     def test_nothing_changed_if_resource_update_fails(self):
         old_max_resource_size = uploader._max_resource_size
@@ -425,6 +754,133 @@ class TestCorrectExistingDataset(TestDatasetForEvent):
             })
 
 
+class TestValidateZips(TestDatasetForEvent):
+    def _validate(self, *zip_files):
+        return helpers.call_action(
+            'validate_mapaction_zips',
+            context={'user': self.user['name']},
+            uploads=[_UploadFile(f) for f in zip_files],
+            workers=2)
+
+    @helpers.change_config('ckanext.mapactionimporter.validate_workers', 2)
+    def test_workers_capped_by_config(self):
+        with mock.patch.object(create.workers, 'pool',
+                               wraps=create.workers.pool) as pool:
+            helpers.call_action(
+                'validate_mapaction_zips',
+                context={'user': self.user['name']},
+                uploads=[_UploadFile(get_test_zip()),
+                         _UploadFile(get_update_zip()),
+                         _UploadFile(get_correction_zip())],
+                workers=500)
+
+        pool.assert_called_once_with(2)
+
+    def test_non_positive_workers_rejected(self):
+        for workers in (0, -1, 'many'):
+            with assert_raises(toolkit.ValidationError):
+                helpers.call_action(
+                    'validate_mapaction_zips',
+                    context={'user': self.user['name']},
+                    uploads=[_UploadFile(get_test_zip())],
+                    workers=workers)
+
+    def test_valid_package_reported_without_importing(self):
+        report = self._validate(get_test_zip())
+
+        [result] = report['results']
+        assert_true(result['valid'])
+        assert_equal(result['name'], '189-ma001-v1')
+        assert_equal(result['status'], 'New')
+        assert_equal(result['errors'], [])
+        assert_equal((report['valid'], report['invalid']), (1, 0))
+
+        with assert_raises(toolkit.ObjectNotFound):
+            helpers.call_action('package_show', id='189-ma001-v1')
+
+    def test_results_in_order_given(self):
+        report = self._validate(get_not_zip(), get_test_zip(),
+                                get_zip_no_metadata())
+
+        assert_equal([r['errors'] for r in report['results']], [
+            ['File is not a zip file'],
+            [],
+            ['Could not find metadata XML in zip file'],
+        ])
+        assert_equal((report['valid'], report['invalid']), (1, 2))
+
+    def test_status_conflicts_reported(self):
+        helpers.call_action(
+            'create_dataset_from_mapaction_zip',
+            context={'user': self.user['name']},
+            upload=_UploadFile(get_update_zip()))
+
+        report = self._validate(get_update_zip())
+
+        assert_equal(report['results'][0]['errors'], [
+            "Status is 'Update' but dataset '189-ma001-v2' already exists"])
+
+    def test_duplicate_datasets_in_batch_reported(self):
+        report = self._validate(get_test_zip(),
+                                _with_zip_comment(get_test_zip()))
+
+        for result in report['results']:
+            assert_false(result['valid'])
+            assert_equal(result['errors'], [
+                "More than one package in the batch is for dataset '189-ma001-v1'"])
+
+
+class TestCreateDatasetsFromZips(TestDatasetForEvent):
+    def _import(self, *zip_files):
+        return helpers.call_action(
+            'create_datasets_from_mapaction_zips',
+            context={'user': self.user['name']},
+            uploads=[_UploadFile(f) for f in zip_files])
+
+    def test_packages_imported_in_order_given(self):
+        report = self._import(get_test_zip(), get_update_zip())
+
+        assert_equal([r['name'] for r in report['results']],
+                     ['189-ma001-v1', '189-ma001-v2'])
+        assert_equal((report['imported'], report['failed']), (2, 0))
+
+        dataset = helpers.call_action('package_show', id='189-ma001-v2')
+        assert_equal([g['name'] for g in dataset['groups']], ['00189'])
+
+    def test_failed_package_does_not_stop_batch(self):
+        report = self._import(get_not_zip(), get_test_zip())
+
+        [failed, imported] = report['results']
+        assert_false(failed['success'])
+        assert_equal(failed['errors'], {'Upload': 'File is not a zip file'})
+        assert_true(imported['success'])
+        assert_equal((report['imported'], report['failed']), (1, 1))
+
+    def test_event_looked_up_once_per_batch(self):
+        calls = []
+        real_get_action = toolkit.get_action
+
+        def recording_get_action(name):
+            calls.append(name)
+            return real_get_action(name)
+
+        with mock.patch.object(toolkit, 'get_action', recording_get_action):
+            report = self._import(get_test_zip(), get_update_zip())
+
+        assert_equal(report['imported'], 2)
+        assert_equal(calls.count('group_show'), 1)
+
+    def test_missing_event_reported_for_each_package(self):
+        helpers.call_action('group_purge', id=self.group_189['id'])
+
+        report = self._import(get_test_zip(), get_update_zip())
+
+        for result in report['results']:
+            assert_false(result['success'])
+            assert_equal(result['errors'], {
+                'Upload': "Event with operationID '00189' does not exist"})
+
+
 class TestCreateDatasetForNoEvent(TestCreateDatasetFromZip):
     def test_it_raises_if_event_does_not_exist(self):
         with assert_raises(toolkit.ValidationError) as cm:
@@ -438,6 +894,16 @@ class TestCreateDatasetForNoEvent(TestCreateDatasetFromZip):
         })
 
 
+def _with_zip_comment(fp, comment='Re-exported'):
+    # Same contents, different archive
+    copy = StringIO(fp.read())
+    with zipfile.ZipFile(copy, 'a') as z:
+        z.comment = comment
+    copy.seek(0)
+
+    return copy
+
+
 class _UploadFile(object):
     '''Mock the parts from cgi.FileStorage we use.'''
     def __init__(self, fp):
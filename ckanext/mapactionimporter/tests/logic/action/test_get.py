@@ -0,0 +1,85 @@
+import shutil
+import tempfile
+
+import ckan.tests.factories as factories
+import ckan.tests.helpers as helpers
+import ckan.plugins.toolkit as toolkit
+
+from ckanext.mapactionimporter.lib import jobs
+from ckanext.mapactionimporter.lib.upload import FileUpload
+from ckanext.mapactionimporter.tests.helpers import (
+    FunctionalTestBaseClass,
+    assert_equal,
+    assert_raises,
+    get_not_zip,
+    get_test_zip,
+)
+
+
+class TestImportStatus(FunctionalTestBaseClass):
+    def setup(self):
+        super(TestImportStatus, self).setup()
+        self.user = factories.User()
+        factories.Group(name='00189', user=self.user)
+
+        # Each test gets its own job queue
+        self.state_dir = tempfile.mkdtemp()
+        toolkit.config['ckanext.mapactionimporter.state_dir'] = self.state_dir
+
+    def teardown(self):
+        del toolkit.config['ckanext.mapactionimporter.state_dir']
+        shutil.rmtree(self.state_dir)
+
+    @helpers.change_config(
+        'ckanext.mapactionimporter.async_worker_threads', 0)
+    def test_status_follows_job_to_completion(self):
+        job_id = jobs.enqueue(self.user['name'], FileUpload(get_test_zip()),
+                              {})
+
+        job = helpers.call_action('mapaction_import_status',
+                                  context={'user': self.user['name']},
+                                  id=job_id)
+        assert_equal(job['status'], 'queued')
+        assert_equal(job['filename'], 'MA001_Aptivate_Example.zip')
+
+        jobs.work(run_forever=False)
+
+        job = helpers.call_action('mapaction_import_status',
+                                  context={'user': self.user['name']},
+                                  id=job_id)
+        assert_equal(job['status'], 'complete')
+        assert_equal(job['dataset'], '189-ma001-v1')
+
+        dataset = helpers.call_action('package_show', id='189-ma001-v1')
+        assert_equal(len(dataset['resources']), 2)
+
+    @helpers.change_config(
+        'ckanext.mapactionimporter.async_worker_threads', 0)
+    def test_status_reports_validation_errors(self):
+        job_id = jobs.enqueue(self.user['name'], FileUpload(get_not_zip()),
+                              {})
+
+        jobs.work(run_forever=False)
+
+        job = helpers.call_action('mapaction_import_status',
+                                  context={'user': self.user['name']},
+                                  id=job_id)
+        assert_equal(job['status'], 'error')
+        assert_equal(job['error'], {'Upload': 'File is not a zip file'})
+
+    @helpers.change_config(
+        'ckanext.mapactionimporter.async_worker_threads', 0)
+    def test_other_users_cannot_see_status(self):
+        job_id = jobs.enqueue(self.user['name'], FileUpload(get_test_zip()),
+                              {})
+        another_user = factories.User()
+
+        with assert_raises(toolkit.NotAuthorized):
+            helpers.call_action('mapaction_import_status',
+                                context={'user': another_user['name'],
+                                         'ignore_auth': False},
+                                id=job_id)
+
+    def test_it_raises_if_job_does_not_exist(self):
+        with assert_raises(toolkit.ObjectNotFound):
+            helpers.call_action('mapaction_import_status', id='not-a-job')
@@ -0,0 +1,101 @@
+import Queue
+import json
+import os
+import tempfile
+
+import mock
+
+import ckan.plugins.toolkit as toolkit
+import ckan.tests.factories as factories
+import ckan.tests.helpers as helpers
+
+from ckanext.mapactionimporter import commands
+from ckanext.mapactionimporter.tests.helpers import (
+    FunctionalTestBaseClass,
+    assert_equal,
+    assert_false,
+    assert_true,
+    get_not_zip,
+    get_test_zip,
+    get_update_zip,
+)
+
+
+class TestBulkImport(FunctionalTestBaseClass):
+    def setup(self):
+        super(TestBulkImport, self).setup()
+        self.user = factories.User()
+        factories.Group(name='00189', user=self.user)
+
+    def _import_zips(self, *paths):
+        results = Queue.Queue()
+        commands._import_zips((paths, self.user['name'], None, results))
+
+        return [results.get_nowait() for path in paths]
+
+    def test_import_zips_creates_dataset(self):
+        [result] = self._import_zips(get_test_zip().name)
+
+        assert_true(result['success'])
+        assert_equal(result['name'], '189-ma001-v1')
+        assert_equal(result['bytes'], os.path.getsize(get_test_zip().name))
+
+        dataset = helpers.call_action('package_show', id='189-ma001-v1')
+        assert_equal(len(dataset['resources']), 2)
+
+    def test_import_zips_reports_failure(self):
+        [failed, imported] = self._import_zips(get_not_zip().name,
+                                               get_test_zip().name)
+
+        assert_false(failed['success'])
+        assert_equal(failed['error'], {'Upload': 'File is not a zip file'})
+        assert_equal(failed['path'], os.path.abspath(get_not_zip().name))
+        assert_true(imported['success'])
+
+    def test_each_result_reported_as_package_is_imported(self):
+        results = Queue.Queue()
+        real_get_action = toolkit.get_action
+        queued = []
+
+        def recording_get_action(name):
+            # Imports after the first start once its result is queued
+            if name == 'create_dataset_from_mapaction_zip':
+                queued.append(results.qsize())
+            return real_get_action(name)
+
+        with mock.patch.object(toolkit, 'get_action', recording_get_action):
+            commands._import_zips(
+                ([get_test_zip().name, get_update_zip().name],
+                 self.user['name'], None, results))
+
+        assert_equal(queued, [0, 1])
+        assert_equal(results.qsize(), 2)
+
+    def test_checkpoint_lists_successful_imports(self):
+        fd, path = tempfile.mkstemp()
+        with os.fdopen(fd, 'w') as f:
+            for result in ({'path': '/a.zip', 'success': True},
+                           {'path': '/b.zip', 'success': False}):
+                f.write(json.dumps(result) + '\n')
+
+        try:
+            assert_equal(commands._read_checkpoint(path), set(['/a.zip']))
+        finally:
+            os.remove(path)
+
+
+class TestBatches(object):
+    def test_each_worker_gets_a_batch(self):
+        batches = commands._batches(range(20), 8)
+
+        assert_equal([len(b) for b in batches], [2, 3, 2, 3, 2, 3, 2, 3])
+        assert_equal(sum(batches, []), range(20))
+
+    def test_batches_no_larger_than_batch_size(self):
+        batches = commands._batches(range(100), 2)
+
+        assert_equal([len(b) for b in batches],
+                     [commands.BULK_BATCH_SIZE] * 5)
+
+    def test_no_batches_without_paths(self):
+        assert_equal(commands._batches([], 4), [])
@@ -0,0 +1,130 @@
+from collections import OrderedDict
+
+import mock
+
+import ckan.plugins.toolkit as toolkit
+import ckan.tests.helpers as helpers
+
+from ckanext.mapactionimporter import plugin
+from ckanext.mapactionimporter.lib import workers
+from ckanext.mapactionimporter.tests.helpers import (
+    FunctionalTestBaseClass,
+    assert_equal,
+    assert_true,
+)
+
+
+class TestProductThemesHelper(FunctionalTestBaseClass):
+    def test_themes_listed(self):
+        names = [t['name'] for t in plugin.product_themes()]
+
+        assert_true('Health' in names)
+
+    def test_themes_cached(self):
+        plugin.product_themes()
+        hits = plugin._product_themes_cache.hits
+
+        plugin.product_themes()
+
+        assert_equal(plugin._product_themes_cache.hits, hits + 1)
+
+    def test_cache_invalidated_by_tag_changes(self):
+        plugin.product_themes()
+        vocab = helpers.call_action('vocabulary_show', id='product_themes')
+
+        helpers.call_action('tag_create', name='Roads',
+                            vocabulary_id=vocab['id'])
+        assert_true('Roads' in [t['name'] for t in plugin.product_themes()])
+
+        helpers.call_action('tag_delete', id='Roads',
+                            vocabulary_id=vocab['id'])
+        assert_true(
+            'Roads' not in [t['name'] for t in plugin.product_themes()])
+
+
+class TestCreateProductThemes(FunctionalTestBaseClass):
+    def _theme_names(self):
+        return sorted(t['name'] for t in helpers.call_action(
+            'tag_list', vocabulary_id='product_themes', all_fields=True))
+
+    def test_nothing_changed_when_up_to_date(self):
+        changes = plugin.create_product_themes()
+
+        assert_equal(changes, {
+            'vocabulary_created': False,
+            'created': [],
+            'deleted': [],
+        })
+        assert_equal(self._theme_names(), sorted(plugin.PRODUCT_THEMES))
+
+    def test_vocabulary_synchronised(self):
+        vocab = helpers.call_action('vocabulary_show', id='product_themes')
+        helpers.call_action('tag_create', name='Roads',
+                            vocabulary_id=vocab['id'])
+        helpers.call_action('tag_delete', id='Health',
+                            vocabulary_id=vocab['id'])
+
+        changes = plugin.create_product_themes()
+
+        assert_equal(changes['created'], ['Health'])
+        assert_equal(changes['deleted'], ['Roads'])
+        assert_equal(self._theme_names(), sorted(plugin.PRODUCT_THEMES))
+
+
+class TestFacets(object):
+    def setup(self):
+        self.plugin = plugin.MapactionimporterPlugin()
+        self.patcher = mock.patch.object(toolkit, '_', lambda s: s)
+        self.patcher.start()
+
+    def teardown(self):
+        self.patcher.stop()
+
+    def _facets(self):
+        return OrderedDict([
+            ('organization', 'Organizations'),
+            ('groups', 'Groups'),
+            ('tags', 'Tags'),
+            ('res_format', 'Formats'),
+        ])
+
+    def test_dataset_themes_facet_after_groups(self):
+        for i in range(2):
+            facets = self.plugin.dataset_facets(self._facets(), 'dataset')
+
+            assert_equal(facets.items(), [
+                ('organization', 'Organizations'),
+                ('groups', 'Groups'),
+                ('vocab_product_themes', 'Themes'),
+                ('tags', 'Tags'),
+                ('res_format', 'Formats'),
+            ])
+
+    def test_dataset_themes_facet_first_without_groups(self):
+        facets = self._facets()
+        del facets['groups']
+
+        facets = self.plugin.dataset_facets(facets, 'dataset')
+
+        assert_equal(facets.keys(), [
+            'vocab_product_themes', 'organization', 'tags', 'res_format'])
+
+    def test_group_themes_facet_first(self):
+        facets = self.plugin.group_facets(self._facets(), 'group', 'dataset')
+
+        assert_equal(facets.keys(), [
+            'vocab_product_themes', 'organization', 'groups', 'tags',
+            'res_format'])
+
+    def test_label_translated_each_time(self):
+        self.plugin.dataset_facets(self._facets(), 'dataset')
+
+        with mock.patch.object(toolkit, '_', lambda s: s.upper()):
+            facets = self.plugin.dataset_facets(self._facets(), 'dataset')
+
+        assert_equal(facets['vocab_product_themes'], 'THEMES')
+
+
+class TestReexports(object):
+    def test_register_translator(self):
+        assert_true(plugin.register_translator is workers.register_translator)
@@ -64,6 +64,12 @@ setup(
         'python-slugify>=1.2.0,<1.3.0',
     ],
 
+    # Optional dependencies, installed with for example
+    # pip install ckanext-mapactionimporter[previews]
+    extras_require={
+        'previews': ['Pillow'],
+    },
+
     # If there are data files included in your packages that need to be
     # installed, specify them here.  If using Python 2.6 or less, then these
     # have to be included in MANIFEST.in as well.